@@ -0,0 +1,206 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import os
+import random
+import socket
+import time
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db.models import F, QuerySet
+
+from getrecords.job_telemetry import JobTelemetry
+from mapmonitor.settings import BG_SHARDS
+
+
+# Lets several background job processes (e.g. more than one `tmx_scraper` dyno) split the work instead of duplicating it.
+# Coordination is through redis (the django cache), like the nadeo token lock:
+#  - Each process in a WorkerGroup heartbeats a short-lived key and adds itself to the group's member list.
+#  - One process holds the group's leader lease (renewed every heartbeat). Singleton work (scraping new maps, the cache
+#    builders, ...) only runs on the leader; see ScheduledTask.singleton.
+#  - The leader splits BG_SHARDS shards between the live members; partitioned work (AT checks) only touches the TrackIDs
+#    of the shards this process owns (TrackID % BG_SHARDS). BG_SHARDS is the most processes that can share that work.
+#  - singleton_lease() is for work outside a group that must not run twice at once (the COTD quali cache).
+# Leases expire by time, so if a process stalls for longer than LEASE_SECONDS another can take over while it's still
+# finishing; a process stops starting singleton work as soon as it sees it lost the lease, and singleton_lease cancels
+# the work it guards. Leases are extended and released with compare-and-set scripts on redis, so a process can't extend
+# or delete a lease another process has taken over.
+# If redis is unavailable, every process acts as leader and owns every shard (same as a single process).
+
+LEADER_KEY_FMT = "bg-leader:{group}"
+MEMBERS_KEY_FMT = "bg-members:{group}"
+MEMBER_KEY_FMT = "bg-member:{group}:{member}"
+SHARDS_KEY_FMT = "bg-shards:{group}"
+SINGLETON_KEY_FMT = "bg-singleton:{name}"
+LEASE_SECONDS = 30
+HEARTBEAT_SECONDS = 10
+# KEYS[1]: lease key, ARGV[1]: holder (as the cache stores it), ARGV[2]: new ttl in ms
+EXTEND_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def new_member_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{random.randrange(1 << 32):08x}"
+
+
+class WorkerGroup:
+    def __init__(self, group: str, job: JobTelemetry | None = None, nb_shards: int = BG_SHARDS):
+        ''' job: where to show this process's membership (/debug/jobs) '''
+        self.group = group
+        self.job = job
+        self.nb_shards = nb_shards
+        self.member_id = new_member_id()
+        self.is_leader = False
+        self.shards: list[int] = []
+        self.ready = asyncio.Event()
+
+    async def run_forever(self):
+        while True:
+            await self.heartbeat()
+            self.ready.set()
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+
+    async def heartbeat(self):
+        try:
+            await cache.aset(MEMBER_KEY_FMT.format(group=self.group, member=self.member_id), time.time(), LEASE_SECONDS)
+            members = await cache.aget(MEMBERS_KEY_FMT.format(group=self.group)) or []
+            if self.member_id not in members:
+                # racy (no CAS), but a member that gets dropped re-adds itself next heartbeat
+                await cache.aset(MEMBERS_KEY_FMT.format(group=self.group), members + [self.member_id], None)
+            was_leader = self.is_leader
+            self.is_leader = await renew_lease(LEADER_KEY_FMT.format(group=self.group), self.member_id)
+            if self.is_leader != was_leader:
+                logging.info(f"bg group {self.group}: {self.member_id} {'is now' if self.is_leader else 'is no longer'} the leader")
+            if self.is_leader:
+                await self.assign_shards()
+            assignment = await cache.aget(SHARDS_KEY_FMT.format(group=self.group)) or dict()
+            shards = assignment.get(self.member_id, [])
+            if shards != self.shards:
+                logging.info(f"bg group {self.group}: {self.member_id} now owns shards {shards} of {self.nb_shards}")
+            self.shards = shards
+        except Exception as e:
+            logging.warning(f"bg group {self.group}: heartbeat failed, running everything in this process: {e}")
+            self.is_leader = True
+            self.shards = list(range(self.nb_shards))
+        if self.job is not None:
+            self.job.doc['workers'] = self.status()
+
+    async def assign_shards(self):
+        ''' round robin over the live members, in member id order '''
+        members = await cache.aget(MEMBERS_KEY_FMT.format(group=self.group)) or []
+        alive = await cache.aget_many([MEMBER_KEY_FMT.format(group=self.group, member=m) for m in members])
+        live = sorted(m for m in members if MEMBER_KEY_FMT.format(group=self.group, member=m) in alive)
+        if self.member_id not in live:
+            live = sorted(live + [self.member_id])
+        if live != sorted(members):
+            await cache.aset(MEMBERS_KEY_FMT.format(group=self.group), live, None)
+        assignment = {m: [s for s in range(self.nb_shards) if s % len(live) == i] for i, m in enumerate(live)}
+        await cache.aset(SHARDS_KEY_FMT.format(group=self.group), assignment, LEASE_SECONDS * 3)
+
+    def owns_track(self, track_id: int) -> bool:
+        return track_id % self.nb_shards in self.shards
+
+    def filter_tracks(self, qs: QuerySet, field: str = 'TrackID') -> QuerySet:
+        ''' the rows of qs whose `field` (a TrackID) is in one of our shards '''
+        return qs.annotate(bg_shard=F(field) % self.nb_shards).filter(bg_shard__in=self.shards)
+
+    def status(self) -> dict:
+        return dict(group=self.group, member_id=self.member_id, is_leader=self.is_leader, shards=self.shards, nb_shards=self.nb_shards)
+
+
+async def renew_lease(key: str, holder: str, seconds: int = LEASE_SECONDS) -> bool:
+    ''' takes the lease if it's free, extends it if we hold it; True if we hold it now '''
+    if await cache.aadd(key, holder, seconds):
+        return True
+    return await asyncio.to_thread(extend_lease, key, holder, seconds)
+
+
+async def release_lease(key: str, holder: str):
+    try:
+        await asyncio.to_thread(drop_lease, key, holder)
+    except Exception as e:
+        logging.warning(f"lease release failed for {key}: {e}")
+
+
+def extend_lease(key: str, holder: str, seconds: int) -> bool:
+    backend = caches[DEFAULT_CACHE_ALIAS]
+    if isinstance(backend, RedisCache):
+        return run_lease_script(backend, EXTEND_LEASE_LUA, key, holder, int(seconds * 1000))
+    # other cache backends (local dev, tests): the same, but not atomic
+    return backend.get(key) == holder and backend.touch(key, seconds)
+
+
+def drop_lease(key: str, holder: str) -> bool:
+    backend = caches[DEFAULT_CACHE_ALIAS]
+    if isinstance(backend, RedisCache):
+        return run_lease_script(backend, RELEASE_LEASE_LUA, key, holder)
+    return backend.get(key) == holder and backend.delete(key)
+
+
+def run_lease_script(backend: RedisCache, script: str, key: str, holder: str, *args) -> bool:
+    ''' on the raw redis key, comparing with holder as the cache stores it '''
+    client = backend._cache.get_client(key, write=True)
+    return client.eval(script, 1, backend.make_and_validate_key(key), backend._cache._serializer.dumps(holder), *args) == 1
+
+
+@asynccontextmanager
+async def singleton_lease(name: str):
+    ''' yields True if we got the lease (held, and renewed, until the block exits), False if another process has it.
+        If the lease is lost partway (we couldn't renew it in time), the block is cancelled and LeaseLost raised. '''
+    key = SINGLETON_KEY_FMT.format(name=name)
+    holder = new_member_id()
+    try:
+        got_it = await renew_lease(key, holder)
+    except Exception as e:
+        logging.warning(f"singleton lease {name} failed, running without it: {e}")
+        yield True
+        return
+    if not got_it:
+        yield False
+        return
+    body = asyncio.current_task()
+    lost = asyncio.Event()
+    async def keep_renewing():
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            try:
+                if await renew_lease(key, holder):
+                    renewed_at = time.monotonic()
+                    continue
+                logging.error(f"singleton lease {name}: lost the lease to another process, stopping")
+            except Exception as e:
+                if time.monotonic() - renewed_at < LEASE_SECONDS:
+                    logging.warning(f"singleton lease {name}: renew failed: {e}")
+                    continue
+                logging.error(f"singleton lease {name}: couldn't renew the lease before it expired, stopping: {e}")
+            lost.set()
+            body.cancel()
+            return
+    renewer = asyncio.create_task(keep_renewing())
+    try:
+        yield True
+    except asyncio.CancelledError:
+        # our cancel, and nobody else's: stop here with LeaseLost; otherwise keep cancelling
+        if lost.is_set() and body.uncancel() == 0:
+            raise LeaseLost(f"singleton lease {name} was lost")
+        raise
+    finally:
+        renewer.cancel()
+        if not lost.is_set():
+            await release_lease(key, holder)
@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Callable
+
+from mapmonitor.metrics import record_cache
+
+
+def content_key(*parts: bytes | str | memoryview) -> str:
+    ''' sha256 over the parts; each part is length-prefixed so ('ab', 'c') and ('a', 'bc') differ '''
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class BlobCache:
+    ''' Content-addressed blobs on local disk with LRU eviction by total size.
+        Recency is the file mtime (bumped on every hit), so several processes can share one directory.
+    '''
+    def __init__(self, root: str | Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size_bytes: int | None = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"BlobCache {self.root}: failed to read {key}: {e}")
+            with self._lock:
+                self.misses += 1
+            record_cache(self.root.name, misses=1)
+            return None
+        with self._lock:
+            self.hits += 1
+        record_cache(self.root.name, hits=1)
+        return data
+
+    def put(self, key: str, data: bytes):
+        ''' failing to write (disk full, read-only, ...) is logged and otherwise ignored; the blob just isn't cached '''
+        path = self._path(key)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"BlobCache {self.root}: failed to write {key}: {e}")
+            try:
+                tmp_path.unlink(missing_ok=True)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size_bytes is None:
+                self._size_bytes = self._scan_size()
+            else:
+                self._size_bytes += len(data)
+            if self._size_bytes > self.max_bytes:
+                self._evict()
+
+    def get_or_create(self, key: str, create: Callable[[], bytes]) -> bytes:
+        data = self.get(key)
+        if data is None:
+            data = create()
+            self.put(key, data)
+        return data
+
+    def stats(self) -> dict:
+        ''' hits/misses/evictions are for this process; size is the whole directory '''
+        with self._lock:
+            if self._size_bytes is None:
+                self._size_bytes = self._scan_size()
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size_bytes=self._size_bytes, max_bytes=self.max_bytes)
+
+    def _files(self) -> list[tuple[os.stat_result, Path]]:
+        ret = []
+        for path in self.root.glob('*/*'):
+            if path.name.endswith('.tmp'): continue
+            try:
+                ret.append((path.stat(), path))
+            except FileNotFoundError:
+                pass
+        return ret
+
+    def _scan_size(self) -> int:
+        return sum(st.st_size for st, _ in self._files())
+
+    def _evict(self):
+        ''' drop least recently used blobs until we're at 90% of max_bytes; the directory is rescanned since other processes write to it too '''
+        files = self._files()
+        total = sum(st.st_size for st, _ in files)
+        target = self.max_bytes * 0.9
+        files.sort(key=lambda f: f[0].st_mtime)
+        nb_evicted = 0
+        for st, path in files:
+            if total <= target: break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= st.st_size
+            nb_evicted += 1
+        self.evictions += nb_evicted
+        self._size_bytes = total
+        logging.info(f"BlobCache {self.root}: evicted {nb_evicted} blobs; size now {total} B")
@@ -0,0 +1,241 @@
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Callable
+
+from lxml.html import HtmlElement
+
+from getrecords.bg_workers import WorkerGroup
+from getrecords.http import get_session
+from getrecords.job_telemetry import get_job, job_items, job_stage, run_stage
+from getrecords.kacky import cell_link_uid, cell_text, cell_to_openplanet, html_rows, row_cells
+from getrecords.models import CachedValue
+from getrecords.utils import adumps_json, dumps_json
+from getrecords.view_logic import is_close_to_cotd
+
+
+# Event leaderboards (kacky editions etc.) scraped from HTML tables. An event is just an EventConfig: where its results,
+# maps and per-map LB pages are, how to read each table's columns, and when it's running. Each page is published as a
+# CachedValue doc ({key: rows, ts, min_refresh_period}) and served by the events/<slug>/... endpoints.
+
+MAX_CONCURRENT_FETCHES = 8
+# how often to look for an event becoming active when none are
+IDLE_CHECK_SECONDS = 3600
+# while another tmx_scraper process is the leader, check this often whether we've taken over
+NOT_LEADER_CHECK_SECONDS = 60
+
+EVENTS_JOB = get_job('events')
+
+
+# column kind -> how to get the value from a <td>
+CELL_PARSERS: dict[str, Callable[[HtmlElement], Any]] = {
+    'int': lambda c: int(c.text_content()),
+    'float': lambda c: float(c.text_content()),
+    'raw': lambda c: c.text_content(),
+    'text': cell_text,
+    'openplanet': cell_to_openplanet,
+    'link_uid': cell_link_uid,
+}
+
+
+@dataclass
+class Column:
+    name: str
+    cell: int
+    kind: str
+
+    def __post_init__(self):
+        if self.kind not in CELL_PARSERS:
+            raise ValueError(f"unknown column kind: {self.kind}")
+
+
+@dataclass
+class EventConfig:
+    slug: str
+    results_url: str
+    maps_url: str
+    # formatted with map_uid=...
+    map_lb_url_fmt: str
+    results_columns: list[Column]
+    maps_columns: list[Column]
+    map_lb_columns: list[Column]
+    nb_maps: int
+    active_from: float = 0
+    active_until: float = float('inf')
+    refresh_period: int = 310
+    results_cv_name: str = ""
+    maps_cv_name: str = ""
+    # formatted with the map's index in the maps doc
+    map_cv_name_fmt: str = ""
+    # name of the maps column holding the uid used in map_lb_url_fmt
+    map_uid_column: str = 'map_uid'
+
+    def __post_init__(self):
+        self.results_cv_name = self.results_cv_name or f"{self.slug}Results"
+        self.maps_cv_name = self.maps_cv_name or f"{self.slug}Maps"
+        self.map_cv_name_fmt = self.map_cv_name_fmt or f"{self.slug}Map_{{0}}"
+        for name in [self.results_cv_name, self.maps_cv_name, self.map_cv_name_fmt.format(self.nb_maps - 1)]:
+            if len(name) > CachedValue._meta.get_field('name').max_length:
+                raise ValueError(f"CachedValue name too long for event {self.slug}: {name}")
+        self.map_uid_ix = [c.name for c in self.maps_columns].index(self.map_uid_column)
+
+    def is_active(self, now: float | None = None) -> bool:
+        now = time.time() if now is None else now
+        return self.active_from <= now < self.active_until
+
+    def cv_name(self, doc: str, map_number: int | None = None) -> str | None:
+        ''' doc is 'results', 'maps' or 'map'; None for a map number outside the event '''
+        if doc == 'results': return self.results_cv_name
+        if doc == 'maps': return self.maps_cv_name
+        if map_number is None or not (0 <= map_number < self.nb_maps): return None
+        return self.map_cv_name_fmt.format(map_number)
+
+
+EVENTS: dict[str, EventConfig] = dict()
+
+def register_event(event: EventConfig) -> EventConfig:
+    EVENTS[event.slug] = event
+    return event
+
+
+def kacky_reloaded_event(edition: int, **kwargs) -> EventConfig:
+    ''' all kacky reloaded editions use the same pages and tables '''
+    base = "https://kackyreloaded.com/event/editions"
+    kwargs.setdefault('slug', f"kr{edition}")
+    return EventConfig(
+        results_url=f"{base}/ranking.php?edition={edition}&raw=1",
+        maps_url=f"{base}/records.php?edition={edition}&raw=1",
+        map_lb_url_fmt=f"{base}/maps.php?uid={{map_uid}}&raw=1",
+        results_columns=[Column('rank', 0, 'int'), Column('nickname', 1, 'text'), Column('name_formatted', 1, 'openplanet'),
+                         Column('finishes', 2, 'int'), Column('avgs', 3, 'float'), Column('avgs_finished', 4, 'float')],
+        maps_columns=[Column('map_name', 0, 'text'), Column('map_name_formatted', 0, 'openplanet'), Column('map_uid', 0, 'link_uid'),
+                      Column('author_name', 1, 'text'), Column('author_name_formatted', 1, 'openplanet'), Column('record_time', 2, 'text'),
+                      Column('record_holder', 3, 'text'), Column('record_holder_formatted', 3, 'openplanet'),
+                      Column('finishes', 4, 'int'), Column('karma', 5, 'float')],
+        map_lb_columns=[Column('rank', 0, 'int'), Column('nickname', 1, 'text'), Column('name_formatted', 1, 'openplanet'),
+                        Column('time', 2, 'raw'), Column('finishes', 3, 'int')],
+        **kwargs,
+    )
+
+
+register_event(kacky_reloaded_event(
+    5, nb_maps=75,
+    # end of december 2024
+    active_until=1735597980,
+    results_cv_name="KR5Results", maps_cv_name="KR5Maps", map_cv_name_fmt="KR5Map_{0}",
+))
+
+
+def parse_table(html_doc: str, columns: list[Column]) -> list[list]:
+    ''' one list of column values per <tr> '''
+    min_cells = max(c.cell for c in columns) + 1
+    parsers = [(c.cell, CELL_PARSERS[c.kind]) for c in columns]
+    rows = []
+    for row in html_rows(html_doc):
+        cells = row_cells(row)
+        if len(cells) < min_cells:
+            raise Exception(f"unexpected row with less than {min_cells} cells: {cell_text(row)}")
+        rows.append([parse(cells[ix]) for ix, parse in parsers])
+    return rows
+
+
+async def check_event_results_loop(workers: WorkerGroup | None = None):
+    ''' updates each active event every refresh_period (only on the leader of `workers`) '''
+    next_run: dict[str, float] = dict()
+    while True:
+        now = time.time()
+        active = [e for e in EVENTS.values() if e.is_active(now)]
+        if len(active) == 0:
+            await asyncio.sleep(IDLE_CHECK_SECONDS)
+            continue
+        if workers is not None and not workers.is_leader:
+            await asyncio.sleep(NOT_LEADER_CHECK_SECONDS)
+            continue
+        if await is_close_to_cotd(60):
+            logging.info("check_event_results_loop sleeping as we are close to COTD")
+            await asyncio.sleep(60)
+            continue
+        for event in active:
+            if next_run.get(event.slug, 0) > now: continue
+            start = time.time()
+            try:
+                with EVENTS_JOB.run():
+                    await run_stage(event.slug, update_event(event))
+            except Exception as e:
+                logging.error(f"Exception updating event {event.slug}: {e}")
+            next_run[event.slug] = start + event.refresh_period
+            logging.info(f"update_event({event.slug}) took {time.time() - start} s")
+        sleep_for = min(next_run.get(e.slug, 0) for e in active) - time.time()
+        await asyncio.sleep(max(1.0, sleep_for))
+
+
+async def update_event(event: EventConfig):
+    async with get_session() as session:
+        await run_stage('results', update_event_page(session, event, event.results_url, event.results_cv_name, 'results', event.results_columns))
+        maps = await run_stage('maps', update_event_page(session, event, event.maps_url, event.maps_cv_name, 'maps', event.maps_columns))
+        sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+        async def update_one(i: int, map_uid: str):
+            async with sem:
+                try:
+                    await update_event_page(session, event, event.map_lb_url_fmt.format(map_uid=map_uid), event.cv_name('map', i), 'lb', event.map_lb_columns)
+                except Exception as e:
+                    logging.error(f"Exception updating {event.slug} map LB {i} ({map_uid}): {e}")
+        with job_stage('map_lbs'):
+            await asyncio.gather(*[update_one(i, map_row[event.map_uid_ix]) for i, map_row in enumerate(maps[:event.nb_maps])])
+    logging.info(f"-- DONE -- Updated {event.slug} data")
+
+
+# CachedValue name -> (sha256 of the page html, rows parsed from it); pages that haven't changed aren't parsed again
+_parsed_pages: dict[str, tuple[str, list[list]]] = dict()
+
+async def update_event_page(session, event: EventConfig, url: str, cv_name: str, key: str, columns: list[Column]) -> list[list]:
+    with job_stage('fetch'):
+        html_doc = await fetch_event_page(session, url)
+    page_hash = hashlib.sha256(html_doc.encode()).hexdigest()
+    last = _parsed_pages.get(cv_name)
+    if last is not None and last[0] == page_hash:
+        return last[1]
+    with job_stage('parse'):
+        # parsing takes a while for big pages; keep it off the event loop
+        rows = await asyncio.to_thread(parse_table, html_doc, columns)
+        job_items(len(rows))
+    with job_stage('write'):
+        await save_event_doc_if_changed(event, cv_name, key, rows)
+    _parsed_pages[cv_name] = (page_hash, rows)
+    return rows
+
+
+async def fetch_event_page(session, url: str) -> str:
+    try:
+        async with session.get(url) as resp:
+            if resp.status == 200:
+                return await resp.text()
+            else:
+                raise Exception(f"Could not get {url}: {resp.status} code.")
+    except asyncio.TimeoutError:
+        raise Exception(f"Timeout getting {url}")
+
+
+def content_hash(content) -> str:
+    return hashlib.sha256(dumps_json(content).encode()).hexdigest()
+
+def saved_content_unchanged(saved_doc: str, key: str, content: list) -> bool:
+    try:
+        return content_hash(json.loads(saved_doc).get(key)) == content_hash(content)
+    except (ValueError, AttributeError):
+        return False
+
+async def save_event_doc_if_changed(event: EventConfig, cv_name: str, key: str, content: list):
+    ''' saves {key: content, ts, min_refresh_period} unless content is the same as what's already saved, so ts is when it last changed '''
+    cv = await CachedValue.objects.filter(name=cv_name).afirst()
+    if cv is None:
+        cv = CachedValue(name=cv_name, value="")
+    elif await asyncio.to_thread(saved_content_unchanged, cv.value, key, content):
+        logging.info(f"Event doc {cv_name} unchanged; not saving")
+        return
+    cv.value = await adumps_json({key: content, 'ts': time.time(), 'min_refresh_period': event.refresh_period})
+    await cv.asave()
+    logging.info(f"Cached event doc {cv_name}; len={len(cv.value)} B / {len(content)} elements")
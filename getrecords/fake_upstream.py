@@ -0,0 +1,395 @@
+import asyncio
+from dataclasses import dataclass
+import datetime
+import math
+import random
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+import jwt
+
+from getrecords.models import model_to_dict_v2
+from getrecords.synthetic import synthetic_map
+from getrecords.tmx_maps import difficulty_to_int, tmx_tags_cached
+from getrecords.utils import model_to_dict
+
+
+# A stand-in for TMX and the nadeo/ubi APIs, for load testing without hitting (or being rate limited by) the real ones.
+# It serves the endpoints the scraper (including the mappack and replay ones the unbeaten ATs tasks use), the COTD job and
+# the views call, with deterministic synthetic data, under one prefix per upstream. Run it with `manage.py run_fake_upstream` and point the *_BASE_URL settings at it:
+#
+#     TMX_BASE_URL=http://127.0.0.1:8090/tmx NADEO_CORE_BASE_URL=http://127.0.0.1:8090/core
+#     NADEO_LIVE_BASE_URL=http://127.0.0.1:8090/live NADEO_MEET_BASE_URL=http://127.0.0.1:8090/meet UBI_BASE_URL=http://127.0.0.1:8090/ubi
+#
+# Maps are synthetic.synthetic_map's (so they match a db filled by gen_synthetic_data): TrackIDs 1..nb_maps to start with,
+# then a new one every new_map_every seconds; a map's UpdatedAt is its upload time. Leaderboards are derived from the map
+# uid. Mappacks start empty and are kept in memory; any secret is accepted. A COTD quali starts every cotd_every seconds, and its players join over the quali.
+# Every request gets latency_ms (+/- latency_jitter_ms), and some get an injected 429 (with Retry-After) or 503.
+# GET /_stats has request counts by route and status.
+
+UPSTREAM_PREFIXES = ['tmx', 'core', 'live', 'meet', 'ubi']
+WORLD_ZONE_ID = "301e1b69-7e13-11e8-8060-e284abfd2bc4"
+FAKE_JWT_KEY = "fake-upstream"
+FAKE_COTD_CHALLENGE_ID_START = 8_000_000
+# nadeo's max page size for leaderboards and challenge records
+MAX_PAGE_LENGTH = 100
+# between consecutive positions on a fake leaderboard
+LB_SCORE_STEP = 13
+
+
+@dataclass
+class FakeUpstreamConfig:
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    # fractions of requests answered with a 503 / a 429
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after_seconds: int = 1
+    nb_maps: int = 250_000
+    new_map_every: float = 30.0
+    cotd_every: int = 8 * 3600
+    # the first quali of the day starts this long after midnight UTC
+    cotd_offset: int = 3600
+    cotd_quali_seconds: int = 900
+    cotd_players: int = 10_000
+    token_lifetime_seconds: int = 3600
+    seed: int = 1
+
+
+class FakeUpstream:
+    def __init__(self, config: FakeUpstreamConfig):
+        self.config = config
+        self.started_at = time.time()
+        self.rng = random.Random(config.seed)
+        # "METHOD route" -> {status: count}
+        self.stats: dict[str, dict[int, int]] = dict()
+        # mappack id -> {TrackID: added ts}
+        self.mappacks: dict[int, dict[int, float]] = dict()
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.inject_faults])
+        app.router.add_get('/_stats', self.get_stats)
+        tmx = web.Application()
+        tmx.router.add_get('/mapsearch2/search', self.tmx_search)
+        tmx.router.add_get('/api/maps', self.tmx_updated_maps)
+        tmx.router.add_get('/api/maps/get_map_info/multi/{ids}', self.tmx_map_info_multi)
+        tmx.router.add_get('/api/tags/gettags', self.tmx_tags)
+        tmx.router.add_get('/maps/download/{tid}', self.map_file)
+        tmx.router.add_get('/api/replays/get_replay_info/{replay_id}', self.tmx_replay_info)
+        tmx.router.add_get('/api/mappack/get_mappack_tracks/{mpid}', self.tmx_mappack_tracks)
+        tmx.router.add_post('/api/mappack/manage/{mpid}/add_map/{tid}', self.tmx_mappack_add)
+        tmx.router.add_delete('/api/mappack/manage/{mpid}/remove_map/{tid}', self.tmx_mappack_remove)
+        tmx.router.add_post('/api/mappack/manage/{mpid}/map_status/{status}/{tid}', self.tmx_mappack_map_status)
+        core = web.Application()
+        core.router.add_post('/v2/authentication/token/{kind}', self.nadeo_token)
+        core.router.add_get('/maps/', self.core_maps_by_uid)
+        core.router.add_get('/maps/{map_id}/file', self.map_file)
+        live = web.Application()
+        live.router.add_get('/api/token/leaderboard/group/Personal_Best/map/{uid}/top', self.live_top)
+        live.router.add_get('/api/token/leaderboard/group/Personal_Best/map/{uid}/surround/{below}/{above}', self.live_surround)
+        live.router.add_get('/api/token/campaign/month', self.live_totd_month)
+        meet = web.Application()
+        meet.router.add_get('/api/cup-of-the-day/current', self.meet_cotd_current)
+        meet.router.add_get('/api/challenges/{id}', self.meet_challenge)
+        meet.router.add_get('/api/challenges/{id}/records/maps/{uid}', self.meet_challenge_records)
+        meet.router.add_get('/api/challenges/{id}/records/maps/{uid}/players', self.meet_challenge_players)
+        ubi = web.Application()
+        ubi.router.add_post('/v3/profiles/sessions', self.ubi_session)
+        for prefix, sub in zip(UPSTREAM_PREFIXES, [tmx, core, live, meet, ubi]):
+            app.add_subapp(f"/{prefix}", sub)
+        return app
+
+    @web.middleware
+    async def inject_faults(self, request: web.Request, handler):
+        if request.path == '/_stats':
+            return await handler(request)
+        c = self.config
+        if c.latency_ms > 0 or c.latency_jitter_ms > 0:
+            await asyncio.sleep(max(0.0, c.latency_ms + self.rng.uniform(-c.latency_jitter_ms, c.latency_jitter_ms)) / 1000)
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource is not None else request.path
+        r = self.rng.random()
+        try:
+            if r < c.rate_limit_rate:
+                resp = web.json_response(dict(error="rate limited (injected)"), status=429, headers={'Retry-After': str(c.retry_after_seconds)})
+            elif r < c.rate_limit_rate + c.error_rate:
+                resp = web.json_response(dict(error="injected error"), status=503)
+            else:
+                resp = await handler(request)
+        except web.HTTPException as e:
+            self.count(request.method, route, e.status)
+            raise
+        self.count(request.method, route, resp.status)
+        return resp
+
+    def count(self, method: str, route: str, status: int):
+        by_status = self.stats.setdefault(f"{method} {route}", dict())
+        by_status[status] = by_status.get(status, 0) + 1
+
+    async def get_stats(self, request: web.Request):
+        return web.json_response(dict(started_at=self.started_at, latest_map_id=self.latest_map_id(), requests=self.stats))
+
+    # --- TMX
+
+    def latest_map_id(self) -> int:
+        return self.config.nb_maps + int((time.time() - self.started_at) / self.config.new_map_every)
+
+    def upload_ts(self, tid: int) -> float:
+        return self.started_at - (self.config.nb_maps - tid) * self.config.new_map_every
+
+    def fake_map(self, tid: int):
+        m = synthetic_map(tid, "fake upstream map", random.Random(tid))
+        m.UploadedAt = m.UpdatedAt = tmx_date(self.upload_ts(tid))
+        return m
+
+    def map_v1(self, tid: int) -> dict:
+        j = model_to_dict(self.fake_map(tid))
+        # tmx doesn't send the fields TmxMap derives
+        for k in ['LengthSecs', 'LengthEnum', 'UploadTimestamp', 'UpdateTimestamp', 'DifficultyInt']:
+            j.pop(k, None)
+        return j
+
+    def map_v2(self, tid: int) -> dict:
+        m = self.fake_map(tid)
+        j = model_to_dict_v2(m)
+        j.update(Difficulty=difficulty_to_int(m.DifficultyName), Environment=m.EnvironmentName, VehicleName=m.VehicleName, MoodFull=m.Mood)
+        return j
+
+    def parse_map_id(self, s: str) -> int | None:
+        ''' a TrackID, or a uid as synthetic_map makes them '''
+        if s.startswith('uid'): s = s[3:]
+        tid = int(s) if s.isdigit() else -1
+        return tid if 1 <= tid <= self.latest_map_id() else None
+
+    async def tmx_search(self, request: web.Request):
+        ''' newest first; enough for get_latest_map_id '''
+        limit = min(100, int(request.query.get('limit', 40)))
+        latest = self.latest_map_id()
+        return web.json_response(dict(results=[self.map_v1(tid) for tid in range(latest, max(0, latest - limit), -1)], totalItemCount=latest))
+
+    async def tmx_updated_maps(self, request: web.Request):
+        ''' api v2, most recently updated first, paged by `after` (a MapId) '''
+        count = min(100, int(request.query.get('count', 40)))
+        start = self.latest_map_id()
+        if 'after' in request.query:
+            start = min(start, int(request.query['after']) - 1)
+        tids = list(range(start, max(0, start - count), -1))
+        return web.json_response(dict(More=len(tids) > 0 and tids[-1] > 1, Results=[self.map_v2(tid) for tid in tids]))
+
+    async def tmx_map_info_multi(self, request: web.Request):
+        tids = [self.parse_map_id(s) for s in request.match_info['ids'].split(',')]
+        return web.json_response([self.map_v1(tid) for tid in dict.fromkeys(tids) if tid is not None])
+
+    async def tmx_tags(self, request: web.Request):
+        return web.json_response(tmx_tags_cached)
+
+    async def tmx_replay_info(self, request: web.Request):
+        ''' every replay id exists; uploaded up to a day before we started '''
+        replay_id = int(request.match_info['replay_id'])
+        return web.json_response(dict(ReplayID=replay_id, UploadedAt=tmx_date(self.started_at - replay_id % 86400)))
+
+    def mappack_and_map(self, request: web.Request) -> tuple[dict[int, float], int]:
+        tid = self.parse_map_id(request.match_info['tid'])
+        if tid is None:
+            raise web.HTTPNotFound()
+        return self.mappacks.setdefault(int(request.match_info['mpid']), dict()), tid
+
+    async def tmx_mappack_tracks(self, request: web.Request):
+        pack = self.mappacks.get(int(request.match_info['mpid']), dict())
+        return web.json_response([dict(self.map_v1(tid), Added=tmx_date(added)) for tid, added in pack.items()])
+
+    async def tmx_mappack_add(self, request: web.Request):
+        pack, tid = self.mappack_and_map(request)
+        if tid in pack:
+            return web.json_response(dict(Message="Map is already in the mappack."))
+        pack[tid] = time.time()
+        return web.json_response(dict(Message="Map successfully added."))
+
+    async def tmx_mappack_remove(self, request: web.Request):
+        pack, tid = self.mappack_and_map(request)
+        if pack.pop(tid, None) is None:
+            return web.json_response(dict(Message="Map is not in the mappack."))
+        return web.json_response(dict(Message="Map successfully removed."))
+
+    async def tmx_mappack_map_status(self, request: web.Request):
+        self.mappack_and_map(request)
+        return web.json_response(dict(Message="Map status successfully changed."))
+
+    async def map_file(self, request: web.Request):
+        if 'tid' in request.match_info and self.parse_map_id(request.match_info['tid']) is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=b"GBX fake map file", content_type='application/octet-stream')
+
+    # --- nadeo core, auth
+
+    async def nadeo_token(self, request: web.Request):
+        if request.match_info['kind'] == 'refresh':
+            refresh_token = request.headers.get('Authorization', '').removeprefix('nadeo_v1 t=')
+            try:
+                audience = jwt.decode(refresh_token, FAKE_JWT_KEY, algorithms=['HS256'], options=dict(verify_aud=False))['aud']
+            except jwt.PyJWTError:
+                raise web.HTTPUnauthorized()
+        else:
+            audience = (await request.json()).get('audience', 'NadeoServices')
+        now = int(time.time())
+        lifetime = self.config.token_lifetime_seconds
+        access = dict(jti=str(uuid.uuid4()), aud=audience, iat=now, exp=now + lifetime, rat=now + lifetime // 2, sub=str(uuid.UUID(int=1)))
+        refresh = dict(access, jti=str(uuid.uuid4()), exp=now + lifetime * 24)
+        return web.json_response(dict(accessToken=jwt.encode(access, FAKE_JWT_KEY, algorithm='HS256'),
+                                      refreshToken=jwt.encode(refresh, FAKE_JWT_KEY, algorithm='HS256')))
+
+    async def ubi_session(self, request: web.Request):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        profile_id = str(uuid.UUID(int=1))
+        return web.json_response(dict(
+            platformType="uplay", ticket=uuid.uuid4().hex, twoFactorAuthenticationTicket=None, profileId=profile_id, userId=profile_id,
+            nameOnPlatform="fake", environment="Prod", expiration=(now + datetime.timedelta(hours=3)).isoformat(), spaceId=str(uuid.UUID(int=2)),
+            clientIp="127.0.0.1", clientIpCountry="AU", serverTime=now.isoformat(), sessionId=str(uuid.uuid4()), sessionKey=uuid.uuid4().hex,
+            rememberMeTicket=None,
+        ))
+
+    async def core_maps_by_uid(self, request: web.Request):
+        uids = [u for u in request.query.get('mapUidList', '').split(',') if u]
+        origin = f"{request.scheme}://{request.host}"
+        infos = []
+        for uid in dict.fromkeys(uids):
+            h = uid_hash(uid)
+            map_id = str(uuid.uuid5(uuid.NAMESPACE_OID, uid))
+            author_score = lb_wr(uid)
+            infos.append(dict(
+                author=str(uuid.UUID(int=h)), submitter=str(uuid.UUID(int=h)), authorScore=author_score, goldScore=author_score * 106 // 100,
+                silverScore=author_score * 12 // 10, bronzeScore=author_score * 15 // 10, collectionName="Stadium", createdWithGamepadEditor=False,
+                createdWithSimpleEditor=False, filename=f"{uid}.Map.Gbx", fileUrl=f"{origin}/core/maps/{map_id}/file", isPlayable=True,
+                mapId=map_id, mapStyle="", mapType="TrackMania\\TM_Race", mapUid=uid, name=f"Map {uid}", timestamp="2023-06-01T12:00:00+00:00",
+                thumbnailUrl=f"{origin}/core/maps/{map_id}/file",
+            ))
+        return web.json_response(infos)
+
+    # --- nadeo live: leaderboards, TOTDs
+
+    async def live_top(self, request: web.Request):
+        uid = request.match_info['uid']
+        length = min(MAX_PAGE_LENGTH, int(request.query.get('length', 5)))
+        offset = int(request.query.get('offset', 0))
+        positions = range(offset + 1, min(lb_nb_players(uid), offset + length) + 1)
+        return web.json_response(lb_response(uid, [lb_entry(uid, p) for p in positions]))
+
+    async def live_surround(self, request: web.Request):
+        ''' the given score slots in after the players at least as fast; `below` players above it and `above` after '''
+        uid = request.match_info['uid']
+        below, above = int(request.match_info['below']), int(request.match_info['above'])
+        score = int(request.query.get('score', 0))
+        n = lb_nb_players(uid)
+        pos = max(0, min(n, (score - lb_wr(uid)) // LB_SCORE_STEP + 1))
+        entries = [lb_entry(uid, p) for p in range(max(1, pos - below + 1), pos + 1)]
+        entries.append(dict(accountId=str(uuid.UUID(int=0)), zoneId=WORLD_ZONE_ID, zoneName="World", position=pos + 1, score=score))
+        entries += [dict(lb_entry(uid, p), position=p + 1) for p in range(pos + 1, min(n, pos + above) + 1)]
+        return web.json_response(lb_response(uid, entries))
+
+    async def live_totd_month(self, request: web.Request):
+        ''' one "day" per COTD, so the current quali always has its TOTD '''
+        k = self.current_cotd_slot()
+        days = []
+        for i in range(k - int(request.query.get('length', 1)), k + 1):
+            start = self.cotd_start(i)
+            d = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+            days.append(dict(campaignId=0, mapUid=self.cotd_map_uid(i), day=d.isoweekday(), monthDay=d.day, seasonUid="",
+                             startTimestamp=start - 60, endTimestamp=start - 60 + self.config.cotd_every, relativeStart=0, relativeEnd=0))
+        d = datetime.datetime.fromtimestamp(self.cotd_start(k), datetime.timezone.utc)
+        return web.json_response(dict(itemCount=1, monthList=[dict(year=d.year, month=d.month, lastDay=d.day, days=days, media=dict())],
+                                      nextRequestTimestamp=self.cotd_start(k + 1), relativeNextRequest=self.cotd_start(k + 1) - int(time.time())))
+
+    # --- nadeo meet: COTD
+
+    def cotd_start(self, k: int) -> int:
+        return k * self.config.cotd_every + self.config.cotd_offset
+
+    def current_cotd_slot(self) -> int:
+        ''' the quali that's running, or the next one '''
+        c = self.config
+        return math.ceil((time.time() - c.cotd_offset - c.cotd_quali_seconds) / c.cotd_every)
+
+    def cotd_challenge_id(self, k: int) -> int:
+        return FAKE_COTD_CHALLENGE_ID_START + k % 1_000_000
+
+    def cotd_map_uid(self, k: int) -> str:
+        return f"cotd{self.cotd_challenge_id(k):023d}"
+
+    def cotd_slot_of(self, challenge_id: int) -> int:
+        offset = challenge_id - FAKE_COTD_CHALLENGE_ID_START
+        k = self.current_cotd_slot()
+        return k - (k - offset) % 1_000_000
+
+    def cotd_challenge(self, k: int) -> dict:
+        start = self.cotd_start(k)
+        cid = self.cotd_challenge_id(k)
+        return dict(id=cid, uid=self.cotd_map_uid(k), name=f"COTD fake #{k}", leaderboardId=cid, startDate=start,
+                    endDate=start + self.config.cotd_quali_seconds, status="HAS_STARTED" if start <= time.time() else "INIT")
+
+    def cotd_nb_players(self, k: int) -> int:
+        ''' players join over the quali '''
+        frac = (time.time() - self.cotd_start(k)) / self.config.cotd_quali_seconds
+        return int(self.config.cotd_players * max(0.0, min(1.0, frac)))
+
+    async def meet_cotd_current(self, request: web.Request):
+        k = self.current_cotd_slot()
+        challenge = self.cotd_challenge(k)
+        return web.json_response(dict(
+            id=k, edition=1 + k % 3, startDate=challenge['startDate'], endDate=challenge['endDate'] + 3600, deletedOn=None, challenge=challenge,
+            competition=dict(id=k, liveId=f"LID-COMP-fake{k}", name=challenge['name'], matchesGenerationDate=challenge['endDate'] + 60),
+        ))
+
+    async def meet_challenge(self, request: web.Request):
+        return web.json_response(self.cotd_challenge(self.cotd_slot_of(int(request.match_info['id']))))
+
+    async def meet_challenge_records(self, request: web.Request):
+        cid = int(request.match_info['id'])
+        length = min(MAX_PAGE_LENGTH, int(request.query.get('length', 10)))
+        offset = int(request.query.get('offset', 0))
+        n = self.cotd_nb_players(self.cotd_slot_of(cid))
+        return web.json_response([cotd_record(cid, rank) for rank in range(offset + 1, min(n, offset + length) + 1)])
+
+    async def meet_challenge_players(self, request: web.Request):
+        cid = int(request.match_info['id'])
+        n = self.cotd_nb_players(self.cotd_slot_of(cid))
+        records = []
+        for player in ','.join(request.query.getall('players[]', [])).split(','):
+            try:
+                rank = uuid.UUID(player).int & 0xFFFFFFFF
+            except ValueError:
+                continue
+            if 1 <= rank <= n:
+                records.append(cotd_record(cid, rank))
+        return web.json_response(dict(uid=request.match_info['uid'], cardinal=n, records=records))
+
+
+
+def uid_hash(uid: str) -> int:
+    return zlib.crc32(uid.encode())
+
+
+def lb_nb_players(uid: str) -> int:
+    return 1 + uid_hash(uid) % 20_000
+
+
+def lb_wr(uid: str) -> int:
+    return 20_000 + uid_hash(uid) % 100_000
+
+
+def lb_entry(uid: str, position: int) -> dict:
+    return dict(accountId=str(uuid.UUID(int=(uid_hash(uid) << 32) | position)), zoneId=WORLD_ZONE_ID, zoneName="World",
+                position=position, score=lb_wr(uid) + (position - 1) * LB_SCORE_STEP)
+
+
+def lb_response(uid: str, entries: list[dict]) -> dict:
+    return dict(groupUid="Personal_Best", mapUid=uid, tops=[dict(zoneId=WORLD_ZONE_ID, zoneName="World", top=entries)])
+
+
+def cotd_record(challenge_id: int, rank: int) -> dict:
+    return dict(player=str(uuid.UUID(int=(challenge_id << 32) | rank)), score=40_000 + rank * 3, rank=rank)
+
+
+def tmx_date(ts: float) -> str:
+    ''' the format tmx_date_to_ts reads (local time, like it) '''
+    return datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%S.%f")[:23]
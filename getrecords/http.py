@@ -1,11 +1,12 @@
 import aiohttp
 
 from getrecords.utils import run_async
+from mapmonitor.metrics import aiohttp_trace_config
 
 def get_session() -> aiohttp.ClientSession:
     return aiohttp.ClientSession(headers={
         'User-Agent': f'app=MapMonitor / contact=@XertroV,mapmonitor@xk.io / supports openplanet plugin'
-    })
+    }, trace_configs=[aiohttp_trace_config()])
 
 def http_head_okay(url):
     return run_async(http_head_okay_async(url))
@@ -0,0 +1,41 @@
+from io import BytesIO
+
+from PIL import Image
+
+from getrecords.blob_cache import BlobCache
+from mapmonitor.settings import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES
+
+
+ICON_SIZE = (64, 64)
+ICON_BGRA_LEN = ICON_SIZE[0] * ICON_SIZE[1] * 4
+
+image_cache = BlobCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+
+def bgra_to_image(bs: bytes) -> Image.Image:
+    ''' decode raw BGRA pixels with PIL's raw decoder (no per-pixel python work) '''
+    return Image.frombytes('RGBA', ICON_SIZE, bs, 'raw', 'BGRA')
+
+
+def webp_to_image(bs: bytes) -> Image.Image:
+    return Image.open(BytesIO(bs), formats=['webp'])
+
+
+def icon_to_png(im: Image.Image) -> bytes:
+    im = im.resize(ICON_SIZE)
+    im = im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    bs = BytesIO()
+    im.save(bs, "png", optimize=True)
+    return bs.getvalue()
+
+
+def frame_bytes(data: bytes) -> bytes:
+    ''' u32 (LE) length prefix followed by the data; the framing used by the e++ endpoints '''
+    return len(data).to_bytes(4, 'little') + data
+
+
+def webp_to_png(bs: bytes) -> bytes:
+    im = webp_to_image(bs)
+    out = BytesIO()
+    im.save(out, "png", optimize=True)
+    return out.getvalue()
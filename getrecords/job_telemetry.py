@@ -0,0 +1,325 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import copy
+import logging
+import os
+import socket
+import time
+
+from django.core.cache import cache
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+# Progress of the background job loops (tmx scraper, unbeaten ATs check, COTD quali cache, event leaderboards).
+# Each job keeps a status doc in redis, so the web processes can serve it at /debug/jobs and /metrics even though the
+# jobs run in another process. A doc has the job's last run, and per stage (e.g. scrape_range, scrape_range.fetch):
+# time, items processed, upstream calls/errors and exceptions in the latest run that reached it, plus totals and last
+# success. A stage used outside of run() counts each top-level use as a run (this is how scheduler.Scheduler runs tasks,
+# several at once). Time is summed over concurrent uses of a stage (e.g. map LBs fetched in parallel), so it can exceed the
+# run's wall time.
+#
+#     with SCRAPER_JOB.run():
+#         with job_stage('scrape_range'):
+#             with job_stage('fetch'): ...     # -> stage 'scrape_range.fetch'
+#             job_items(len(maps))
+#
+# job_stage / job_items / job_queue_depth apply to whichever job the calling task is in, and do nothing outside one.
+#
+# A job can run in several processes (see bg_workers.WorkerGroup), so each process writes its own doc, and readers merge
+# them (merge_job_docs): totals are summed, and the latest run / stage details are from whichever process ran it last.
+# Docs of processes that stopped expire after JOB_DOC_TTL.
+#
+# monitor_loop_lag(job) runs alongside a job's loop and records in its doc how late the event loop wakes up; anything
+# blocking the loop (e.g. encoding a big doc, parsing HTML) for longer than LOOP_LAG_WARN_SECONDS is logged.
+
+JOB_NAMES = ['tmx_scraper', 'tmx_unbeaten', 'cotd_quali', 'events']
+JOB_KEY_FMT = "job-telemetry:{name}:{process}"
+# the processes that have written a doc for the job
+JOB_PROCESSES_KEY_FMT = "job-telemetry-processes:{name}"
+JOB_DOC_TTL = 7 * 86400
+# stage doc fields that count since the process started, so are summed over processes
+STAGE_TOTAL_KEYS = ['seconds_total', 'items_total', 'upstream_errors_total', 'errors_total']
+# while a top-level stage is running, its progress is written at most this often
+FLUSH_INTERVAL_SECONDS = 2.0
+LOOP_LAG_CHECK_SECONDS = 0.5
+LOOP_LAG_WARN_SECONDS = 0.25
+
+# (job, stage path, run number) of the calling task
+_current: ContextVar[tuple['JobTelemetry', str, int] | None] = ContextVar('mm_job_stage', default=None)
+
+
+def new_stage_doc() -> dict:
+    return dict(run_no=None, seconds=0.0, calls=0, items=0, upstream_calls=0, upstream_errors=0, errors=0, last_ok=None, last_error=None,
+                last_started_at=None, last_success_at=None,
+                seconds_total=0.0, items_total=0, upstream_errors_total=0, errors_total=0)
+
+
+class JobTelemetry:
+    def __init__(self, name: str):
+        if name not in JOB_NAMES:
+            raise ValueError(f"unknown job {name}; add it to JOB_NAMES")
+        self.name = name
+        self.process = f"{socket.gethostname()}-{os.getpid()}"
+        self.doc = dict(name=name, process=self.process, pid=os.getpid(), started_at=time.time(), updated_at=None,
+                        run=None, last_success_at=None, runs_total=0, failures_total=0, stages=dict(), queues=dict())
+        self._last_flush = 0.0
+        self._run_no = 0
+        self._writing = False
+        self._flush_again = False
+
+    @contextmanager
+    def run(self):
+        ''' one iteration of the job's loop '''
+        self._run_no += 1
+        run = self.doc['run'] = dict(started_at=time.time(), seconds=None, ok=None, error=None)
+        token = _current.set((self, '', self._run_no))
+        start = time.perf_counter()
+        try:
+            yield
+            run['ok'] = True
+            self.doc['last_success_at'] = time.time()
+        except BaseException as e:
+            run.update(ok=False, error=str(e)[:500])
+            self.doc['failures_total'] += 1
+            raise
+        finally:
+            _current.reset(token)
+            run['seconds'] = time.perf_counter() - start
+            self.doc['runs_total'] += 1
+            self.flush()
+
+    @contextmanager
+    def stage(self, name: str):
+        ''' nested stages are named parent.child; time in a child counts towards its parent too '''
+        cur = _current.get()
+        in_job = cur is not None and cur[0] is self
+        parent = cur[1] if in_job else ''
+        if in_job:
+            run_no = cur[2]
+        else:
+            self._run_no += 1
+            run_no = self._run_no
+        path = f"{parent}.{name}" if parent else name
+        s = self.doc['stages'].setdefault(path, new_stage_doc())
+        if s['run_no'] != run_no:
+            s.update(run_no=run_no, seconds=0.0, calls=0, items=0, upstream_calls=0, upstream_errors=0, errors=0)
+        s['calls'] += 1
+        s['last_started_at'] = time.time()
+        token = _current.set((self, path, run_no))
+        start = time.perf_counter()
+        try:
+            yield s
+            s['last_ok'] = True
+            s['last_success_at'] = time.time()
+            if not in_job:
+                self.doc['last_success_at'] = s['last_success_at']
+        except BaseException as e:
+            s.update(last_ok=False, last_error=str(e)[:500], errors=s['errors'] + 1, errors_total=s['errors_total'] + 1)
+            if not in_job:
+                self.doc['failures_total'] += 1
+            raise
+        finally:
+            _current.reset(token)
+            duration = time.perf_counter() - start
+            s['seconds'] += duration
+            s['seconds_total'] += duration
+            if not in_job:
+                self.doc['runs_total'] += 1
+            if not parent or time.time() - self._last_flush > FLUSH_INTERVAL_SECONDS:
+                self.flush()
+
+    def flush(self):
+        ''' on an event loop, the write happens on a thread (one at a time; a flush during it writes again after) '''
+        self.doc['updated_at'] = self._last_flush = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write(self.doc)
+            return
+        if self._writing:
+            self._flush_again = True
+            return
+        self._writing = True
+        # a copy, as the loop keeps changing the doc while it's written
+        loop.run_in_executor(None, self.write, copy.deepcopy(self.doc)).add_done_callback(self._written)
+
+    def _written(self, _fut):
+        self._writing = False
+        if self._flush_again:
+            self._flush_again = False
+            self.flush()
+
+    def write(self, doc: dict):
+        try:
+            cache.set(JOB_KEY_FMT.format(name=self.name, process=self.process), doc, JOB_DOC_TTL)
+            processes_key = JOB_PROCESSES_KEY_FMT.format(name=self.name)
+            processes = cache.get(processes_key) or []
+            if self.process not in processes:
+                # racy (no CAS), but a process that gets dropped re-adds itself next flush; expired docs are dropped here
+                alive = cache.get_many([JOB_KEY_FMT.format(name=self.name, process=p) for p in processes])
+                processes = [p for p in processes if JOB_KEY_FMT.format(name=self.name, process=p) in alive]
+                cache.set(processes_key, processes + [self.process], None)
+        except Exception as e:
+            logging.warning(f"job telemetry flush failed for {self.name}: {e}")
+
+
+async def monitor_loop_lag(job: JobTelemetry):
+    ''' max_seconds is the worst lag since the process started '''
+    lag = job.doc['loop_lag'] = dict(last_seconds=0.0, max_seconds=0.0, blocked_total=0, last_blocked_at=None, last_blocked_seconds=None)
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_CHECK_SECONDS)
+        late = time.perf_counter() - start - LOOP_LAG_CHECK_SECONDS
+        lag.update(last_seconds=late, max_seconds=max(lag['max_seconds'], late))
+        if late > LOOP_LAG_WARN_SECONDS:
+            lag.update(blocked_total=lag['blocked_total'] + 1, last_blocked_at=time.time(), last_blocked_seconds=late)
+            logging.warning(f"{job.name}: event loop was blocked for {late:.3f} s")
+
+
+_jobs: dict[str, JobTelemetry] = dict()
+
+def get_job(name: str) -> JobTelemetry:
+    if name not in _jobs:
+        _jobs[name] = JobTelemetry(name)
+    return _jobs[name]
+
+
+@contextmanager
+def job_stage(name: str):
+    cur = _current.get()
+    if cur is None:
+        yield None
+        return
+    with cur[0].stage(name) as s:
+        yield s
+
+
+async def run_stage(name: str, coro):
+    with job_stage(name):
+        return await coro
+
+
+def current_stage() -> dict | None:
+    cur = _current.get()
+    if cur is None or not cur[1]: return None
+    return cur[0].doc['stages'][cur[1]]
+
+
+def job_items(n: int):
+    s = current_stage()
+    if s is not None:
+        s['items'] += n
+        s['items_total'] += n
+
+
+def job_queue_depth(queue: str, depth: int):
+    cur = _current.get()
+    if cur is not None:
+        cur[0].doc['queues'][queue] = depth
+
+
+def note_upstream(ok: bool):
+    ''' called for every upstream request (see mapmonitor.metrics.record_upstream) '''
+    s = current_stage()
+    if s is not None:
+        s['upstream_calls'] += 1
+        if not ok:
+            s['upstream_errors'] += 1
+            s['upstream_errors_total'] += 1
+
+
+def get_job_docs() -> dict[str, dict]:
+    ''' each job's docs, merged over its processes (jobs that never ran are missing) '''
+    try:
+        processes = cache.get_many([JOB_PROCESSES_KEY_FMT.format(name=name) for name in JOB_NAMES])
+        docs = cache.get_many([JOB_KEY_FMT.format(name=name, process=p) for name in JOB_NAMES
+                               for p in processes.get(JOB_PROCESSES_KEY_FMT.format(name=name), [])])
+    except Exception as e:
+        logging.warning(f"job telemetry get failed: {e}")
+        return dict()
+    by_job: dict[str, list[dict]] = dict()
+    for doc in docs.values():
+        by_job.setdefault(doc['name'], []).append(doc)
+    return {name: merge_job_docs(job_docs) for name, job_docs in by_job.items()}
+
+
+def merge_job_docs(docs: list[dict]) -> dict:
+    ''' one doc from the docs of a job's processes; each process's own doc (minus stages) is under `processes` '''
+    docs = sorted(docs, key=lambda d: d['updated_at'] or 0)
+    runs = [d['run'] for d in docs if d['run'] is not None]
+    successes = [d['last_success_at'] for d in docs if d['last_success_at'] is not None]
+    merged = dict(name=docs[-1]['name'], updated_at=docs[-1]['updated_at'], run=max(runs, key=lambda r: r['started_at'], default=None),
+                  last_success_at=max(successes, default=None), runs_total=sum(d['runs_total'] for d in docs),
+                  failures_total=sum(d['failures_total'] for d in docs), stages=dict(), queues=dict(),
+                  processes={d['process']: {k: v for k, v in d.items() if k not in ('name', 'stages')} for d in docs})
+    # oldest first, so the most recently updated process's queue depths win
+    for d in docs:
+        merged['queues'].update(d['queues'])
+        for path, s in d['stages'].items():
+            m = merged['stages'].get(path)
+            if m is None:
+                merged['stages'][path] = dict(s)
+                continue
+            totals = {k: m[k] + s[k] for k in STAGE_TOTAL_KEYS}
+            last_success = max([t for t in [m['last_success_at'], s['last_success_at']] if t is not None], default=None)
+            if (s['last_started_at'] or 0) >= (m['last_started_at'] or 0):
+                m.update(s)
+            m.update(totals, last_success_at=last_success)
+    lags = [d['loop_lag'] for d in docs if 'loop_lag' in d]
+    if len(lags) > 0:
+        merged['loop_lag'] = dict(lags[-1], max_seconds=max(lag['max_seconds'] for lag in lags), blocked_total=sum(lag['blocked_total'] for lag in lags))
+    return merged
+
+
+def get_jobs_status() -> dict:
+    now = time.time()
+    jobs = get_job_docs()
+    for doc in jobs.values():
+        doc['seconds_since_success'] = None if doc['last_success_at'] is None else now - doc['last_success_at']
+        doc['seconds_since_update'] = now - doc['updated_at']
+    return dict(now=now, jobs=jobs)
+
+
+class JobTelemetryCollector:
+    ''' exports the job docs (read from redis at scrape time) as prometheus metrics '''
+    def describe(self):
+        # without this, registering the collector would call collect() (and so redis)
+        return self.families()
+
+    def families(self):
+        last_success = GaugeMetricFamily('mm_job_last_success_timestamp_seconds', 'When the job last completed a run', labels=['job'])
+        run_seconds = GaugeMetricFamily('mm_job_run_duration_seconds', 'Duration of the job\'s last run', labels=['job'])
+        runs = CounterMetricFamily('mm_job_runs', 'Job runs (since the job process started)', labels=['job'])
+        failures = CounterMetricFamily('mm_job_failures', 'Job runs that raised', labels=['job'])
+        stage_seconds = GaugeMetricFamily('mm_job_stage_seconds', 'Time in the stage during the latest run', labels=['job', 'stage'])
+        stage_items = GaugeMetricFamily('mm_job_stage_items', 'Items processed by the stage during the latest run', labels=['job', 'stage'])
+        stage_last_success = GaugeMetricFamily('mm_job_stage_last_success_timestamp_seconds', 'When the stage last completed', labels=['job', 'stage'])
+        stage_upstream_errors = CounterMetricFamily('mm_job_stage_upstream_errors', 'Failed upstream requests made by the stage', labels=['job', 'stage'])
+        stage_errors = CounterMetricFamily('mm_job_stage_errors', 'Exceptions raised by the stage', labels=['job', 'stage'])
+        queue_depth = GaugeMetricFamily('mm_job_queue_depth', 'Items waiting to be processed', labels=['job', 'queue'])
+        loop_lag_max = GaugeMetricFamily('mm_job_loop_lag_max_seconds', 'Longest the job process\'s event loop has been blocked', labels=['job'])
+        loop_blocked = CounterMetricFamily('mm_job_loop_blocked', 'Times the job process\'s event loop was blocked for longer than the warning threshold', labels=['job'])
+        return [last_success, run_seconds, runs, failures, stage_seconds, stage_items, stage_last_success, stage_upstream_errors, stage_errors, queue_depth,
+                loop_lag_max, loop_blocked]
+
+    def collect(self):
+        (last_success, run_seconds, runs, failures, stage_seconds, stage_items, stage_last_success, stage_upstream_errors,
+         stage_errors, queue_depth, loop_lag_max, loop_blocked) = families = self.families()
+        for name, doc in get_job_docs().items():
+            if doc['last_success_at'] is not None: last_success.add_metric([name], doc['last_success_at'])
+            if doc['run'] is not None and doc['run']['seconds'] is not None: run_seconds.add_metric([name], doc['run']['seconds'])
+            runs.add_metric([name], doc['runs_total'])
+            failures.add_metric([name], doc['failures_total'])
+            for stage, s in doc['stages'].items():
+                stage_seconds.add_metric([name, stage], s['seconds'])
+                stage_items.add_metric([name, stage], s['items'])
+                if s['last_success_at'] is not None: stage_last_success.add_metric([name, stage], s['last_success_at'])
+                stage_upstream_errors.add_metric([name, stage], s['upstream_errors_total'])
+                stage_errors.add_metric([name, stage], s['errors_total'])
+            for queue, depth in doc['queues'].items():
+                queue_depth.add_metric([name, queue], depth)
+            if 'loop_lag' in doc:
+                loop_lag_max.add_metric([name], doc['loop_lag']['max_seconds'])
+                loop_blocked.add_metric([name], doc['loop_lag']['blocked_total'])
+        return families
@@ -1,178 +1,66 @@
-import asyncio
-import json
-import logging
-import sys
-import time
-from bs4 import BeautifulSoup, Tag
-import bs4
+import lxml.html
+from lxml.html import HtmlElement
 
-from getrecords.http import get_session
-from getrecords.models import CachedValue
-from getrecords.view_logic import KR5_MAP_CV_NAME_FMT, KR5_MAPS_CV_NAME, KR5_RESULTS_CV_NAME, is_close_to_cotd
 
+# HTML table -> values for the event scrapers (see events.py). The kacky sites format names with styled <span>s,
+# which are converted to openplanet format codes.
 
 
-async def check_kacky_results_loop():
-    sleep_len = 310
-    while True:
-        start = time.time()
-        if await is_close_to_cotd(60):
-            logging.info(f"update_kacky_reloaded_5 sleeping as we are close to COTD")
-            await asyncio.sleep(60)
-            continue
-        try:
-            await update_kacky_reloaded_5()
-        except Exception as e:
-            logging.error(f"Exception update_kacky_reloaded_5: {e}")
-        sleep_for = sleep_len - (time.time() - start)
-        logging.info(f"update_kacky_reloaded_5 took {time.time() - start} s, sleeping for {sleep_for} s")
-        await asyncio.sleep(sleep_for)
+def html_rows(html_doc: str) -> list[HtmlElement]:
+    ''' lxml builds the tree in C; going through bs4 spent most of the time building python objects for every tag '''
+    return list(lxml.html.document_fromstring(html_doc).iter('tr'))
 
 
-async def update_kacky_reloaded_5():
-    await update_kr5_results()
-    maps = await update_kr5_maps()
-    # todo: loop through maps to get full LB so we can give ranking data
-    for i, map_data in enumerate(maps):
-        map_uid = map_data[2]
-        await update_kr5_map_lb(i, map_uid)
-    logging.info(f"-- DONE -- Updated KR5 data")
+def row_cells(row: HtmlElement) -> list[HtmlElement]:
+    return list(row.iter('td'))
 
 
-async def update_kr5_map_lb(i: int, map_uid: str):
-    html_doc = await get_kr5_map_lb_html(map_uid)
-    soup = BeautifulSoup(html_doc, 'html.parser')
-    rows = soup.find_all('tr')
-    lb_doc = []
-    for row in rows:
-        cells = row.find_all('td')
-        if len(cells) < 4:
-            raise Exception(f"unexpected row with less than 4 cells: {row}")
-            continue
-        rank = int(cells[0].text)
-        nickname = cells[1].text.replace('\xa0', ' ')
-        name_formatted = bs4_to_openplanet(cells[1])
-        time = cells[2].text
-        finishes = int(cells[3].text)
-        lb_doc.append([rank, nickname, name_formatted, time, finishes])
-    await save_kr5_map_lb(i, lb_doc)
-    return lb_doc
+def cell_text(cell: HtmlElement) -> str:
+    return node_text(cell).replace('\xa0', ' ')
 
 
-async def save_kr5_map_lb(i: int, lb_doc: list[list[str | int | float]]):
-    logging.info(f"Saving KR5 map LB {i} ({len(lb_doc)} records)")
-    cv = await CachedValue.objects.filter(name=KR5_MAP_CV_NAME_FMT.format(i)).afirst()
-    if cv is None:
-        cv = CachedValue(name=KR5_MAP_CV_NAME_FMT.format(i), value="")
-    cv.value = json.dumps(dict(lb=lb_doc, ts=time.time(), min_refresh_period=310))
-    await cv.asave()
-    logging.info(f"Cached kr5 map LB {i}; len={len(cv.value)} B / {len(lb_doc)} elements")
+def node_text(el: HtmlElement) -> str:
+    return ''.join(bs4_whitespace(t) for t in el.itertext())
 
 
-async def update_kr5_results():
-    html_doc = await get_kr5_html()
-    soup = BeautifulSoup(html_doc, 'html.parser')
-    rows = soup.find_all('tr')
-    results_doc = []
-    for (i, row) in enumerate(rows):
-        # if i > 100: break
-        cells = row.find_all('td')
-        if len(cells) < 3:
-            raise Exception(f"unexpected row with less than 3 cells: {row}")
-            continue
-        rank = int(cells[0].text)
-        nickname = cells[1].text.replace('\xa0', ' ')
-        name_formatted = bs4_to_openplanet(cells[1])
-        finishes = int(cells[2].text)
-        avgs = float(cells[3].text)
-        avgs_finished = float(cells[4].text)
+def bs4_whitespace(text: str | None) -> str:
+    ''' bs4 (which this used to use) collapses whitespace-only strings to one char; keep that so saved docs don't change '''
+    if not text: return ""
+    if text.strip(' \n\t\f\r') != "": return text
+    return '\n' if '\n' in text else ' '
 
-        results_doc.append([rank, nickname, name_formatted, finishes, avgs, avgs_finished])
 
-        # print(f"{rank} {nickname} ({name_formatted}) {finishes} {avgs} {avgs_finished}")
-    await save_kr5_results(results_doc)
-    return results_doc
+def cell_link_uid(cell: HtmlElement) -> str:
+    return next(cell.iter('a')).get('href').split('uid=')[-1]
 
 
-async def save_kr5_results(results: list[list[str | int | float]]):
-    logging.info(f"Saving KR5 results ({len(results)} results)")
-    cv = await CachedValue.objects.filter(name=KR5_RESULTS_CV_NAME).afirst()
-    if cv is None:
-        cv = CachedValue(name=KR5_RESULTS_CV_NAME, value="")
-    cv.value = json.dumps(dict(results=results, ts=time.time(), min_refresh_period=310))
-    await cv.asave()
-    logging.info(f"Cached kr5 results; len={len(cv.value)} B / {len(results)} elements")
-
-
-async def update_kr5_maps():
-    html_doc = await get_kr5_maps_html()
-    soup = BeautifulSoup(html_doc, 'html.parser')
-    rows = soup.find_all('tr')
-    maps_doc = []
-    for row in rows:
-        cells = row.find_all('td')
-        if len(cells) < 6:
-            raise Exception(f"unexpected row with less than 6 cells: {row}")
-            continue
-        map_name = cells[0].text.replace('\xa0', ' ')
-        map_uid = cells[0].find_next('a')['href'].split('uid=')[-1]
-        map_name_formatted = bs4_to_openplanet(cells[0])
-        author_name = cells[1].text.replace('\xa0', ' ')
-        author_name_formatted = bs4_to_openplanet(cells[1])
-        record_time = cells[2].text.replace('\xa0', ' ')
-        record_holder = cells[3].text.replace('\xa0', ' ')
-        record_holder_formatted = bs4_to_openplanet(cells[3])
-        finishes = int(cells[4].text)
-        karma = float(cells[5].text)
-        maps_doc.append([map_name, map_name_formatted, map_uid, author_name, author_name_formatted, record_time, record_holder, record_holder_formatted, finishes, karma])
-    await save_kr5_maps(maps_doc)
-    return maps_doc
-
-
-async def save_kr5_maps(maps_doc: list[list[str | int | float]]):
-    logging.info(f"Saving KR5 maps ({len(maps_doc)} maps)")
-    cv = await CachedValue.objects.filter(name=KR5_MAPS_CV_NAME).afirst()
-    if cv is None:
-        cv = CachedValue(name=KR5_MAPS_CV_NAME, value="")
-    cv.value = json.dumps(dict(maps=maps_doc, ts=time.time(), min_refresh_period=310))
-    await cv.asave()
-    logging.info(f"Cached kr5 maps; len={len(cv.value)} B / {len(maps_doc)} elements")
-
-
-
-def bs4_to_openplanet(cell: Tag) -> str:
-    link: Tag = cell.find('a')
+def cell_to_openplanet(cell: HtmlElement) -> str:
+    link = next(cell.iter('a'), None)
     if link is None:
         # raise Exception(f"unexpected cell without link: {cell}")
-        return cell.text.replace('\xa0', ' ')
-    op_fmt = ""
-    if link.children is None:
-        raise Exception(f"unexpected link without children: {link}")
-        return cell.text.replace('\xa0', ' ')
-    for span in link.children:
-        if isinstance(span, Tag):
-            if span.name == 'span':
-                op_fmt += styled_span_to_op_text(span)
-            else:
-                raise Exception(f"unexpected tag in link: {span}")
-        elif isinstance(span, bs4.element.NavigableString):
-            op_fmt += span
+        return cell_text(cell)
+    # lxml keeps text between children as the previous child's tail
+    op_fmt = bs4_whitespace(link.text)
+    for span in link:
+        if span.tag == 'span':
+            op_fmt += styled_span_to_op_text(span)
         else:
-            raise Exception(f"unexpected non-tag in link: {type(span)} {span}")
+            raise Exception(f"unexpected tag in link: {lxml.html.tostring(span)}")
+        op_fmt += bs4_whitespace(span.tail)
     return op_fmt.replace('\xa0', ' ')
 
 
-def styled_span_to_op_text(span: Tag) -> str:
-    if span.has_attr('style'):
-        style = span['style']
+def styled_span_to_op_text(span: HtmlElement) -> str:
+    style = span.get('style')
+    if style is not None:
         color = get_style_prop(style, 'color', '#ffffff')
         font_style = get_style_prop(style, 'font-style', '')
         font_weight = get_style_prop(style, 'font-weight', '')
         check_for_unrecognized_style_props(style)
         fmt_tags = fmt_color(color) + fmt_font_style(font_style) + fmt_font_weight(font_weight)
-        return f"$<{fmt_tags}{span.text}$>"
+        return f"$<{fmt_tags}{node_text(span)}$>"
     else:
-        return span.text
+        return node_text(span)
 
 
 def fmt_color(color: str) -> str:
@@ -207,46 +95,6 @@ def check_for_unrecognized_style_props(style: str):
         if prop not in ['color', 'font-style', 'font-weight', 'letter-spacing', 'font-size']:
             raise Exception(f"unrecognized style prop: {prop}")
 
-async def get_kr5_html():
-    # return TEST_HTML
-    async with get_session() as session:
-        try:
-            async with session.get(f"https://kackyreloaded.com/event/editions/ranking.php?edition=5&raw=1") as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    raise Exception(f"Could not get KR5 ranking data: {resp.status} code.")
-        except asyncio.TimeoutError as e:
-            raise Exception(f"KR5 timeout for getting ranking data")
-
-
-async def get_kr5_maps_html():
-    # return TEST_MAPS_HTML
-    async with get_session() as session:
-        try:
-            async with session.get(f"https://kackyreloaded.com/event/editions/records.php?edition=5&raw=1") as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    raise Exception(f"Could not get KR5 maps data: {resp.status} code.")
-        except asyncio.TimeoutError as e:
-            raise Exception(f"KR5 timeout for getting maps data")
-
-
-async def get_kr5_map_lb_html(map_uid: str):
-    # return TEST_MAP_301_HTML
-    async with get_session() as session:
-        try:
-            async with session.get(f"https://kackyreloaded.com/event/editions/maps.php?uid={map_uid}&raw=1") as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                else:
-                    raise Exception(f"Could not get KR5 map LB data: {resp.status} code.")
-        except asyncio.TimeoutError as e:
-            raise Exception(f"KR5 timeout for getting map LB data")
-
-
-
 
 
 TEST_MAP_301_HTML = """
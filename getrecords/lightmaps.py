@@ -0,0 +1,85 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import logging
+import threading
+import zipfile
+
+from PIL import Image
+
+from getrecords.images import frame_bytes
+from mapmonitor.settings import LM_CONVERSION_WORKERS, LM_PNG_COMPRESS_LEVEL
+
+
+_pool: Executor | None = None
+_pool_lock = threading.Lock()
+
+
+def get_lm_pool() -> Executor | None:
+    ''' one pool per server process, created on first use (so it isn't inherited by forked workers) '''
+    global _pool
+    if LM_CONVERSION_WORKERS <= 0: return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=LM_CONVERSION_WORKERS)
+            logging.info(f"Started lightmap conversion pool with {LM_CONVERSION_WORKERS} workers")
+        return _pool
+
+
+def reset_lm_pool():
+    ''' drop a broken pool (e.g. a worker was OOM killed); the next request starts a new one '''
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def is_lm_file(name: str) -> bool:
+    return name == "ProbeGrid.webp" or (name.startswith("LightMap") and name.endswith(".webp"))
+
+
+def parse_compress_level(raw: str | None) -> int:
+    if raw is None or raw == '': return LM_PNG_COMPRESS_LEVEL
+    return max(0, min(9, int(raw)))
+
+
+def lm_webp_to_png(data: bytes, compress_level: int = LM_PNG_COMPRESS_LEVEL) -> bytes:
+    ''' runs in the pool workers, so it only takes/returns bytes '''
+    im = Image.open(BytesIO(data), formats=['webp'])
+    im = im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    bs = BytesIO()
+    im.save(bs, "png", compress_level=compress_level)
+    return bs.getvalue()
+
+
+def frame_lm_png(name: str, png: bytes) -> bytes:
+    ''' u32 name length + name + u32 data length + data '''
+    return frame_bytes(name.encode()) + frame_bytes(png)
+
+
+def read_lm_files(zip_bytes: bytes) -> list[tuple[str, bytes]]:
+    ''' [(png name, webp bytes)] for each lightmap in the zip; raises zipfile.BadZipFile '''
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as zf:
+        return [(name[:-5] + ".png", zf.read(name)) for name in zf.namelist() if is_lm_file(name)]
+
+
+def convert_lightmaps(files: list[tuple[str, bytes]], compress_level: int, pool: Executor | None = None) -> bytes:
+    ''' one framed png per lightmap, in zip order. Everything is converted before anything is returned, so a failed
+        conversion is an exception (-> 500) rather than a truncated response. '''
+    if pool is None:
+        pngs = [lm_webp_to_png(data, compress_level) for _, data in files]
+    else:
+        futures = [pool.submit(lm_webp_to_png, data, compress_level) for _, data in files]
+        try:
+            pngs = [fut.result() for fut in futures]
+        except BrokenProcessPool:
+            reset_lm_pool()
+            raise
+        finally:
+            # a conversion failed: don't leave the rest queued
+            for fut in futures:
+                fut.cancel()
+    for (new_name, _), png in zip(files, pngs):
+        logging.info(f"{new_name}: {len(png)}")
+    return b''.join(frame_lm_png(new_name, png) for (new_name, _), png in zip(files, pngs))
@@ -0,0 +1,50 @@
+import os
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from getrecords.images import ICON_BGRA_LEN, ICON_SIZE, bgra_to_image, icon_to_png
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark BGRA -> PNG icon conversion (legacy per-pixel python vs PIL raw BGRA decoder)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=500)
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        icons = [os.urandom(ICON_BGRA_LEN) for _ in range(16)]
+        if legacy_bgra_to_image(icons[0]).tobytes() != bgra_to_image(icons[0]).tobytes():
+            raise Exception("legacy and new conversions differ!")
+        for name, f in [('legacy', legacy_bgra_to_image), ('raw_bgra', bgra_to_image)]:
+            decode = bench(lambda i: f(icons[i % len(icons)]), n)
+            full = bench(lambda i: icon_to_png(f(icons[i % len(icons)])), max(1, n // 10))
+            self.stdout.write(f"{name:>9}: decode {decode['us_per_icon']:9.1f} us/icon (peak python allocations {decode['alloc_peak_bytes']:>8} B)"
+                              f" | decode+png {full['us_per_icon']:9.1f} us/icon")
+
+
+def legacy_bgra_to_image(bs: bytes) -> Image.Image:
+    ''' the implementation convert_rgba_to_png used before the raw decoder, kept for comparison '''
+    img_bytes = b''.join(bytes((r,g,b,a)) for (b,g,r,a) in chunks([b for b in bs], 4))
+    return Image.frombytes('RGBA', ICON_SIZE, img_bytes)
+
+
+def chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+
+def bench(f, n: int) -> dict:
+    start = time.perf_counter()
+    for i in range(n):
+        f(i)
+    duration = time.perf_counter() - start
+    # allocations are measured on a separate (single) run so tracing doesn't skew the timings
+    tracemalloc.start()
+    f(0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(us_per_icon=duration / n * 1e6, alloc_peak_bytes=peak)
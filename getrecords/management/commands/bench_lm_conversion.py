@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import time
+import zipfile
+
+from django.core.management.base import BaseCommand
+import numpy as np
+from PIL import Image
+
+from getrecords.lightmaps import convert_lightmaps, read_lm_files
+
+
+class Command(BaseCommand):
+    help = "Benchmark lightmap webp -> png conversion (serial vs process pool, per compress level) on a synthetic lightmap zip"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nb-lightmaps", type=int, default=8)
+        parser.add_argument("--size", type=int, default=1024, help="lightmap width/height in px")
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--levels", type=str, default="1,6,9", help="comma separated png compress levels")
+
+    def handle(self, *args, **options):
+        zip_bytes = synthetic_lm_zip(options['nb_lightmaps'], options['size'])
+        files = read_lm_files(zip_bytes)
+        self.stdout.write(f"synthetic zip: {len(files)} lightmaps, {len(zip_bytes) / 1024**2:.2f} MB")
+        levels = [int(l) for l in options['levels'].split(',')]
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            # warm up the workers so process start-up isn't counted
+            convert_lightmaps(files[:1], 1, pool)
+            for level in levels:
+                for name, p in [('serial', None), (f"pool({options['workers']})", pool)]:
+                    start = time.perf_counter()
+                    total = len(convert_lightmaps(files, level, p))
+                    duration = time.perf_counter() - start
+                    self.stdout.write(f"level {level} {name:>8}: total {duration * 1000:8.1f} ms, output {total / 1024**2:6.2f} MB")
+
+
+def synthetic_lm_zip(nb_lightmaps: int, size: int) -> bytes:
+    ''' smooth gradients plus some noise, roughly like baked lighting; plus a ProbeGrid and a file that should be skipped '''
+    rng = np.random.default_rng(1234)
+    yy, xx = np.mgrid[0:size, 0:size]
+    out = BytesIO()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for i in range(nb_lightmaps):
+            base = (np.sin(xx / (20 + i)) + np.cos(yy / (30 + i)) + 2) * 60
+            px = np.stack([base, base * 0.8, base * 0.6, np.full_like(base, 255)], axis=-1)
+            px += rng.normal(0, 6, px.shape)
+            zf.writestr(f"LightMap{i}.webp", to_webp(np.clip(px, 0, 255).astype(np.uint8)))
+        zf.writestr("ProbeGrid.webp", to_webp(rng.integers(0, 255, (64, 256, 4), dtype=np.uint8)))
+        zf.writestr("Readme.txt", b"not a lightmap")
+    return out.getvalue()
+
+
+def to_webp(px: np.ndarray) -> bytes:
+    bs = BytesIO()
+    Image.fromarray(px, 'RGBA').save(bs, 'webp', quality=90)
+    return bs.getvalue()
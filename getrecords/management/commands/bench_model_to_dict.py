@@ -0,0 +1,68 @@
+import time
+
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.http import JsonResponse
+from django.test import RequestFactory
+
+from getrecords.models import TmxMap
+from getrecords.synthetic import create_synthetic_maps
+from getrecords.utils import model_to_dict
+import getrecords.views as views
+
+
+class Command(BaseCommand):
+    help = "Benchmark get_map_info/multi (50 maps): legacy serializer-based model_to_dict vs the precompiled one vs the values() path the view uses"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nb-maps", type=int, default=50)
+        parser.add_argument("--iterations", type=int, default=50)
+
+    def handle(self, *args, **options):
+        nb_maps = options['nb_maps']
+        with transaction.atomic():
+            # synthetic maps (if the db doesn't have enough) are rolled back afterwards
+            track_ids = list(TmxMap.objects.order_by('TrackID').values_list('TrackID', flat=True)[:nb_maps])
+            if len(track_ids) < nb_maps:
+                track_ids += create_synthetic_maps(nb_maps - len(track_ids))
+            mapids = ','.join(map(str, track_ids))
+            request = RequestFactory().get(f"/maps/get_map_info/multi/{mapids}")
+            results = dict()
+            for name, f in [('legacy', lambda: multi_with_model_to_dict(track_ids, legacy_model_to_dict)),
+                            ('compiled', lambda: multi_with_model_to_dict(track_ids, model_to_dict)),
+                            ('values', lambda: views.tmx_maps_get_map_info_multi(request, mapids))]:
+                results[name] = bench_multi(f, options['iterations'])
+            transaction.set_rollback(True)
+        for name, r in results.items():
+            if r['body'] != results['legacy']['body']:
+                raise Exception(f"legacy and {name} responses differ!")
+        for name, r in results.items():
+            self.stdout.write(f"{name:>9}: {r['ms_per_request']:8.2f} ms/request ({nb_maps} maps, {len(r['body'])} B)"
+                              f" | {results['legacy']['ms_per_request'] / r['ms_per_request']:.1f}x")
+        self.stdout.write("responses identical")
+
+
+def legacy_model_to_dict(m):
+    ''' what model_to_dict did before the precompiled accessors, kept for comparison '''
+    return serializers.serialize('python', [m])[0]['fields']
+
+
+def multi_with_model_to_dict(track_ids: list[int], to_dict) -> JsonResponse:
+    ''' get_map_info/multi as it was before it used TmxMap.objects.api_dicts() '''
+    resp = []
+    done = set()
+    for track in TmxMap.objects.filter(TrackID__in=track_ids):
+        if track.TrackID in done: continue
+        done.add(track.TrackID)
+        resp.append(to_dict(track))
+    return JsonResponse(resp, safe=False)
+
+
+def bench_multi(f, n: int) -> dict:
+    body = f().content
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    duration = time.perf_counter() - start
+    return dict(ms_per_request=duration / n * 1000, body=body)
@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import QuerySet
+
+from getrecords.models import TmxMap
+from getrecords.synthetic import create_synthetic_maps
+
+
+class Command(BaseCommand):
+    help = "Benchmark hot TmxMap reads: full rows vs the TmxMapQuerySet projections (rows/sec and bytes per row)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nb-maps", type=int, default=2000)
+        parser.add_argument("--comments-len", type=int, default=1500, help="length of Comments for synthetic maps")
+        parser.add_argument("--iterations", type=int, default=5)
+
+    def handle(self, *args, **options):
+        nb_maps = options['nb_maps']
+        with transaction.atomic():
+            # synthetic maps (if the db doesn't have enough) are rolled back afterwards
+            have = TmxMap.objects.count()
+            if have < nb_maps:
+                create_synthetic_maps(nb_maps - have, comments="x" * options['comments_len'])
+            base = TmxMap.objects.order_by('TrackID')[:nb_maps]
+            cases = [
+                ('rand_mapsearch', base, base.for_search()),
+                ('tmx_next_map', base, base.for_next_map()),
+                ('get_map_info/multi', base, base.api_dicts()),
+            ]
+            for name, before, after in cases:
+                b, a = bench_query(before, options['iterations']), bench_query(after, options['iterations'])
+                self.stdout.write(f"{name:>18}: before {b['rows_per_sec']:9.0f} rows/s {b['bytes_per_row']:6.0f} B/row"
+                                  f" | after {a['rows_per_sec']:9.0f} rows/s {a['bytes_per_row']:6.0f} B/row"
+                                  f" | {a['rows_per_sec'] / b['rows_per_sec']:.1f}x rows/s, {a['bytes_per_row'] / max(1, b['bytes_per_row']):.0%} bytes")
+            transaction.set_rollback(True)
+
+
+def bench_query(qs: QuerySet, n: int) -> dict:
+    nb_rows = len(list(qs._chain()))
+    start = time.perf_counter()
+    for _ in range(n):
+        list(qs._chain())
+    duration = time.perf_counter() - start
+    return dict(rows_per_sec=nb_rows * n / duration, bytes_per_row=result_bytes(qs) / max(1, nb_rows))
+
+
+def result_bytes(qs: QuerySet) -> int:
+    ''' approximate bytes the db sends for the query's rows: the size of each column value '''
+    sql, params = qs.query.sql_with_params()
+    total = 0
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for row in cursor.fetchall():
+            for v in row:
+                if v is None: total += 1
+                elif isinstance(v, (str, bytes)): total += len(v.encode() if isinstance(v, str) else v)
+                else: total += 8
+    return total
@@ -8,9 +8,11 @@ from typing import Coroutine
 
 from django.core.management.base import BaseCommand, CommandError
 
+from getrecords.bg_workers import singleton_lease
 from getrecords.http import get_session
+from getrecords.job_telemetry import get_job, job_items, job_stage, monitor_loop_lag
 from getrecords.models import CachedValue, CotdChallenge, CotdChallengeRanking, MapTotalPlayers, TmxMap, TmxMapAT, TmxMapScrapeState
-from getrecords.nadeoapi import LOCAL_DEV_MODE, get_and_save_all_challenge_records, get_challenge, get_challenge_players, get_challenge_records, get_cotd_current, get_map_records, get_totd_maps, run_nadeo_services_auth
+from getrecords.nadeoapi import LOCAL_DEV_MODE, get_and_save_all_challenge_records, get_challenge, get_challenge_players, get_challenge_records, get_cotd_current, get_map_records, get_totd_maps, run_nadeo_services_auth, use_background_retry_policy
 from getrecords.view_logic import CURRENT_COTD_KEY, RECENTLY_BEATEN_ATS_CV_NAME, TRACK_UIDS_CV_NAME, UNBEATEN_ATS_CV_NAME, get_recently_beaten_ats_query, get_tmx_map, get_tmx_map_pack_maps, get_unbeaten_ats_query, refresh_nb_players_inner, update_tmx_map
 
 class Command(BaseCommand):
@@ -31,7 +33,12 @@ class Command(BaseCommand):
                 time.sleep(60)
 
 
+COTD_JOB = get_job('cotd_quali')
+
+
 def run_cotd_quali_cache(loop: asyncio.AbstractEventLoop):
+    use_background_retry_policy()
+    loop.create_task(monitor_loop_lag(COTD_JOB))
     loop.create_task(cotd_quali_cache_main())
 
 class OldCOTDInfoEx(Exception):
@@ -46,10 +53,11 @@ async def cotd_quali_cache_main():
         old_cotd_sleep = 3.14 * 60
         try:
             logging.info(f"Getting next COTD info.")
-            next_cotd = await get_cotd_current()
-            while next_cotd is None:
-                await asyncio.sleep(3.14)
+            with COTD_JOB.stage('next_cotd'):
                 next_cotd = await get_cotd_current()
+                while next_cotd is None:
+                    await asyncio.sleep(3.14)
+                    next_cotd = await get_cotd_current()
             # set to 1 minute after the hour
             start_date = next_cotd['challenge']['startDate']
             end_date = next_cotd['challenge']['endDate']
@@ -77,7 +85,8 @@ async def cotd_quali_cache_main():
             i = 0
             while not (totd_start_date < start_date < totd_end_date):
                 if i > 0: await asyncio.sleep(10)
-                totd_info = await get_totd_maps(2)
+                with COTD_JOB.stage('totd'):
+                    totd_info = await get_totd_maps(2)
                 totd_map = get_most_recent_totd_from_totd_maps_resp(totd_info)
                 totd_start_date = totd_map['startTimestamp']
                 totd_end_date = totd_map['endTimestamp']
@@ -88,8 +97,14 @@ async def cotd_quali_cache_main():
 
             # cotd has started!
             logging.info(f"Got current TOTD: {json.dumps(totd_map)}; COTD has started...")
-            await run_cache_during_cotd_quali(challenge_id, totd_uid, start_date, end_date)
-            logging.info(f"COTD has ended")
+            # if more than one cotd_quali_cache process runs, only one caches the quali; the others try again after
+            # sleeping below, so one takes over if the lease holder dies mid-quali
+            async with singleton_lease('cotd_quali') as got_lease:
+                if got_lease:
+                    await run_cache_during_cotd_quali(challenge_id, totd_uid, start_date, end_date)
+                    logging.info(f"COTD has ended")
+                else:
+                    logging.info(f"Another process is caching this COTD quali")
 
         except OldCOTDInfoEx as e:
             logging.warn(f"Got old cotd. Sleeping {old_cotd_sleep / 60 + 3.14} minutes.")
@@ -131,7 +146,9 @@ async def run_cache_during_cotd_quali(cid, uid, start_date, end_date):
         logging.info(f"COTD results cache runner starting at {loop_start}, running for another {end_date - loop_start} seconds")
 
         # loop and get all records for current size and save
-        await get_and_save_all_challenge_records(challenge)
+        with COTD_JOB.run(), job_stage('quali_records'):
+            rankings = await get_and_save_all_challenge_records(challenge)
+            job_items(len(rankings))
 
         # report and sleep
         loop_end = time.time()
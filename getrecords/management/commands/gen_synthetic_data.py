@@ -0,0 +1,44 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from getrecords.nadeoapi import LOCAL_DEV_MODE
+from getrecords.synthetic import create_synthetic_cotd, create_synthetic_map_ats, create_synthetic_maps, create_synthetic_nb_players, create_synthetic_track_events, get_or_create_synthetic_mapalitics_token, set_scraped_up_to_latest_map
+
+
+class Command(BaseCommand):
+    help = "Fill the db with realistic volumes of synthetic maps, ATs, COTD rankings and mapalitics events (for run_benchmarks)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--maps", type=int, default=250_000)
+        parser.add_argument("--beaten-frac", type=float, default=0.6, help="fraction of the maps' ATs that are beaten")
+        parser.add_argument("--cotd-challenges", type=int, default=3)
+        parser.add_argument("--cotd-players", type=int, default=10_000)
+        parser.add_argument("--cotd-snapshots", type=int, default=10, help="ranking snapshots per COTD quali")
+        parser.add_argument("--track-events", type=int, default=2_000_000)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--yes", action="store_true", help="required when not in DEBUG mode")
+
+    def handle(self, *args, **options):
+        if not LOCAL_DEV_MODE and not options['yes']:
+            raise CommandError(f"Not in DEBUG mode; this adds a lot of rows to {connection.settings_dict['NAME']}. Pass --yes if you mean it.")
+        rng = random.Random(options['seed'])
+
+        track_ids = self.step(f"{options['maps']} maps", lambda: create_synthetic_maps(options['maps'], rng=rng))
+        self.step("scrape state", set_scraped_up_to_latest_map)
+        self.step("map ATs", lambda: create_synthetic_map_ats(track_ids, rng, options['beaten_frac']))
+        self.step("map nb players", lambda: create_synthetic_nb_players(track_ids, rng))
+        self.step(f"{options['cotd_challenges']} COTDs x {options['cotd_snapshots']} snapshots x {options['cotd_players']} players",
+                  lambda: create_synthetic_cotd(options['cotd_challenges'], options['cotd_players'], options['cotd_snapshots'], rng))
+        if len(track_ids) > 0:
+            self.step(f"{options['track_events']} track events", lambda: create_synthetic_track_events(options['track_events'], track_ids, rng))
+        self.step("mapalitics token", get_or_create_synthetic_mapalitics_token)
+
+    def step(self, name: str, f):
+        start = time.perf_counter()
+        with transaction.atomic():
+            ret = f()
+        self.stdout.write(f"{name}: done in {time.perf_counter() - start:.1f} s")
+        return ret
@@ -0,0 +1,45 @@
+import asyncio
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from getrecords.models import MapTotalPlayers
+from getrecords.nadeoapi import run_nadeo_services_auth, use_background_retry_policy
+from getrecords.surround_cache import SURROUND_CACHE_TTL, get_stats, prefetch_top
+from getrecords.utils import run_async
+
+
+class Command(BaseCommand):
+    help = "Prefetch top-N leaderboards of popular maps into the surround cache (optionally in a loop)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--maps", type=int, default=50, help="number of maps, most recently active first")
+        parser.add_argument("--top", type=int, default=300, help="records to prefetch per map")
+        parser.add_argument("--uid", type=str, action="append", default=[], help="prefetch these maps too (repeatable)")
+        parser.add_argument("--loop", action="store_true", help=f"repeat before the cached windows expire ({SURROUND_CACHE_TTL}s)")
+
+    def handle(self, *args, **options):
+        run_async(self.run(options))
+
+    async def run(self, options):
+        use_background_retry_policy()
+        asyncio.create_task(run_nadeo_services_auth())
+        while True:
+            start = time.time()
+            uids = options['uid'] + await popular_map_uids(options['maps'])
+            total = 0
+            for uid in dict.fromkeys(uids):
+                try:
+                    total += await prefetch_top(uid, options['top'])
+                except Exception as e:
+                    logging.warning(f"prefetch_surround: {uid} failed: {e}")
+            logging.info(f"prefetch_surround: {total} records for {len(uids)} maps in {time.time() - start:.1f}s; stats: {get_stats()}")
+            if not options['loop']: return
+            await asyncio.sleep(max(10, SURROUND_CACHE_TTL * 0.8 - (time.time() - start)))
+
+
+async def popular_map_uids(nb_maps: int) -> list[str]:
+    ''' maps the plugin has recently asked about (nb_players refreshes) '''
+    if nb_maps <= 0: return []
+    return [uid async for uid in MapTotalPlayers.objects.order_by('-updated_ts').values_list('uid', flat=True)[:nb_maps]]
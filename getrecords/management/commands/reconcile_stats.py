@@ -0,0 +1,74 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+
+from getrecords.models import Ghost, TrackStats, UserStats, UserTrackPlay
+
+
+STAT_FIELDS = ['total_runs', 'segmented_runs', 'partial_runs', 'total_time']
+
+
+class Command(BaseCommand):
+    help = "Recompute TrackStats / UserStats from Ghost / UserTrackPlay and report (or fix) any mismatches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="overwrite mismatched stats rows with the recomputed values")
+
+    def handle(self, *args, **options):
+        fix = options['fix']
+        nb_track = reconcile(TrackStats, 'track_id', 'unique_users', fix)
+        nb_user = reconcile(UserStats, 'user_id', 'unique_maps', fix)
+        logging.info(f"reconcile_stats: {nb_track} TrackStats and {nb_user} UserStats mismatches{' fixed' if fix else ''}")
+        self.stdout.write(f"TrackStats mismatches: {nb_track}, UserStats mismatches: {nb_user}{' (fixed)' if fix else ''}")
+
+
+def recompute_stats(group_by: str, unique_field: str) -> dict[int, dict]:
+    ''' group_by is 'track_id' or 'user_id'; returns {id: {field: value}} for every id with at least one ghost '''
+    other = 'user_id' if group_by == 'track_id' else 'track_id'
+    expected = dict()
+    runs = Ghost.objects.values(group_by).annotate(
+        total_runs=Count('id', filter=Q(segmented=False)),
+        segmented_runs=Count('id', filter=Q(segmented=True)),
+        partial_runs=Count('id', filter=Q(partial=True)),
+        total_time=Coalesce(Sum('duration', filter=Q(segmented=False)), 0),
+    )
+    for row in runs:
+        expected[row[group_by]] = {f: row[f] for f in STAT_FIELDS}
+        expected[row[group_by]][unique_field] = 0
+    uniques = UserTrackPlay.objects.values(group_by).annotate(nb=Count(other, distinct=True))
+    for row in uniques:
+        expected.setdefault(row[group_by], {f: 0 for f in STAT_FIELDS})[unique_field] = row['nb']
+    return expected
+
+
+def reconcile(stats_model, group_by: str, unique_field: str, fix: bool) -> int:
+    expected = recompute_stats(group_by, unique_field)
+    fields = STAT_FIELDS + [unique_field]
+    seen = set()
+    mismatches = 0
+    for stats in stats_model.objects.order_by('id'):
+        parent_id = getattr(stats, group_by)
+        if parent_id in seen:
+            # increment_stats used to be able to create a second row for the same parent
+            logging.warning(f"Duplicate {stats_model.__name__} row {stats.pk} for {group_by}={parent_id}")
+            mismatches += 1
+            if fix: stats.delete()
+            continue
+        seen.add(parent_id)
+        exp = expected.get(parent_id, {f: 0 for f in fields})
+        diff = {f: (getattr(stats, f), exp[f]) for f in fields if getattr(stats, f) != exp[f]}
+        if len(diff) == 0: continue
+        mismatches += 1
+        logging.warning(f"{stats_model.__name__} {group_by}={parent_id} mismatch (stored, expected): {diff}")
+        if fix:
+            with transaction.atomic():
+                stats_model.objects.filter(pk=stats.pk).update(**exp)
+    for parent_id in expected.keys() - seen:
+        mismatches += 1
+        logging.warning(f"Missing {stats_model.__name__} for {group_by}={parent_id}")
+        if fix:
+            stats_model.objects.create(**{group_by: parent_id}, **expected[parent_id])
+    return mismatches
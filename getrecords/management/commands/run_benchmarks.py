@@ -0,0 +1,198 @@
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+import io
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+from typing import Callable
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from getrecords.management.commands.tmx_scraper import cache_map_uids, cache_recently_beaten_ats, cache_unbeaten_ats, update_beaten_ats_leaderboard
+from getrecords.models import CotdChallenge, CotdChallengeRanking, MapTotalPlayers, TmxMap, TmxMapAT
+from getrecords.synthetic import get_or_create_synthetic_mapalitics_token
+from getrecords.utils import run_async
+from mapalitics.models import TrackEvent
+from mapmonitor.metrics import UPSTREAM_REQUESTS
+
+
+# Times the hot endpoints and the cache-building jobs against whatever is in the db (see gen_synthetic_data), and writes
+# the results as JSON so runs can be compared (--compare). The jobs run for real (via run_async, so on other connections)
+# and overwrite their CachedValues; the mapalitics events posted are deleted afterwards.
+# By default the django cache is a DummyCache, so cache_page'd views and the TmxMap cache do their full work every time.
+
+COUNTED_MODELS = [TmxMap, TmxMapAT, MapTotalPlayers, CotdChallenge, CotdChallengeRanking, TrackEvent]
+
+
+@dataclass
+class BenchCase:
+    name: str
+    # one iteration; gets the case's rng, returns a response (or None)
+    run: Callable[[random.Random], object]
+    iterations: int
+    cleanup: Callable[[], object] | None = None
+
+
+class Command(BaseCommand):
+    help = "Benchmark hot endpoints and cache-building jobs; results as JSON for regression comparison"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=30, help="per endpoint")
+        parser.add_argument("--job-iterations", type=int, default=3, help="per cache-building job")
+        parser.add_argument("--only", type=str, default="", help="comma separated substrings of case names to run")
+        parser.add_argument("--output", type=str, default="", help="write the JSON results here")
+        parser.add_argument("--compare", type=str, default="", help="a previous --output to compare against")
+        parser.add_argument("--threshold", type=float, default=1.25, help="p50 ratio vs --compare that counts as a regression")
+        parser.add_argument("--with-cache", action="store_true", help="use the configured django cache instead of a DummyCache")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        caches = None if options['with_cache'] else {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        with override_settings(**(dict(CACHES=caches) if caches else dict())):
+            meta = dict(ts=time.time(), git_commit=git_commit(), db_vendor=connection.vendor, python=platform.python_version(),
+                        django=django.get_version(), row_counts={m.__name__: m.objects.count() for m in COUNTED_MODELS},
+                        options={k: options[k] for k in ['iterations', 'job_iterations', 'with_cache', 'seed']})
+            cases = build_cases(options['iterations'], options['job_iterations'])
+            only = [s for s in options['only'].split(',') if s]
+            results = dict()
+            for case in cases:
+                if only and not any(s in case.name for s in only): continue
+                results[case.name] = bench_case(case, random.Random(options['seed']))
+                self.stdout.write(fmt_result(case.name, results[case.name]))
+        doc = dict(meta=meta, results=results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(doc, f, indent=2)
+            self.stdout.write(f"wrote {options['output']}")
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            regressions = compare(baseline['results'], results, options['threshold'], self.stdout.write)
+            if len(regressions) > 0:
+                raise CommandError(f"p50 regressed by more than {options['threshold']}x: {', '.join(regressions)}")
+
+
+def build_cases(iterations: int, job_iterations: int) -> list[BenchCase]:
+    client = Client()
+    race_ids = list(TmxMap.objects.filter(MapType__contains="TM_Race").order_by('TrackID').values_list('TrackID', flat=True))
+    cases = [
+        BenchCase('rand_mapsearch', lambda rng: client.get("/mapsearch2/search", dict(api='on', random='1')), iterations),
+        BenchCase('rand_mapsearch_tags', lambda rng: client.get("/mapsearch2/search", dict(
+            api='on', random='1', tags=rng.randint(1, 44), etags=rng.randint(1, 44), lengthop='1', length=rng.randint(1, 8))), iterations),
+        BenchCase('rand_api_maps', lambda rng: client.get("/api/maps", dict(random='1', count='1')), iterations),
+    ]
+    if len(race_ids) > 0:
+        cases += [
+            BenchCase('tmx_next_map', lambda rng: client.get(f"/tmx/{rng.choice(race_ids)}/next"), iterations),
+            BenchCase('tmx_next_map_tags', lambda rng: client.get(f"/tmx/{rng.choice(race_ids)}/next", dict(tags=rng.randint(1, 44))), iterations),
+            BenchCase('get_map_info_multi', lambda rng: client.get(f"/api/maps/get_map_info/multi/{','.join(map(str, rng.sample(race_ids, min(50, len(race_ids)))))}"), iterations),
+        ]
+    challenge = CotdChallenge.objects.order_by('-challenge_id').first()
+    if challenge is not None:
+        cotd_path = f"/api/challenges/{challenge.challenge_id}/records/maps/{challenge.uid}"
+        players = list(CotdChallengeRanking.objects.filter(challenge=challenge).values_list('player', flat=True).distinct()[:1000])
+        nb = max(1, CotdChallengeRanking.objects.filter(challenge=challenge).values('rank').distinct().count())
+        cases += [
+            BenchCase('cotd_records_page', lambda rng: client.get(cotd_path, dict(length=100, offset=rng.randrange(0, nb, 100))), iterations),
+            BenchCase('cotd_cached_records_page', lambda rng: client.get(f"/cached{cotd_path}", dict(length=100, offset=rng.randrange(0, nb, 100))), iterations),
+            BenchCase('cotd_cached_cutoffs', lambda rng: client.get(f"/cached{cotd_path}", dict(cutoffs='1')), iterations),
+            BenchCase('cotd_cached_players', lambda rng: client.get(f"/cached{cotd_path}/players", {'players[]': ','.join(rng.sample(players, min(5, len(players))))}), iterations),
+        ]
+    # the jobs build what the next endpoints serve
+    cases += [
+        BenchCase('job_cache_unbeaten_ats', lambda rng: run_async(cache_unbeaten_ats()), job_iterations),
+        BenchCase('job_cache_recently_beaten_ats', lambda rng: run_async(cache_recently_beaten_ats()), job_iterations),
+        BenchCase('job_update_beaten_ats_leaderboard', lambda rng: run_async(update_beaten_ats_leaderboard()), job_iterations),
+        BenchCase('job_cache_map_uids', lambda rng: run_async(cache_map_uids()), job_iterations),
+        BenchCase('unbeaten_ats', lambda rng: client.get("/tmx/unbeaten_ats"), iterations),
+        BenchCase('recently_beaten_ats', lambda rng: client.get("/tmx/recently_beaten_ats"), iterations),
+        BenchCase('unbeaten_ats_leaderboard', lambda rng: client.get("/tmx/unbeaten_ats/leaderboard"), iterations),
+    ]
+    map_uids = list(TrackEvent.objects.values_list('map_uid', flat=True).distinct()[:100])
+    if len(map_uids) > 0:
+        token = get_or_create_synthetic_mapalitics_token()
+        max_event_id = TrackEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        def post_event(rng: random.Random):
+            ty = rng.choice(['Checkpoint', 'Checkpoint', 'Respawn', 'Restart', 'Finish'])
+            event = dict(Type=ty, MapUid=rng.choice(map_uids), WSID=token.user.wsid, DisplayName=token.user.display_name,
+                         RaceTime=rng.randint(1000, 60_000), CpCount=rng.randint(0, 20), Position=[1.0, 2.0, 3.0], Velocity=[0.0, 0.0, 1.0], ZonePath='World')
+            return client.post("/mapalitics/event", json.dumps(event), content_type='application/json', HTTP_AUTHORIZATION=f"mapalitics {token.token}")
+        cases.append(BenchCase('post_mapalitics_event', post_event, iterations,
+                               cleanup=lambda: TrackEvent.objects.filter(id__gt=max_event_id).delete()))
+    return cases
+
+
+def bench_case(case: BenchCase, rng: random.Random) -> dict:
+    try:
+        # some views print; keep that out of our output
+        with redirect_stdout(io.StringIO()):
+            # warm up, and count queries once (on this thread's connection; jobs' queries aren't counted).
+            # not CaptureQueriesContext: request_started resets connection.queries
+            queries = []
+            def count_query(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+            with connection.execute_wrapper(count_query):
+                resp = case.run(rng)
+            upstream_before = upstream_calls_total()
+            times, statuses, sizes = [], dict(), []
+            for _ in range(case.iterations):
+                start = time.perf_counter()
+                resp = case.run(rng)
+                times.append((time.perf_counter() - start) * 1000)
+                if resp is not None:
+                    statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+                    sizes.append(len(resp.content))
+    except Exception as e:
+        return dict(error=f"{type(e).__name__}: {e}")
+    finally:
+        if case.cleanup is not None:
+            case.cleanup()
+    times.sort()
+    return dict(
+        iterations=case.iterations, mean_ms=statistics.fmean(times), p50_ms=percentile(times, 50), p95_ms=percentile(times, 95),
+        min_ms=times[0], max_ms=times[-1], db_queries=len(queries), upstream_calls=upstream_calls_total() - upstream_before,
+        statuses=statuses, mean_bytes=statistics.fmean(sizes) if len(sizes) > 0 else None,
+    )
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    ix = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[ix]
+
+
+def upstream_calls_total() -> float:
+    return sum(s.value for m in UPSTREAM_REQUESTS.collect() for s in m.samples if s.name.endswith('_total'))
+
+
+def fmt_result(name: str, r: dict) -> str:
+    if 'error' in r:
+        return f"{name:>34}: ERROR {r['error']}"
+    return (f"{name:>34}: p50 {r['p50_ms']:9.2f} ms  p95 {r['p95_ms']:9.2f} ms  mean {r['mean_ms']:9.2f} ms"
+            f"  {r['db_queries']:3d} queries  {r['upstream_calls']:.0f} upstream  statuses {r['statuses']}")
+
+
+def compare(baseline: dict, results: dict, threshold: float, write) -> list[str]:
+    ''' names of cases whose p50 got worse than threshold x the baseline '''
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None or 'error' in b or 'error' in r: continue
+        ratio = r['p50_ms'] / max(1e-6, b['p50_ms'])
+        flag = "REGRESSION" if ratio > threshold else ""
+        write(f"{name:>34}: p50 {b['p50_ms']:9.2f} -> {r['p50_ms']:9.2f} ms ({ratio:.2f}x)  queries {b['db_queries']} -> {r['db_queries']}  {flag}")
+        if ratio > threshold: regressions.append(name)
+    return regressions
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
@@ -0,0 +1,27 @@
+from dataclasses import fields
+
+from aiohttp import web
+from django.core.management.base import BaseCommand
+
+from getrecords.fake_upstream import UPSTREAM_PREFIXES, FakeUpstream, FakeUpstreamConfig
+
+
+SETTING_FOR_PREFIX = dict(tmx='TMX_BASE_URL', core='NADEO_CORE_BASE_URL', live='NADEO_LIVE_BASE_URL', meet='NADEO_MEET_BASE_URL', ubi='UBI_BASE_URL')
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the TMX and nadeo APIs (see getrecords/fake_upstream.py), with injectable latency, errors and 429s"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", type=str, default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8090)
+        # one option per FakeUpstreamConfig field, e.g. --latency-ms 80 --error-rate 0.01 --rate-limit-rate 0.02 --cotd-every 1200
+        for f in fields(FakeUpstreamConfig):
+            parser.add_argument(f"--{f.name.replace('_', '-')}", type=type(f.default), default=f.default)
+
+    def handle(self, *args, **options):
+        config = FakeUpstreamConfig(**{f.name: options[f.name] for f in fields(FakeUpstreamConfig)})
+        base = f"http://{options['host']}:{options['port']}"
+        self.stdout.write(f"{config}\nPoint the app at it with:")
+        self.stdout.write(' '.join(f"{SETTING_FOR_PREFIX[prefix]}={base}/{prefix}" for prefix in UPSTREAM_PREFIXES))
+        web.run_app(FakeUpstream(config).make_app(), host=options['host'], port=options['port'], print=self.stdout.write)
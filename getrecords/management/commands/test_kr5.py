@@ -7,10 +7,13 @@ from typing import Coroutine
 
 from django.core.management.base import BaseCommand, CommandError
 
-from getrecords.kacky import update_kacky_reloaded_5
+from getrecords.events import EVENTS, update_event
 
 class Command(BaseCommand):
-    help = "test kr5 stuff"
+    help = "test kr5 stuff (or another event's scraper)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--event", default="kr5", choices=sorted(EVENTS.keys()))
 
     def _run_async(self, coro: Coroutine):
         loop = asyncio.new_event_loop()
@@ -20,7 +23,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         logging.info(f"test kr5")
-        self._run_async(test_kr5())
+        self._run_async(test_kr5(options['event']))
 
-async def test_kr5():
-    await update_kacky_reloaded_5()
+async def test_kr5(slug: str = 'kr5'):
+    await update_event(EVENTS[slug])
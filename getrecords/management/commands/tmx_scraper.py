@@ -9,14 +9,19 @@ from random import shuffle
 
 from django.core.management.base import BaseCommand, CommandError
 
+from getrecords.bg_workers import WorkerGroup
 from getrecords.http import get_session
-from getrecords.kacky import check_kacky_results_loop
+from getrecords.events import check_event_results_loop
+from getrecords.job_telemetry import get_job, job_items, job_queue_depth, job_stage, monitor_loop_lag, run_stage
 from getrecords.models import CachedValue, MapTotalPlayers, TmxMap, TmxMapAT, TmxMapScrapeState, TmxMapPackTrackUpdateLog, tmx_v2_track_to_v1
-from getrecords.nadeoapi import LOCAL_DEV_MODE, TMX_MAPPACK_UNBEATEN_ATS_APIKEY, TMX_MAPPACK_UNBEATEN_ATS_S3_APIKEY, get_map_records, run_nadeo_services_auth
+from getrecords.nadeoapi import LOCAL_DEV_MODE, TMX_MAPPACK_UNBEATEN_ATS_APIKEY, TMX_MAPPACK_UNBEATEN_ATS_S3_APIKEY, get_map_records, run_nadeo_services_auth, use_background_retry_policy
+from getrecords.scheduler import ScheduledTask, Scheduler
+from getrecords.tmx_map_cache import aget_tmx_map_record
 from getrecords.tmx_maps import tmx_date_to_ts, update_tmx_tags_cached
 from getrecords.unbeaten_ats import TMX_MAPPACKID_UNBEATABLE_ATS, TMXIDS_UNBEATABLE_ATS
-from getrecords.utils import chunk, model_to_dict
-from getrecords.view_logic import CURRENT_COTD_KEY, RECENTLY_BEATEN_ATS_CV_NAME, TRACK_UIDS_CV_NAME, UNBEATEN_ATS_CV_NAME, UNBEATEN_ATS_LEADERBOARD_CV_NAME, add_map_to_tmx_map_pack, get_recently_beaten_ats_query, get_tmx_map, get_tmx_map_pack_maps, get_unbeaten_ats_query, is_close_to_cotd, refresh_nb_players_inner, remove_map_from_tmx_map_pack, set_map_status_in_map_pack, update_tmx_map
+from getrecords.utils import adumps_json, chunk, model_to_dict
+from getrecords.view_logic import CURRENT_COTD_KEY, RECENTLY_BEATEN_ATS_CV_NAME, TRACK_UIDS_CV_NAME, UNBEATEN_ATS_CV_NAME, UNBEATEN_ATS_LEADERBOARD_CV_NAME, add_map_to_tmx_map_pack, get_recently_beaten_ats_query, get_tmx_map, get_tmx_map_pack_maps, get_unbeaten_ats_query, is_close_to_cotd, refresh_nb_players_inner, remove_map_from_tmx_map_pack, save_tmx_fallback_maps, set_map_status_in_map_pack, update_tmx_map
+from mapmonitor.settings import TMX_BASE_URL
 
 
 # AT_CHECK_BATCH_SIZE = 360
@@ -39,6 +44,9 @@ def get_unbeaten_ats_id_key_for(tmx_id: int) -> tuple[int, str]:
 
 RUN_UPDATE_UNBEATEN_MAP_PACK_S2 = not LOCAL_DEV_MODE
 
+SCRAPER_JOB = get_job('tmx_scraper')
+UNBEATEN_JOB = get_job('tmx_unbeaten')
+
 
 class Command(BaseCommand):
     help = "Run the tmx scraper"
@@ -58,12 +66,15 @@ def run_all_tmx_scrapers(loop: asyncio.AbstractEventLoop):
     print(f"Starting TMX Scraper")
     state = get_scrape_state()
     update_state = get_update_scrape_state()
-    loop.create_task(check_tmx_unbeaten_loop())
+    # any number of tmx_scraper processes can run; they split the AT checks and the leader runs everything else
+    workers = WorkerGroup('tmx_scraper', job=SCRAPER_JOB)
+    use_background_retry_policy()
     loop.create_task(run_nadeo_services_auth())
-    loop.create_task(run_tmx_scraper(state, update_state))
-    # end of december 2024
-    if time.time() < 1735597980:
-        loop.create_task(check_kacky_results_loop())
+    loop.create_task(monitor_loop_lag(SCRAPER_JOB))
+    loop.create_task(workers.run_forever())
+    loop.create_task(build_scraper_schedule(state, update_state, workers).run_forever())
+    # idles until an event in events.EVENTS is active
+    loop.create_task(check_event_results_loop(workers))
 
 
 
@@ -78,63 +89,43 @@ def get_update_scrape_state():
     # june 24th
     return get_scrape_state("updated_tracks", 1687567560)
 
-first_run = True
-
-async def run_tmx_scraper(state: TmxMapScrapeState, update_state: TmxMapScrapeState):
-    global first_run
-    # temp fix for maps being marked as removed from tmx
-    # await fix_tmx_records()
-    # await asyncio.sleep(5.0)
-
-    loop_seconds = 300
-    while True:
-        # testing DB issue (integer out of range)
-        # if LOCAL_DEV_MODE:
-        #     while True:
-        #         await scrape_unbeaten_ats()
-
-
-        start = time.time()
-        if await is_close_to_cotd():
-            logging.info(f"tmx scraper sleeping as we are close to COTD")
-            await asyncio.sleep(60)
-            continue
-        try:
-            # to any fixes first (should be batched)
-            await fix_at_beaten_first_nb()
-            if first_run:
-                first_run = False
-                # logging.info(f"First run: cache_recently_beaten_ats")
-                # await update_unbeaten_ats_map_pack_s2()
-            if LOCAL_DEV_MODE:
-                await update_beaten_ats_leaderboard()
-                # logging.info(f"Local dev: cache_recently_beaten_ats")
-                # await cache_recently_beaten_ats()
-                # logging.info(f"Local dev: cache_map_uids")
-                # await cache_map_uids()
-                # logging.info(f"Local dev: scrape_unbeaten_ats")
-                # await scrape_unbeaten_ats()
-                # await cache_unbeaten_ats()
-            latest_map = await get_latest_map_id()
-            if latest_map > state.LastScraped:
-                await scrape_range(state, latest_map)
-            await scrape_update_range(update_state)
-            await fix_unknown_author_logins()
-            await scrape_unbeaten_ats()
-            await cache_unbeaten_ats()
-            await cache_recently_beaten_ats()
-            await update_beaten_ats_leaderboard()
-            await cache_map_uids()
-            # await update_unbeaten_ats_map_pack_s2()
-            await update_tmx_tags_cached()
-            sduration = max(0, loop_seconds - (time.time() - start))
-            logging.info(f"txm scraper sleeping for {sduration}s")
-            await asyncio.sleep(sduration)
-        except Exception as e:
-            sduration = max(0, loop_seconds - (time.time() - start))
-            logging.warn(f"Exception in txm scraper: {e}. Sleeping for {sduration}s and trying again")
-            traceback.print_exc()
-            await asyncio.sleep(sduration)
+# (interval, timeout) in seconds; these all used to run one after the other every 5 minutes
+SCRAPER_TASK_INTERVAL = 300
+SCRAPER_TASK_TIMEOUT = 1800
+CACHE_TASK_TIMEOUT = 600
+CHECK_UNBEATEN_INTERVAL = 86400 // 6
+# maps get_map_info/multi fetched from tmx for unknown ids (see view_logic.get_map_infos_with_tmx_fallback)
+SAVE_FALLBACK_MAPS_INTERVAL = 60
+
+
+def build_scraper_schedule(state: TmxMapScrapeState, update_state: TmxMapScrapeState, workers: WorkerGroup | None = None) -> Scheduler:
+    ''' with more than one process (`workers`), scrape_unbeaten_ats is split between them by TrackID and only the leader
+        runs the rest; update_tmx_tags_cached runs everywhere as it fills an in-process cache '''
+    scheduler = Scheduler('tmx_scraper', workers=workers)
+    def add(name: str, run, job=SCRAPER_JOB, interval=SCRAPER_TASK_INTERVAL, timeout=SCRAPER_TASK_TIMEOUT, singleton=True, **kwargs):
+        scheduler.add(ScheduledTask(name, run, job, interval, timeout, singleton=singleton, **kwargs))
+    add('fix_at_beaten_first_nb', fix_at_beaten_first_nb)
+    add('scrape_new_maps', lambda: scrape_new_maps(state))
+    add('scrape_update_range', lambda: scrape_update_range(update_state))
+    add('fix_unknown_author_logins', fix_unknown_author_logins)
+    add('save_tmx_fallback_maps', save_tmx_fallback_maps, interval=SAVE_FALLBACK_MAPS_INTERVAL, timeout=CACHE_TASK_TIMEOUT)
+    add('scrape_unbeaten_ats', lambda: scrape_unbeaten_ats(workers), singleton=False)
+    add('cache_unbeaten_ats', cache_unbeaten_ats, timeout=CACHE_TASK_TIMEOUT)
+    add('cache_recently_beaten_ats', cache_recently_beaten_ats, timeout=CACHE_TASK_TIMEOUT)
+    add('update_beaten_ats_leaderboard', update_beaten_ats_leaderboard, timeout=CACHE_TASK_TIMEOUT)
+    add('cache_map_uids', cache_map_uids, timeout=CACHE_TASK_TIMEOUT)
+    add('update_tmx_tags_cached', update_tmx_tags_cached, timeout=60, singleton=False)
+    # unbeaten maps removed from / updated on tmx; retried sooner than its interval if it fails
+    add('check_tmx_unbeaten', check_tmx_unbeaten, job=UNBEATEN_JOB, interval=CHECK_UNBEATEN_INTERVAL, timeout=CHECK_UNBEATEN_INTERVAL,
+        retry_base=SCRAPER_TASK_INTERVAL)
+    return scheduler
+
+
+async def scrape_new_maps(state: TmxMapScrapeState):
+    latest_map = await run_stage('get_latest_map_id', get_latest_map_id())
+    job_queue_depth('new_maps', max(0, latest_map - state.LastScraped))
+    if latest_map > state.LastScraped:
+        await run_stage('scrape_range', scrape_range(state, latest_map))
 
 
 async def scrape_range(state: TmxMapScrapeState, latest: int):
@@ -146,6 +137,7 @@ async def scrape_range(state: TmxMapScrapeState, latest: int):
         await update_maps_from_tmx(to_scrape)
         state.LastScraped = to_scrape[-1]
         await state.asave()
+        job_queue_depth('new_maps', latest - state.LastScraped)
         logging.info(f"state.LastScraped: {state.LastScraped}")
         await asyncio.sleep(.8)
 
@@ -158,26 +150,29 @@ async def scrape_update_range(update_state: TmxMapScrapeState):
     updated = list()
 
     while oldest_update > down_to:
-        resp = await get_updated_maps(page, updated[-1] if len(updated) > 0 else None)
+        with job_stage('fetch'):
+            resp = await get_updated_maps(page, updated[-1] if len(updated) > 0 else None)
         maps_page = resp['Results']
         if len(maps_page) == 0:
             logging.warn(f"Got no more maps to update: page: {page}, oldest_update: {oldest_update}, down_to: {down_to}")
             break
         logging.info(f"scrape update range: page: {page}, oldest_update: {oldest_update}, down_to: {down_to}")
-        for track in maps_page:
-            oldest_update = tmx_date_to_ts(track['UpdatedAt'])
-            if oldest_update < down_to:
-                break
-            try:
-                t1 = await TmxMap.objects.filter(TrackID=track['MapId']).afirst()
-                if t1 is not None:
-                    track['AuthorLogin'] = t1.AuthorLogin
-                await update_tmx_map(tmx_v2_track_to_v1(track))
-            except Exception as e:
-                print(f"Failed to update map: {track['MapId']}: {e}")
-                print(f"Map: {track}")
-                raise e
-            updated.append(track['MapId'])
+        with job_stage('write'):
+            for track in maps_page:
+                oldest_update = tmx_date_to_ts(track['UpdatedAt'])
+                if oldest_update < down_to:
+                    break
+                try:
+                    t1 = await aget_tmx_map_record(track['MapId'])
+                    if t1 is not None:
+                        track['AuthorLogin'] = t1['AuthorLogin']
+                    await update_tmx_map(tmx_v2_track_to_v1(track))
+                except Exception as e:
+                    print(f"Failed to update map: {track['MapId']}: {e}")
+                    print(f"Map: {track}")
+                    raise e
+                updated.append(track['MapId'])
+                job_items(1)
         # oldest_map = maps_page[-1]
         page += 1
         await asyncio.sleep(.8)
@@ -225,7 +220,7 @@ async def fix_unknown_author_logins():
     logging.info(f"fix_unknown_author_logins: done for {len(tids)} / {total_tids} tracks with Unknown author login")
 
 
-TMX_SEARCH_API_URL = "https://trackmania.exchange/mapsearch2/search?api=on"
+TMX_SEARCH_API_URL = f"{TMX_BASE_URL}/mapsearch2/search?api=on"
 
 async def get_latest_map_id() -> int:
     async with get_session() as session:
@@ -241,21 +236,25 @@ async def update_maps_from_tmx(tids_or_uids: list[int | str]):
     tids_str = ','.join(map(str, tids_or_uids))
     async with get_session() as session:
         try:
-            async with session.get(f"https://trackmania.exchange/api/maps/get_map_info/multi/{tids_str}", timeout=10.0) as resp:
-                if resp.status == 200:
-                    await _add_maps_from_json(dict(results=await resp.json()))
-                else:
-                    print(f"RETRY ME: {tids_str}")
-                    raise Exception(f"Could not get map infos: {resp.status} code.")
+            with job_stage('fetch'):
+                async with session.get(f"{TMX_BASE_URL}/api/maps/get_map_info/multi/{tids_str}", timeout=10.0) as resp:
+                    if resp.status == 200:
+                        maps_j = await resp.json()
+                    else:
+                        print(f"RETRY ME: {tids_str}")
+                        raise Exception(f"Could not get map infos: {resp.status} code.")
         except asyncio.TimeoutError as e:
             raise Exception(f"TMX timeout for get map infos")
+    with job_stage('write'):
+        await _add_maps_from_json(dict(results=maps_j))
+        job_items(len(maps_j))
 
 # priord: https://api2.mania.exchange/Enum/Index/6
 # newest=2 (default), last updated=4
 
 # ! Not actually *all* of them.
 ALL_TMX2_FIELDS = "ExeVersion,Exebuild,TitlePack,Name,MapId,MapUid,OnlineMapId,Uploader.UserId,Uploader.Name,Medals.Author,Medals.Gold,Medals.Silver,Medals.Bronze,Authors,Type,MapType,Environment,Vehicle,VehicleName,Mood,MoodFull,Style,Routes,Difficulty,AwardCount,CommentCount,UploadedAt,UpdatedAt,ActivityAt,ReplayType,TrackValue,OnlineWR,OnlineWR,OnlineWR,OnlineWR,OnlineWR,ReplayCount,DownloadCount,CustomLength,Length,Tags,Images,HasThumbnail,HasImages,IsPublic,IsListed,GbxMapName,ServerSizeExceeded"
-TMX_RECENTLY_UPDATED_MAPS_API_URL = f"https://trackmania.exchange/api/maps?order1=8&fields={ALL_TMX2_FIELDS}"
+TMX_RECENTLY_UPDATED_MAPS_API_URL = f"{TMX_BASE_URL}/api/maps?order1=8&fields={ALL_TMX2_FIELDS}"
 
 # called from scraping update func: scrape_update_range
 async def get_updated_maps(page: int, after_map_id: int | None = None, d: int = 5):
@@ -294,38 +293,53 @@ async def _add_maps_from_json(j: dict):
     logging.info(f"Saved tmx maps: {track_ids}")
 
 
-def get_unbeaten_at_records_batch_size_query():
-    return TmxMapAT.objects.filter(AuthorTimeBeaten=False, Broken=False, RemovedFromTmx=False, Unbeatable=False, Track__MapType__contains="TM_Race").order_by('LastChecked', 'Track_id')[:AT_CHECK_BATCH_SIZE]
+def get_unbeaten_at_records_batch_size_query(workers: WorkerGroup | None = None):
+    q = TmxMapAT.objects.filter(AuthorTimeBeaten=False, Broken=False, RemovedFromTmx=False, Unbeatable=False, Track__MapType__contains="TM_Race")
+    if workers is not None:
+        q = workers.filter_tracks(q, 'Track__TrackID')
+    return q.order_by('LastChecked', 'Track_id')[:AT_CHECK_BATCH_SIZE]
 
 
-async def scrape_unbeaten_ats():
+async def scrape_unbeaten_ats(workers: WorkerGroup | None = None):
+    ''' checks the next batch of unbeaten ATs; with `workers`, only the maps in this process's shards '''
+    if workers is not None and len(workers.shards) == 0:
+        return
     try:
         # init
-        at_rows_for = set()
-        all_tmx_map_pks = set()
-        all_tmx_maps: dict[int, TmxMap] = dict()
-        async for _map in TmxMap.objects.filter(MapType__contains="TM_Race").values('TrackID', 'TrackUID', 'MapType', 'AuthorTime', 'id', 'pk'):
-            all_tmx_map_pks.add(_map['pk'])
-            all_tmx_maps[_map['pk']] = _map
-        async for mapAT in TmxMapAT.objects.all():
-            at_rows_for.add(mapAT.Track_id)
-        missing_maps = all_tmx_map_pks - at_rows_for
-        print(f"Missing # TmxMapATs: {len(missing_maps)}")
-        # take at most AT_CHECK_BATCH_SIZE
-        to_init = list(missing_maps)[:AT_CHECK_BATCH_SIZE]
-        for pk in to_init:
-            _at = TmxMapAT(Track_id=pk)  #all_tmx_maps[pk]
-            await _at.asave()
-        print(f"Initialized {len(to_init)} TmxMapATs")
+        with job_stage('init'):
+            at_rows_for = set()
+            all_tmx_map_pks = set()
+            all_tmx_maps: dict[int, TmxMap] = dict()
+            maps_q = TmxMap.objects.filter(MapType__contains="TM_Race")
+            if workers is not None:
+                # so two processes never create the same map's TmxMapAT
+                maps_q = workers.filter_tracks(maps_q)
+            async for _map in maps_q.values('TrackID', 'TrackUID', 'MapType', 'AuthorTime', 'id', 'pk'):
+                all_tmx_map_pks.add(_map['pk'])
+                all_tmx_maps[_map['pk']] = _map
+            async for mapAT in TmxMapAT.objects.all():
+                at_rows_for.add(mapAT.Track_id)
+            missing_maps = all_tmx_map_pks - at_rows_for
+            print(f"Missing # TmxMapATs: {len(missing_maps)}")
+            job_queue_depth('uninitialized_map_ats', len(missing_maps))
+            # take at most AT_CHECK_BATCH_SIZE
+            to_init = list(missing_maps)[:AT_CHECK_BATCH_SIZE]
+            for pk in to_init:
+                _at = TmxMapAT(Track_id=pk)  #all_tmx_maps[pk]
+                await _at.asave()
+            print(f"Initialized {len(to_init)} TmxMapATs")
+            job_items(len(to_init))
 
         # now get ATs
-        q = get_unbeaten_at_records_batch_size_query()
-        count = 0
-        mats: list[TmxMapAT] = list()
-        async for mapAT in q:
-            mapAT.LastChecked = time.time()
-            mats.append(mapAT)
-        await TmxMapAT.objects.abulk_update(mats, ['LastChecked'])
+        with job_stage('query'):
+            q = get_unbeaten_at_records_batch_size_query(workers)
+            count = 0
+            mats: list[TmxMapAT] = list()
+            async for mapAT in q:
+                mapAT.LastChecked = time.time()
+                mats.append(mapAT)
+            await TmxMapAT.objects.abulk_update(mats, ['LastChecked'])
+            job_items(len(mats))
         # for mapAT in mats:
         #     await mapAT.asave()
         for mapAT in mats:
@@ -343,7 +357,9 @@ async def scrape_unbeaten_ats():
                 logging.warn(f"Found Unbeatable AT: {track['TrackID']}")
             else:
                 # todo: scan tmx for removed maps somewhere else
-                res = await get_map_records(track['TrackUID'])
+                with job_stage('fetch'):
+                    res = await get_map_records(track['TrackUID'])
+                    job_items(1)
                 if len(res['tops']) > 0:
                     world_tops = res['tops'][0]['top']
                     if len(world_tops) > 0:
@@ -353,13 +369,15 @@ async def scrape_unbeaten_ats():
                         if score <= track['AuthorTime']:
                             set_at_beaten(mapAT, track, world_tops)
                         try:
-                            await refresh_nb_players_inner(track['TrackUID'], updated_ago_min_secs=86400)
+                            await run_stage('refresh_nb_players', refresh_nb_players_inner(track['TrackUID'], updated_ago_min_secs=86400))
                         except Exception as e:
                             logging.warn(f"Exception refreshing nb players from tmx scraper for {mapAT}: {e}")
                 if LOCAL_DEV_MODE:
                     logging.info(f"Checked AT ({track['AuthorTime']} ms) for {track['TrackID']}: Beaten: {mapAT.AuthorTimeBeaten}, WR: {mapAT.WR}")#\n{res}")
             logging.info(f"Checked AT ({track['AuthorTime']} ms) for {track['TrackID']}: Beaten: {mapAT.AuthorTimeBeaten}, WR: {mapAT.WR}")
-            await mapAT.asave()
+            with job_stage('write'):
+                await mapAT.asave()
+                job_items(1)
             count += 1
             if count >= AT_CHECK_BATCH_SIZE:
                 break
@@ -428,7 +446,7 @@ async def tmx_replay_timestamp(t: dict) -> float:
 async def replay_exists_on_tmx(replayID: int) -> bool:
     async with get_session() as session:
         try:
-            async with session.get(f"https://trackmania.exchange/api/replays/get_replay_info/{replayID}", timeout=10.0) as resp:
+            async with session.get(f"{TMX_BASE_URL}/api/replays/get_replay_info/{replayID}", timeout=10.0) as resp:
                 if resp.status == 200:
                     # returns 200 with 0 length for nonexistent replays?
                     try:
@@ -575,15 +593,17 @@ async def cache_unbeaten_ats():
     q = get_unbeaten_ats_query()
     uids = list()
     keys = ['TrackID', 'TrackUID', 'Track_Name', 'AuthorLogin', 'Tags', 'MapType', 'AuthorTime', 'WR', 'LastChecked']
-    async for mapAT in q:
-        if "TM_Race" not in mapAT.Track.MapType: continue
-        tracks.append([mapAT.Track.TrackID, mapAT.Track.TrackUID, mapAT.Track.Name, mapAT.Track.AuthorLogin, mapAT.Track.Tags, mapAT.Track.MapType, mapAT.Track.AuthorTime, mapAT.WR, mapAT.LastChecked])
-        uids.append(mapAT.Track.TrackUID)
-    q = MapTotalPlayers.objects.filter(uid__in=uids)
-
-    nbPlayersMap = dict()
-    async for mtp in q:
-        nbPlayersMap[mtp.uid] = mtp.nb_players
+    with job_stage('query'):
+        async for mapAT in q:
+            if "TM_Race" not in mapAT.Track.MapType: continue
+            tracks.append([mapAT.Track.TrackID, mapAT.Track.TrackUID, mapAT.Track.Name, mapAT.Track.AuthorLogin, mapAT.Track.Tags, mapAT.Track.MapType, mapAT.Track.AuthorTime, mapAT.WR, mapAT.LastChecked])
+            uids.append(mapAT.Track.TrackUID)
+        q = MapTotalPlayers.objects.filter(uid__in=uids)
+
+        nbPlayersMap = dict()
+        async for mtp in q:
+            nbPlayersMap[mtp.uid] = mtp.nb_players
+        job_items(len(tracks))
     keys.append('NbPlayers')
     for track in tracks:
         uid = track[1]
@@ -593,11 +613,12 @@ async def cache_unbeaten_ats():
             track.append(-1)
 
     resp = dict(keys=keys, nbTracks=len(tracks), tracks=tracks)
-    cv = await CachedValue.objects.filter(name=UNBEATEN_ATS_CV_NAME).afirst()
-    if cv is None:
-        cv = CachedValue(name=UNBEATEN_ATS_CV_NAME, value="")
-    cv.value = json.dumps(resp)
-    await cv.asave()
+    with job_stage('write'):
+        cv = await CachedValue.objects.filter(name=UNBEATEN_ATS_CV_NAME).afirst()
+        if cv is None:
+            cv = CachedValue(name=UNBEATEN_ATS_CV_NAME, value="")
+        cv.value = await adumps_json(resp)
+        await cv.asave()
     logging.info(f"Cached unbeaten ATs; len={len(cv.value)} / {len(tracks)}")
 
 async def cache_recently_beaten_ats():
@@ -605,19 +626,22 @@ async def cache_recently_beaten_ats():
     keys = ['TrackID', 'TrackUID', 'Track_Name', 'AuthorLogin', 'Tags', 'MapType', 'AuthorTime', 'WR', 'LastChecked', "ATBeatenTimestamp", "ATBeatenUsers", "NbPlayers"]
 
     nb = 200
-    tracks = await gen_recently_beaten_from_query(get_recently_beaten_ats_query()[:nb])
+    with job_stage('query'):
+        tracks = await gen_recently_beaten_from_query(get_recently_beaten_ats_query()[:nb])
 
-    tracks100k = await gen_recently_beaten_from_query(
-            get_recently_beaten_ats_query().filter(Track__TrackID__lte=100_000)[:nb]
-        )
+        tracks100k = await gen_recently_beaten_from_query(
+                get_recently_beaten_ats_query().filter(Track__TrackID__lte=100_000)[:nb]
+            )
+        job_items(len(tracks) + len(tracks100k))
 
     resp = dict(keys=keys, all=dict(nbTracks=len(tracks), tracks=tracks),
                 below100k=dict(nbTracks=len(tracks100k), tracks=tracks100k))
-    cv = await CachedValue.objects.filter(name=RECENTLY_BEATEN_ATS_CV_NAME).afirst()
-    if cv is None:
-        cv = CachedValue(name=RECENTLY_BEATEN_ATS_CV_NAME, value="")
-    cv.value = json.dumps(resp)
-    await cv.asave()
+    with job_stage('write'):
+        cv = await CachedValue.objects.filter(name=RECENTLY_BEATEN_ATS_CV_NAME).afirst()
+        if cv is None:
+            cv = CachedValue(name=RECENTLY_BEATEN_ATS_CV_NAME, value="")
+        cv.value = await adumps_json(resp)
+        await cv.asave()
     logging.info(f"Cached recently beaten ATs; len={len(cv.value)} / {len(tracks)}")
 
 
@@ -625,13 +649,16 @@ async def cache_map_uids():
     logging.info(f"track ids to uid cache start")
     q = TmxMap.objects.all().values('TrackID', 'TrackUID')
     track_uids = {}
-    async for track in q:
-        track_uids[track['TrackID']] = track['TrackUID']
-    cv = await CachedValue.objects.filter(name=TRACK_UIDS_CV_NAME).afirst()
-    if cv is None:
-        cv = CachedValue(name=TRACK_UIDS_CV_NAME, value="")
-    cv.value = json.dumps(track_uids)
-    await cv.asave()
+    with job_stage('query'):
+        async for track in q:
+            track_uids[track['TrackID']] = track['TrackUID']
+        job_items(len(track_uids))
+    with job_stage('write'):
+        cv = await CachedValue.objects.filter(name=TRACK_UIDS_CV_NAME).afirst()
+        if cv is None:
+            cv = CachedValue(name=TRACK_UIDS_CV_NAME, value="")
+        cv.value = await adumps_json(track_uids)
+        await cv.asave()
     logging.info(f"Cached track ids to uid; len={len(cv.value)} / {len(track_uids)}")
 
 
@@ -667,7 +694,7 @@ async def gen_recently_beaten_from_query(q: 'BaseManager[TmxMapAT]'):
 
 
 async def check_tmx_unbeaten_loop():
-    sleep_len = 86400 // 6
+    ''' standalone version of the scheduler's check_tmx_unbeaten task '''
     while True:
         start = time.time()
         if await is_close_to_cotd():
@@ -675,14 +702,19 @@ async def check_tmx_unbeaten_loop():
             await asyncio.sleep(60)
             continue
         try:
-            await try_fix_broken_maps()
-            await update_unbeatable_maps_list()
-            # await scrape_unbeaten_ats()
-            await run_check_tmx_unbeaten_removed_updated()
-            await try_fix_broken_maps()
+            with UNBEATEN_JOB.run():
+                await check_tmx_unbeaten()
         except Exception as e:
             logging.error(f"Exception checking tmx unbeaten/removed/updated: {e}")
-        await asyncio.sleep(sleep_len - (time.time() - start))
+        await asyncio.sleep(CHECK_UNBEATEN_INTERVAL - (time.time() - start))
+
+
+async def check_tmx_unbeaten():
+    await run_stage('try_fix_broken_maps', try_fix_broken_maps())
+    await run_stage('update_unbeatable_maps_list', update_unbeatable_maps_list())
+    # await scrape_unbeaten_ats()
+    await run_stage('check_unbeaten_removed_updated', run_check_tmx_unbeaten_removed_updated())
+    await run_stage('try_fix_broken_maps', try_fix_broken_maps())
 
 
 async def try_fix_broken_maps():
@@ -730,10 +762,13 @@ async def run_check_tmx_unbeaten_removed_updated():
     shuffle(tids)
 
     # errors above 20
-    for _batch_ids in chunk(tids, 20):
+    for i, _batch_ids in enumerate(chunk(tids, 20)):
         batch_ids = list(_batch_ids)
+        job_queue_depth('unbeaten_to_check', max(0, len(tids) - i * 20))
         logging.info(f"run_check_tmx_unbeaten_removed_updated: {len(batch_ids)}")
-        batch_resp = await get_maps_from_tmx(batch_ids)
+        with job_stage('fetch'):
+            batch_resp = await get_maps_from_tmx(batch_ids)
+            job_items(len(batch_ids))
         resp_ids = [t['TrackID'] for t in batch_resp]
         removed = set(batch_ids) - set(resp_ids)
         if len(removed) > 0:
@@ -764,6 +799,7 @@ async def run_check_tmx_unbeaten_removed_updated():
             logging.info(f"Marked {len(saved_offline_wrs)} as having AT beaten offline.")
 
         await asyncio.sleep(.5)
+    job_queue_depth('unbeaten_to_check', 0)
     logging.info(f"{time.time()} run_check_tmx_unbeaten_removed_updated end")
 
 
@@ -771,7 +807,7 @@ async def get_maps_from_tmx(tids_or_uids: list[int | str]) -> list[dict]:
     tids_str = ','.join(map(str, tids_or_uids))
     async with get_session() as session:
         try:
-            async with session.get(f"https://trackmania.exchange/api/maps/get_map_info/multi/{tids_str}", timeout=10.0) as resp:
+            async with session.get(f"{TMX_BASE_URL}/api/maps/get_map_info/multi/{tids_str}", timeout=10.0) as resp:
                 if resp.status == 200:
                     return await resp.json()
                 else:
@@ -861,6 +897,6 @@ async def update_beaten_ats_leaderboard():
     cv = await CachedValue.objects.filter(name=UNBEATEN_ATS_LEADERBOARD_CV_NAME).afirst()
     if cv is None:
         cv = CachedValue(name=UNBEATEN_ATS_LEADERBOARD_CV_NAME, value="")
-    cv.value = json.dumps(j)
+    cv.value = await adumps_json(j)
     await cv.asave()
     logging.info(f"Cached UnbeatenATs LB; len={len(cv.value)} / {nb_players}")
@@ -0,0 +1,131 @@
+from concurrent.futures import Future
+import logging
+import threading
+
+from django.core.cache import cache
+
+from getrecords.nadeoapi import MAP_INFO_BY_UID_URL, core_get_maps_by_uid
+from getrecords.utils import run_async
+from mapmonitor.metrics import record_cache
+
+
+# nadeo's map info (mapId, fileUrl, thumbnailUrl, ...) only changes if a map is re-uploaded, which is rare
+MAP_INFO_CACHE_TTL = 3600 * 6
+MAP_INFO_CACHE_KEY_FMT = "nadeo-map-info:{uid}"
+
+# how long the first lookup in a batch waits for others to join it
+BATCH_WINDOW_SECONDS = 0.05
+MAX_UIDS_PER_REQUEST = 100
+MAX_URL_LEN = 4000
+LOOKUP_TIMEOUT_SECONDS = 30
+
+
+def get_map_info(uid: str) -> dict | None:
+    ''' map info for one uid, or None if nadeo doesn't know it; safe to call from any request thread '''
+    return get_map_infos([uid]).get(uid)
+
+
+def get_map_infos(uids: list[str]) -> dict[str, dict]:
+    ''' {uid: map info} for the uids nadeo knows; cached in redis, misses are batched with concurrent lookups '''
+    uids = list(dict.fromkeys(uids))
+    found = cache_get_map_infos(uids)
+    missing = [uid for uid in uids if uid not in found]
+    record_cache('nadeo_map_info', hits=len(found), misses=len(missing))
+    if len(missing) > 0:
+        futures = {uid: _batcher.submit(uid) for uid in missing}
+        for uid, fut in futures.items():
+            info = fut.result(timeout=LOOKUP_TIMEOUT_SECONDS)
+            if info is not None:
+                found[uid] = info
+    return found
+
+
+def cache_get_map_infos(uids: list[str]) -> dict[str, dict]:
+    try:
+        cached = cache.get_many([MAP_INFO_CACHE_KEY_FMT.format(uid=uid) for uid in uids])
+    except Exception as e:
+        logging.warning(f"map info cache get failed: {e}")
+        return dict()
+    return {info['mapUid']: info for info in cached.values()}
+
+
+def cache_set_map_infos(infos: list[dict]):
+    try:
+        cache.set_many({MAP_INFO_CACHE_KEY_FMT.format(uid=info['mapUid']): info for info in infos}, MAP_INFO_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"map info cache set failed: {e}")
+
+
+def chunk_uids_for_url(uids: list[str]) -> list[list[str]]:
+    ''' split so each mapUidList request stays under MAX_UIDS_PER_REQUEST and MAX_URL_LEN '''
+    chunks = [[]]
+    url_len = len(MAP_INFO_BY_UID_URL)
+    for uid in uids:
+        if len(chunks[-1]) >= MAX_UIDS_PER_REQUEST or url_len + len(uid) + 1 > MAX_URL_LEN:
+            chunks.append([])
+            url_len = len(MAP_INFO_BY_UID_URL)
+        chunks[-1].append(uid)
+        url_len += len(uid) + 1
+    return [c for c in chunks if len(c) > 0]
+
+
+class MapInfoBatcher:
+    ''' Collects uid lookups from concurrent request threads for BATCH_WINDOW_SECONDS, then resolves them all with as few
+        mapUidList requests as possible. Lookups for a uid that is already pending share its result.
+    '''
+    def __init__(self, window: float):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending: dict[str, Future] = dict()
+        # under self.lock
+        self.nb_lookups = 0
+        self.nb_shared = 0
+        self.nb_batches = 0
+        self.nb_requests = 0
+        self.nb_uids_requested = 0
+
+    def submit(self, uid: str) -> Future:
+        with self.lock:
+            self.nb_lookups += 1
+            fut = self.pending.get(uid)
+            if fut is not None:
+                self.nb_shared += 1
+            else:
+                fut = self.pending[uid] = Future()
+                if len(self.pending) == 1:
+                    timer = threading.Timer(self.window, self.flush)
+                    timer.daemon = True
+                    timer.start()
+            return fut
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, dict()
+            chunks = chunk_uids_for_url(list(batch.keys()))
+            self.nb_batches += 1
+            self.nb_requests += len(chunks)
+            self.nb_uids_requested += len(batch)
+        for uids in chunks:
+            try:
+                infos = run_async(core_get_maps_by_uid(uids)) or []
+                cache_set_map_infos(infos)
+                by_uid = {info['mapUid']: info for info in infos}
+                for uid in uids:
+                    batch[uid].set_result(by_uid.get(uid))
+            except Exception as e:
+                logging.warning(f"map info batch of {len(uids)} failed: {e}")
+                for uid in uids:
+                    if not batch[uid].done(): batch[uid].set_exception(e)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(lookups=self.nb_lookups, shared_lookups=self.nb_shared, batches=self.nb_batches, upstream_requests=self.nb_requests,
+                        uids_per_request=self.nb_uids_requested / max(1, self.nb_requests), pending=len(self.pending))
+
+
+_batcher = MapInfoBatcher(BATCH_WINDOW_SECONDS)
+
+
+def get_stats() -> dict:
+    ''' for this process: cache misses go to the batcher; lookups per upstream request shows how much batching saves '''
+    return _batcher.stats()
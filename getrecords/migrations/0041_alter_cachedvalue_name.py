@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-19 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('getrecords', '0040_alter_tmxmap_ratingvoteaverage_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cachedvalue',
+            name='name',
+            field=models.CharField(db_index=True, max_length=64, unique=True),
+        ),
+    ]
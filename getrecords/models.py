@@ -2,6 +2,7 @@ import time
 from django.db import models
 
 from getrecords.tmx_maps import *
+from getrecords.utils import serialized_field_names
 
 _MAP_MONITOR_PLUGIN_ID = 308
 
@@ -82,7 +83,27 @@ class TmxMapScrapeState(models.Model):
 TMX_MAP_REMOVE_KEYS = ['Lightmap', 'UnlimiterRequired', 'MappackID', 'HasGhostBlocks', 'EmbeddedObjectsCount', 'EmbeddedItemsSize', 'AuthorCount', 'SizeWarning', 'CommentCount', 'ReplayCount', 'VideoCount', 'Length', 'Type', 'Environment', 'Vehicle', 'Routes', 'Difficulty', 'ActivityAt', 'ReplayType', 'UserRecord']
 
 
+# columns read by the random map search filters (views.rand_mapsearch); the chosen map is then loaded in full
+TMX_MAP_SEARCH_FIELDS = ['TrackID', 'Tags', 'LengthEnum', 'LengthSecs', 'VehicleName', 'MapType', 'Downloadable', 'Unlisted', 'Unreleased']
+TMX_MAP_NEXT_FIELDS = ['TrackID', 'TrackUID', 'Tags', 'Name', 'Username', 'MapType']
+
+
+class TmxMapQuerySet(models.QuerySet):
+    ''' projections for hot reads, so they don't pull Comments and the other ~50 columns for every row '''
+    def for_search(self):
+        return self.only(*TMX_MAP_SEARCH_FIELDS)
+
+    def for_next_map(self):
+        return self.only(*TMX_MAP_NEXT_FIELDS)
+
+    def api_dicts(self):
+        ''' the same dicts model_to_dict gives, straight from the db without building model instances '''
+        return self.values(*serialized_field_names(self.model))
+
+
 class TmxMap(models.Model):
+    objects = TmxMapQuerySet.as_manager()
+
     TrackID: int = models.IntegerField(db_index=True, unique=True)
     UserID: int = models.IntegerField(db_index=True)
     Username: str = models.CharField(max_length=32, db_index=True)
@@ -302,7 +323,7 @@ class UserStats(models.Model):
 
 
 class CachedValue(models.Model):
-    name = models.CharField(max_length=32, db_index=True, unique=True)
+    name = models.CharField(max_length=64, db_index=True, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     value = models.TextField()
@@ -3,13 +3,21 @@ from dataclasses import dataclass
 import json
 import logging
 import math
+import os
 from pathlib import Path
 import random
+import threading
 import time
+from typing import Any
+import weakref
+
+import aiohttp
 from aiohttp import BasicAuth
 
 import jwt
-from mapmonitor.settings import DEBUG
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.redis import RedisCache
+from mapmonitor.settings import DEBUG, NADEO_CORE_BASE_URL, NADEO_LIVE_BASE_URL, NADEO_MEET_BASE_URL, UBI_BASE_URL
 
 from .utils import read_config_file
 from .http import get_session
@@ -27,10 +35,10 @@ UNBEATEN_ATS_CONFIG = read_config_file('.tmx-mappack-unbeaten-ats', ['apikey', '
 TMX_MAPPACK_UNBEATEN_ATS_APIKEY = UNBEATEN_ATS_CONFIG['apikey']
 TMX_MAPPACK_UNBEATEN_ATS_S3_APIKEY = UNBEATEN_ATS_CONFIG['s3_apikey']
 
-UBI_SESSIONS_URL = "https://public-ubiservices.ubi.com/v3/profiles/sessions"
-NADEO_AUDIENCE_REG_URL = "https://prod.trackmania.core.nadeo.online/v2/authentication/token/ubiservices"
-NADEO_AUDIENCE_BASIC_URL = "https://prod.trackmania.core.nadeo.online/v2/authentication/token/basic"
-NADEO_REFRESH_URL = "https://prod.trackmania.core.nadeo.online/v2/authentication/token/refresh"
+UBI_SESSIONS_URL = f"{UBI_BASE_URL}/v3/profiles/sessions"
+NADEO_AUDIENCE_REG_URL = f"{NADEO_CORE_BASE_URL}/v2/authentication/token/ubiservices"
+NADEO_AUDIENCE_BASIC_URL = f"{NADEO_CORE_BASE_URL}/v2/authentication/token/basic"
+NADEO_REFRESH_URL = f"{NADEO_CORE_BASE_URL}/v2/authentication/token/refresh"
 
 
 TTG_CLUB_ID = 55829
@@ -105,86 +113,174 @@ def all_tokens() -> list[NadeoToken | None]:
     return [NadeoLiveToken, NadeoCoreToken, NadeoClubToken]
 
 def tokens_need_reacquire() -> bool:
-    buffer_seconds = 150.0 + 200.0 * random.random()
+    # less than TOKEN_REFRESH_MARGIN, so a token refreshed by another process is usually picked up before we'd refresh it ourselves
+    buffer_seconds = TOKEN_REFRESH_MARGIN * (0.25 + 0.25 * random.random())
     for t in all_tokens():
         if t is None: return True
         if check_refresh_after(t, buffer_seconds): return True
     return False
 
-async def reacquire_token(for_name: str, force=False) -> NadeoToken:
-    tmpNadeoToken = None
-    existing = await AuthToken.objects.filter(token_for=for_name, expiry_ts__gt=int(time.time() + 10)).afirst()
-    if existing is not None:
-        t = existing
-        tmpNadeoToken = NadeoToken(accessToken=t.access_token, refreshToken=t.refresh_token)
 
-    if force or check_refresh_after(tmpNadeoToken):
-        tmpNadeoToken = await get_token_for_audience(for_name)
-        logging.warn(f"Got {for_name} token: {tmpNadeoToken is not None}")
-        if tmpNadeoToken is not None:
-            await AuthToken.objects.aupdate_or_create(
-                token_for=for_name,
-                defaults=dict(access_token=tmpNadeoToken.accessToken, refresh_token=tmpNadeoToken.refreshToken,
-                            expiry_ts=tmpNadeoToken.accessTokenJson.get('exp'), refresh_after=tmpNadeoToken.accessTokenJson.get('rat'))
-            )
-    return tmpNadeoToken
+# Tokens are shared by every process (web workers, scraper, cotd job) via the django cache (redis), with AuthToken rows as a
+# fallback. A redis lock per audience means only one process refreshes; the others poll the shared token until it changes.
+TOKEN_CACHE_KEY_FMT = "nadeo-token:{audience}"
+TOKEN_LOCK_KEY_FMT = "nadeo-token-lock:{audience}"
+TOKEN_LOCK_TIMEOUT = 30
+TOKEN_WAIT_POLL_SECONDS = 0.25
+# refresh this long before a token's refresh-after (rat) time
+TOKEN_REFRESH_MARGIN = 120
+
+
+async def reacquire_token(for_name: str, force=False, stale_access_token: str | None = None) -> NadeoToken:
+    ''' returns the shared token if it's fresh; otherwise refreshes it (or waits for the process that is).
+        force: the caller got a 401 using stale_access_token, so don't return that one again.
+    '''
+    shared = await load_shared_token(for_name)
+    if shared is not None and not check_refresh_after(shared, TOKEN_REFRESH_MARGIN) and not (force and shared.accessToken == stale_access_token):
+        return shared
+    lock_id = await acquire_token_lock(for_name)
+    give_up_at = time.time() + 2 * TOKEN_LOCK_TIMEOUT
+    while lock_id is None:
+        token = await wait_for_token_refresh(for_name, shared)
+        if token is not None:
+            return token
+        if time.time() > give_up_at:
+            logging.warning(f"Gave up waiting for another process to refresh the {for_name} token")
+            return shared
+        # the lock went away without a new token (holder died?); take it over, unless another process beat us to it
+        lock_id = await acquire_token_lock(for_name)
+    try:
+        # someone may have finished a refresh between our first read and taking the lock
+        latest = await load_shared_token(for_name)
+        if latest is not None and (shared is None or latest.accessToken != shared.accessToken) and not check_refresh_after(latest, TOKEN_REFRESH_MARGIN):
+            return latest
+        new_token = None
+        if shared is not None and shared.refreshTokenJson.get('exp', 0) > time.time() + 10:
+            new_token = await refresh_nadeo_token(for_name, shared)
+        if new_token is None:
+            new_token = await get_token_for_audience(for_name)
+            logging.warn(f"Got {for_name} token via login: {new_token is not None}")
+        if new_token is None:
+            return shared
+        await save_shared_token(for_name, new_token)
+        return new_token
+    finally:
+        await release_token_lock(for_name, lock_id)
+
+
+async def refresh_nadeo_token(for_name: str, token: NadeoToken) -> NadeoToken | None:
+    ''' uses the refresh token instead of logging in again '''
+    async with get_session() as session:
+        async with await session.post(NADEO_REFRESH_URL, headers={'Authorization': f"nadeo_v1 t={token.refreshToken}"}) as resp:
+            if not resp.ok:
+                logging.warn(f"Error refreshing {for_name} token; {resp.status}, {await resp.content.read()}")
+                return None
+            data = await resp.json()
+            logging.info(f"Refreshed {for_name} token")
+            return NadeoToken(accessToken=data['accessToken'], refreshToken=data['refreshToken'])
+
 
+async def load_shared_token(for_name: str) -> NadeoToken | None:
+    try:
+        cached = await cache.aget(TOKEN_CACHE_KEY_FMT.format(audience=for_name))
+        if cached is not None:
+            return NadeoToken(**cached)
+    except Exception as e:
+        logging.warning(f"token cache get failed: {e}")
+    existing = await AuthToken.objects.filter(token_for=for_name, expiry_ts__gt=int(time.time() + 10)).afirst()
+    if existing is not None:
+        return NadeoToken(accessToken=existing.access_token, refreshToken=existing.refresh_token)
+    return None
+
+
+async def save_shared_token(for_name: str, token: NadeoToken):
+    expiry = token.accessTokenJson.get('exp')
+    await AuthToken.objects.aupdate_or_create(
+        token_for=for_name,
+        defaults=dict(access_token=token.accessToken, refresh_token=token.refreshToken,
+                      expiry_ts=expiry, refresh_after=token.accessTokenJson.get('rat'))
+    )
+    try:
+        await cache.aset(TOKEN_CACHE_KEY_FMT.format(audience=for_name), dict(accessToken=token.accessToken, refreshToken=token.refreshToken), max(1, int(expiry - time.time())))
+    except Exception as e:
+        logging.warning(f"token cache set failed: {e}")
+
+
+async def acquire_token_lock(for_name: str) -> str | None:
+    ''' a lock id if we got the lock, else None. If redis is down every process refreshes for itself. '''
+    lock_id = f"{os.getpid()}-{threading.get_ident()}-{random.random()}"
+    try:
+        got_it = await cache.aadd(TOKEN_LOCK_KEY_FMT.format(audience=for_name), lock_id, TOKEN_LOCK_TIMEOUT)
+    except Exception as e:
+        logging.warning(f"token lock failed, refreshing without it: {e}")
+        return lock_id
+    return lock_id if got_it else None
+
+
+async def release_token_lock(for_name: str, lock_id: str):
+    key = TOKEN_LOCK_KEY_FMT.format(audience=for_name)
+    try:
+        if await cache.aget(key) == lock_id:
+            await cache.adelete(key)
+    except Exception as e:
+        logging.warning(f"token lock release failed: {e}")
+
+
+async def wait_for_token_refresh(for_name: str, previous: NadeoToken | None) -> NadeoToken | None:
+    ''' another process holds the lock: wait until the shared token changes (None if the lock goes away first) '''
+    deadline = time.time() + TOKEN_LOCK_TIMEOUT
+    while time.time() < deadline:
+        await asyncio.sleep(TOKEN_WAIT_POLL_SECONDS)
+        latest = await load_shared_token(for_name)
+        if latest is not None and (previous is None or latest.accessToken != previous.accessToken):
+            return latest
+        try:
+            if await cache.aget(TOKEN_LOCK_KEY_FMT.format(audience=for_name)) is None:
+                return None
+        except Exception:
+            return None
+    return None
 
 
 async def reacquire_all_tokens(force=False):
+    ''' force: the current tokens were rejected (401), so replace them even if they look fresh '''
     global NadeoCoreToken, NadeoLiveToken, NadeoClubToken
+    stale = [t.accessToken if t is not None else None for t in [NadeoCoreToken, NadeoLiveToken, NadeoClubToken]]
 
     NadeoCoreToken, NadeoLiveToken, NadeoClubToken = \
         await asyncio.gather(
-            reacquire_token('NadeoServices'),
-            reacquire_token('NadeoLiveServices'),
-            reacquire_token('NadeoClubServices'),
+            reacquire_token('NadeoServices', force, stale[0]),
+            reacquire_token('NadeoLiveServices', force, stale[1]),
+            reacquire_token('NadeoClubServices', force, stale[2]),
         )
 
-    # # NadeoCoreToken = await get_token_for_audience(ubi, 'NadeoServices')
-    # # logging.warn(f"Got core token: {NadeoCoreToken is not None}")
-    # # if LOCAL_DEV_MODE:
-    # #     logging.warn(f"Got core token: {NadeoCoreToken.accessToken}")
-    # tmpNadeoToken = None
-    # existing = await AuthToken.objects.filter(token_for="NadeoLiveServices", expiry_ts__gt=int(time.time() + 10)).afirst()
-    # if existing is not None:
-    #     t = existing
-    #     tmpNadeoToken = NadeoToken(accessToken=t.access_token, refreshToken=t.refresh_token)
-
-    # if force or check_refresh_after(tmpNadeoToken):
-    #     NadeoLiveToken = await get_token_for_audience('NadeoLiveServices')
-    #     logging.warn(f"Got live token: {NadeoLiveToken is not None}")
-    #     await AuthToken.objects.aupdate_or_create(
-    #         token_for='NadeoLiveServices',
-    #         defaults=dict(access_token=NadeoLiveToken.accessToken, refresh_token=NadeoLiveToken.refreshToken,
-    #                       expiry_ts=NadeoLiveToken.accessTokenJson.get('exp'), refresh_after=NadeoLiveToken.accessTokenJson.get('rat'))
-    #     )
-    # else:
-    #     NadeoLiveToken = tmpNadeoToken
-    # if LOCAL_DEV_MODE:
-    #     logging.warn(f"Got live token: {NadeoLiveToken.accessToken}")
-
 
 def check_refresh_after(t: NadeoToken, buffer_seconds: float = 0.0) -> bool:
     if t is None: return True
     return t.accessTokenJson.get('rat') < (time.time() + buffer_seconds)
 
 
+def seconds_until_next_refresh() -> float:
+    ''' until the earliest token is within TOKEN_REFRESH_MARGIN of its rat; clamped to [5s, 10min] '''
+    if any(t is None for t in all_tokens()): return 5.0
+    now = time.time()
+    due = min(t.accessTokenJson.get('rat') - TOKEN_REFRESH_MARGIN - now for t in all_tokens())
+    return max(5.0, min(600.0, due))
+
+
 NADEO_SVC_AUTH_STARTED = False
 async def run_nadeo_services_auth():
+    ''' refreshes tokens just before their refresh-after time; only the process holding the lock actually calls nadeo '''
     global NADEO_SVC_AUTH_STARTED
     if NADEO_SVC_AUTH_STARTED: return
     NADEO_SVC_AUTH_STARTED = True
     await reacquire_all_tokens()
     while True:
-        await asyncio.sleep(60)
-        ts = all_tokens()
-        for t in ts:
-            if t is None: continue
-            refreshAfter = t.accessTokenJson.get('rat')
-            if time.time() > refreshAfter + 10:
-                await reacquire_all_tokens()
-                break
+        await asyncio.sleep(seconds_until_next_refresh() + random.random() * 5)
+        try:
+            await reacquire_all_tokens()
+        except Exception as e:
+            logging.error(f"Error refreshing nadeo tokens: {e}")
 
 
 def get_token_for(audience):
@@ -211,40 +307,244 @@ def get_club_session():
     return get_nadeo_session('NadeoClubServices')
 
 
-TOTD_MAP_LIST = "https://live-services.trackmania.nadeo.live/api/token/campaign/month?length={length}&offset=0"
+NADEO_SERVICE_LIMITS = {
+    # audience: (requests per second and burst, shared by every process (see SharedTokenBucket); max in flight per event loop)
+    'NadeoServices': (10.0, 20, 8),
+    'NadeoLiveServices': (10.0, 20, 8),
+    'NadeoClubServices': (10.0, 20, 8),
+}
+NADEO_BACKOFF_BASE_SECONDS = 0.5
+
+
+@dataclass(frozen=True)
+class NadeoRetryPolicy:
+    # per attempt
+    timeout: float
+    max_retries: int
+    backoff_max: float
+    # no retry starts later than this after the first attempt
+    deadline: float
+
+
+# Web requests call nadeo through run_async while a gunicorn worker waits, so they get a small budget (at worst about
+# deadline + timeout); the bg jobs can afford to wait out rate limits and outages. Bg job processes switch with
+# use_background_retry_policy().
+REQUEST_RETRY_POLICY = NadeoRetryPolicy(timeout=5, max_retries=1, backoff_max=2.0, deadline=8.0)
+BACKGROUND_RETRY_POLICY = NadeoRetryPolicy(timeout=20, max_retries=3, backoff_max=30.0, deadline=300.0)
+
+
+class TokenBucket:
+    ''' Thread-safe, since every run_async call has its own event loop. acquire() reserves a slot and sleeps until it's due;
+        negative tokens are reservations queued behind the ones already handed out.
+    '''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# One budget per service for every process (gunicorn workers, each bg job process): the bucket lives in redis and is
+# updated by a script, so it's atomic. The clock is redis's, so processes on different hosts agree. If redis isn't
+# available, each process falls back to its own TokenBucket at the same rate, which lets the total go over the limit.
+NADEO_BUCKET_KEY_FMT = "nadeo-bucket:{audience}"
+# KEYS[1]: bucket, ARGV: rate, burst; returns the seconds to wait before sending (as a string: lua numbers are truncated)
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', string.format('%.6f', tokens), 'updated', string.format('%.6f', now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate - tokens / rate) + 60)
+if tokens >= 0 then return '0' end
+return string.format('%.6f', -tokens / rate)
+"""
+
+
+class SharedTokenBucket(TokenBucket):
+    ''' a TokenBucket kept in redis, so every process draws from it; this process's own bucket is the fallback '''
+    def __init__(self, audience: str, rate: float, burst: int):
+        super().__init__(rate, burst)
+        self.key = NADEO_BUCKET_KEY_FMT.format(audience=audience)
+        self.shared = True
+        # one backend (so one connection pool) for all threads, created on first use
+        self._backend = None
+
+    def reserve_shared(self) -> float | None:
+        ''' None if the cache isn't redis '''
+        if self._backend is None:
+            self._backend = caches.create_connection(DEFAULT_CACHE_ALIAS)
+        if not isinstance(self._backend, RedisCache):
+            return None
+        client = self._backend._cache.get_client(self.key, write=True)
+        return float(client.eval(TOKEN_BUCKET_LUA, 1, self._backend.make_and_validate_key(self.key), self.rate, self.burst))
+
+    async def acquire(self):
+        try:
+            delay = await asyncio.to_thread(self.reserve_shared)
+            if not self.shared:
+                logging.info(f"nadeo rate limit {self.key}: back to the shared bucket")
+                self.shared = True
+        except Exception as e:
+            if self.shared:
+                logging.warning(f"nadeo rate limit {self.key}: redis failed, limiting this process on its own: {e}")
+                self.shared = False
+            delay = None
+        if delay is None:
+            delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+@dataclass
+class NadeoResult:
+    status: int
+    # parsed json for 2xx responses (None if empty), otherwise the body text (or the exception, for network errors)
+    data: Any
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+
+class NadeoApiClient:
+    ''' All requests to nadeo services go through here: token injection by audience, a token bucket per service (shared by all processes),
+        bounded concurrency per event loop, exponential backoff on 429/5xx/network errors (idempotent requests only),
+        one forced token reacquire on 401, and per-endpoint metrics (see metrics()).
+    '''
+    def __init__(self, limits: dict[str, tuple[float, int, int]], policy: NadeoRetryPolicy = REQUEST_RETRY_POLICY):
+        self.limits = limits
+        self.policy = policy
+        self.buckets = {aud: SharedTokenBucket(aud, rate, burst) for aud, (rate, burst, _) in limits.items()}
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]] = weakref.WeakKeyDictionary()
+        self._metrics: dict[str, dict] = dict()
+        self._lock = threading.Lock()
+
+    def _semaphore(self, audience: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            per_loop = self._semaphores.setdefault(loop, dict())
+            if audience not in per_loop:
+                per_loop[audience] = asyncio.Semaphore(self.limits[audience][2])
+            return per_loop[audience]
+
+    def _record(self, endpoint: str, status: int, duration: float, retried: bool):
+        with self._lock:
+            m = self._metrics.setdefault(endpoint, dict(requests=0, errors=0, retries=0, total_secs=0.0, max_secs=0.0, statuses=dict()))
+            m['requests'] += 1
+            if not (200 <= status < 300): m['errors'] += 1
+            if retried: m['retries'] += 1
+            m['total_secs'] += duration
+            m['max_secs'] = max(m['max_secs'], duration)
+            m['statuses'][status] = m['statuses'].get(status, 0) + 1
+
+    def metrics(self) -> dict[str, dict]:
+        with self._lock:
+            return {ep: dict(m, statuses=dict(m['statuses']), avg_secs=m['total_secs'] / max(1, m['requests'])) for ep, m in self._metrics.items()}
+
+    async def request(self, audience: str, method: str, url: str, endpoint: str, headers: dict | None = None, idempotent: bool | None = None, **kwargs) -> NadeoResult:
+        ''' endpoint is the name metrics are recorded under; kwargs go to aiohttp (json=, data=, ...).
+            idempotent (default: GET/HEAD) requests are retried on 429/5xx/network errors; others aren't, since nadeo may
+            have acted on a request that timed out (creating a room twice, ...). '''
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        policy = self.policy
+        await await_nadeo_services_initialized()
+        refreshed_token = False
+        attempt = 0
+        first_start = time.monotonic()
+        while True:
+            await self.buckets[audience].acquire()
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                async with self._semaphore(audience):
+                    async with get_nadeo_session(audience) as session:
+                        if headers is not None: session.headers.update(headers)
+                        async with session.request(method, url, timeout=policy.timeout, **kwargs) as resp:
+                            body = await resp.read()
+                            retry_after = resp.headers.get('Retry-After')
+                            if resp.ok:
+                                result = NadeoResult(resp.status, json.loads(body) if len(body) > 0 else None)
+                            else:
+                                result = NadeoResult(resp.status, body.decode('utf-8', errors='replace'))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result = NadeoResult(0, e)
+            should_refresh = result.status == 401 and not refreshed_token
+            delay = backoff_delay(attempt, retry_after, policy.backoff_max)
+            should_retry = (idempotent and (result.status == 0 or result.status == 429 or result.status >= 500) and attempt < policy.max_retries
+                            and time.monotonic() - first_start + delay <= policy.deadline)
+            self._record(endpoint, result.status, time.perf_counter() - start, should_refresh or should_retry)
+            if should_refresh:
+                logging.warning(f"nadeo {endpoint}: 401, reacquiring tokens and retrying")
+                refreshed_token = True
+                await reacquire_all_tokens(True)
+                continue
+            if should_retry:
+                attempt += 1
+                logging.warning(f"nadeo {endpoint}: {result.status} {str(result.data)[:200]}; retry {attempt}/{policy.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            if not result.ok:
+                logging.warning(f"nadeo {endpoint} failed: {method} {url}: {result.status}, {str(result.data)[:500]}")
+            return result
+
+    async def get_json(self, audience: str, url: str, endpoint: str, **kwargs):
+        ''' the parsed response for 2xx, None otherwise '''
+        result = await self.request(audience, 'GET', url, endpoint, **kwargs)
+        return result.data if result.ok else None
+
+
+def backoff_delay(attempt: int, retry_after: str | None, backoff_max: float) -> float:
+    if retry_after is not None:
+        try:
+            return min(backoff_max, float(retry_after))
+        except ValueError:
+            pass
+    return min(backoff_max, NADEO_BACKOFF_BASE_SECONDS * 2**attempt) * (0.5 + random.random())
+
+
+nadeo_client = NadeoApiClient(NADEO_SERVICE_LIMITS)
+
+
+def use_background_retry_policy():
+    ''' for bg job processes: longer timeouts and more retries than web requests get '''
+    nadeo_client.policy = BACKGROUND_RETRY_POLICY
+
+
+TOTD_MAP_LIST = NADEO_LIVE_BASE_URL + "/api/token/campaign/month?length={length}&offset=0"
 
 async def get_totd_maps(length=100):
-    await await_nadeo_services_initialized()
-    async with get_live_session() as session:
-        async with await session.get(TOTD_MAP_LIST.format(length=length)) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            logging.warn(f"get totd maps got status: {resp.status}, {await resp.text()}")
-            return None
+    return await nadeo_client.get_json('NadeoLiveServices', TOTD_MAP_LIST.format(length=length), 'get_totd_maps')
 
-GET_CHALLENGE_URL = "https://meet.trackmania.nadeo.club/api/challenges/{id}"
+GET_CHALLENGE_URL = NADEO_MEET_BASE_URL + "/api/challenges/{id}"
 
 async def get_challenge(_id: int):
-    url = GET_CHALLENGE_URL.format(id=_id)
-    await await_nadeo_services_initialized()
-    async with get_club_session() as session:
-        async with await session.get(url) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            logging.warn(f"get challenge with id {_id} failed: {resp.status}, {await resp.text()}")
-            return None
+    return await nadeo_client.get_json('NadeoClubServices', GET_CHALLENGE_URL.format(id=_id), 'get_challenge')
 
-GET_CHALLENGE_RECORDS_URL = "https://meet.trackmania.nadeo.club/api/challenges/{id}/records/maps/{map_uid}?length={length}&offset={offset}"
+GET_CHALLENGE_RECORDS_URL = NADEO_MEET_BASE_URL + "/api/challenges/{id}/records/maps/{map_uid}?length={length}&offset={offset}"
 
 async def get_challenge_records(_id: int, map_uid: str, length: int = 10, offset: int = 0):
     url = GET_CHALLENGE_RECORDS_URL.format(id=_id, map_uid=map_uid, length=length, offset=offset)
-    await await_nadeo_services_initialized()
-    async with get_club_session() as session:
-        async with await session.get(url) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            logging.warn(f"get challenge records with id {_id}, map: {map_uid} failed: {resp.status}, {await resp.text()}")
-            return None
+    return await nadeo_client.get_json('NadeoClubServices', url, 'get_challenge_records')
 
 
 async def get_and_save_all_challenge_records(challenge: CotdChallenge):
@@ -269,65 +569,38 @@ def gen_cotd_quali_challenge_block(challenge, resp, offset, loop_mid) -> list[Co
     ]
 
 
-GET_CHALLENGE_PLAYERS_URL = "https://meet.trackmania.nadeo.club/api/challenges/{id}/records/maps/{map_uid}/players?players[]="
+GET_CHALLENGE_PLAYERS_URL = NADEO_MEET_BASE_URL + "/api/challenges/{id}/records/maps/{map_uid}/players?players[]="
 
 # {"uid":"jAtn7LQt2MTG5xv4BeiQwZAX1K","cardinal":376,"records":[{"player":"0a2d1bc0-4aaa-4374-b2db-3d561bdab1c9","score":52414,"rank":230}]}
 async def get_challenge_players(_id: int, map_uid: str, *player_wsids: list[str]):
     url = GET_CHALLENGE_PLAYERS_URL.format(id=_id, map_uid=map_uid) + ",".join(player_wsids)
-    await await_nadeo_services_initialized()
-    async with get_club_session() as session:
-        async with await session.get(url) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            logging.warn(f"get challenge players with id {_id}, map: {map_uid} failed: {resp.status}, {await resp.text()}")
-            return None
+    return await nadeo_client.get_json('NadeoClubServices', url, 'get_challenge_players')
 
-COTD_CURRENT_URL = "https://meet.trackmania.nadeo.club/api/cup-of-the-day/current"
+COTD_CURRENT_URL = f"{NADEO_MEET_BASE_URL}/api/cup-of-the-day/current"
 
 async def get_cotd_current():
-    await await_nadeo_services_initialized()
-    async with get_club_session() as session:
-        async with await session.get(COTD_CURRENT_URL) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            if resp.status == 204:
-                logging.warn(f"api COTD current 204, sleeping for 180 seconds")
-                await asyncio.sleep(180)
-            else:
-                logging.warn(f"api COTD current failed: {resp.status}, {await resp.text()}")
-            return None
+    result = await nadeo_client.request('NadeoClubServices', 'GET', COTD_CURRENT_URL, 'get_cotd_current')
+    if result.status == 200:
+        return result.data
+    if result.status == 204:
+        logging.warn(f"api COTD current 204, sleeping for 180 seconds")
+        await asyncio.sleep(180)
+    return None
 
 
-MAP_RECORD = "https://live-services.trackmania.nadeo.live/api/token/leaderboard/group/Personal_Best/map/{mapUid}/top?length={length}&onlyWorld={onlyWorld}&offset={offset}"
+MAP_RECORD = NADEO_LIVE_BASE_URL + "/api/token/leaderboard/group/Personal_Best/map/{mapUid}/top?length={length}&onlyWorld={onlyWorld}&offset={offset}"
 
 
-async def get_map_records(mapUid: str, length: int = 20, offset: int = 0, only_world: bool = True, retry_fix_401=True):
-    await await_nadeo_services_initialized()
-    async with get_live_session() as session:
-        async with await session.get(MAP_RECORD.format(mapUid=mapUid, length=length, offset=offset, onlyWorld=str(only_world).lower())) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            logging.warn(f"get_map_records status: {resp.status}, {await resp.text()}")
-            if (retry_fix_401 and resp.status == 401):
-                await reacquire_all_tokens(True)
-                return await get_map_records(mapUid, length, offset, only_world, retry_fix_401 = False)
-            return None
+async def get_map_records(mapUid: str, length: int = 20, offset: int = 0, only_world: bool = True):
+    url = MAP_RECORD.format(mapUid=mapUid, length=length, offset=offset, onlyWorld=str(only_world).lower())
+    return await nadeo_client.get_json('NadeoLiveServices', url, 'get_map_records')
 
 
 
-MAP_SCORE_AROUND = "https://live-services.trackmania.nadeo.live/api/token/leaderboard/group/Personal_Best/map/{mapUid}/surround/1/1?onlyWorld=true&score={score}"
+MAP_SCORE_AROUND = NADEO_LIVE_BASE_URL + "/api/token/leaderboard/group/Personal_Best/map/{mapUid}/surround/1/1?onlyWorld=true&score={score}"
 
-async def get_map_scores_around(mapUid: str, score: int, retry_fix_401=True):
-    await await_nadeo_services_initialized()
-    async with get_live_session() as session:
-        async with await session.get(MAP_SCORE_AROUND.format(mapUid=mapUid, score=score)) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            logging.warn(f"get_map_scores_around status: {resp.status}, {await resp.text()}")
-            if (retry_fix_401 and resp.status == 401):
-                await reacquire_all_tokens(True)
-                return await get_map_scores_around(mapUid, score, retry_fix_401 = False)
-            return None
+async def get_map_scores_around(mapUid: str, score: int):
+    return await nadeo_client.get_json('NadeoLiveServices', MAP_SCORE_AROUND.format(mapUid=mapUid, score=score), 'get_map_scores_around')
 
 async def nadeo_get_nb_players_for_map(map_uid: str):
     a_long_time = 1000 * 86400 * 21
@@ -343,22 +616,13 @@ async def nadeo_get_surround_for_map(map_uid: str, score: int):
     return resp
 
 
-MAP_INFO_BY_UID_URL = "https://prod.trackmania.core.nadeo.online/maps/?mapUidList="
+MAP_INFO_BY_UID_URL = f"{NADEO_CORE_BASE_URL}/maps/?mapUidList="
 
 async def core_get_maps_by_uid(uids: list[str]):
-    await await_nadeo_services_initialized()
-    url = MAP_INFO_BY_UID_URL + ",".join(uids)
-    async with get_core_session() as session:
-        async with await session.get(url) as resp:
-            if not resp.ok:
-                print(f"Error getting maps for uids: {uids}; {resp.status}, {await resp.content.read()}")
-                logging.warn(f"Error getting maps for uids: {uids}; {resp.status}, {await resp.content.read()}")
-                return
-            return await resp.json()
+    return await nadeo_client.get_json('NadeoServices', MAP_INFO_BY_UID_URL + ",".join(uids), 'core_get_maps_by_uid')
 
 ''' wait for up to 2 minutes for maps to be uploaded '''
 async def await_maps_uploaded(mapUids: list[str]):
-    await await_nadeo_services_initialized()
     mapsNotUploaded = set(mapUids)
     counter = 0
     logging.info(f"Awaiting map uploads: {len(mapsNotUploaded)} : {mapsNotUploaded}")
@@ -366,29 +630,25 @@ async def await_maps_uploaded(mapUids: list[str]):
         if counter > 0:
             await asyncio.sleep(2)
         counter += 1
-        url = MAP_INFO_BY_UID_URL + ",".join(mapsNotUploaded)
-        async with get_core_session() as session:
-            async with await session.get(url) as resp:
-                if not resp.ok:
-                    logging.warn(f"Error getting maps for uids: {mapUids}; {resp.status}, {await resp.content.read()}")
-                    return
-                mapInfos = await resp.json()
-                for mapInfo in mapInfos:
-                    uid = mapInfo['mapUid']
-                    if uid in mapsNotUploaded:
-                        mapsNotUploaded.remove(uid)
-                logging.info(f"Maps not yet uploaded; {mapsNotUploaded}")
+        mapInfos = await core_get_maps_by_uid(list(mapsNotUploaded))
+        if mapInfos is None:
+            return
+        for mapInfo in mapInfos:
+            uid = mapInfo['mapUid']
+            if uid in mapsNotUploaded:
+                mapsNotUploaded.remove(uid)
+        logging.info(f"Maps not yet uploaded; {mapsNotUploaded}")
     if len(mapsNotUploaded) > 0:
         logging.warn(f"Some maps are not yet uploaded! {mapsNotUploaded}")
     else:
         logging.info(f"All maps uploaded: {set(mapUids)}")
 
 
-CREATE_ROOM_URL = f"https://live-services.trackmania.nadeo.live/api/token/club/{TTG_CLUB_ID}/room/create"
-DELETE_ROOM_URL = lambda activityId: f"https://live-services.trackmania.nadeo.live/api/token/club/{TTG_CLUB_ID}/activity/{activityId}/delete"
-GET_ROOM_URL = lambda activityId: f"https://live-services.trackmania.nadeo.live/api/token/club/{TTG_CLUB_ID}/room/{activityId}/"
-GET_PASSWORD_URL = lambda activityId: f"https://live-services.trackmania.nadeo.live/api/token/club/{TTG_CLUB_ID}/room/{activityId}/get-password"
-POST_JOIN_URL = lambda activityId: f"https://live-services.trackmania.nadeo.live/api/token/club/{TTG_CLUB_ID}/room/{activityId}/join"
+CREATE_ROOM_URL = f"{NADEO_LIVE_BASE_URL}/api/token/club/{TTG_CLUB_ID}/room/create"
+DELETE_ROOM_URL = lambda activityId: f"{NADEO_LIVE_BASE_URL}/api/token/club/{TTG_CLUB_ID}/activity/{activityId}/delete"
+GET_ROOM_URL = lambda activityId: f"{NADEO_LIVE_BASE_URL}/api/token/club/{TTG_CLUB_ID}/room/{activityId}/"
+GET_PASSWORD_URL = lambda activityId: f"{NADEO_LIVE_BASE_URL}/api/token/club/{TTG_CLUB_ID}/room/{activityId}/get-password"
+POST_JOIN_URL = lambda activityId: f"{NADEO_LIVE_BASE_URL}/api/token/club/{TTG_CLUB_ID}/room/{activityId}/join"
 
 ''' example settings:
 
@@ -397,7 +657,6 @@ POST_JOIN_URL = lambda activityId: f"https://live-services.trackmania.nadeo.live
 '''
 
 async def create_club_room(name: str, mapUids=list[str], region: str = "eu-west", scalable=0, password=0, maxPlayers=64, script="TrackMania/TM_TimeAttack_Online.Script.txt", settings=None):
-    await await_nadeo_services_initialized()
     valid_regions = ["eu-west", "ca-central"]
     if region not in valid_regions:
         region = valid_regions[0]
@@ -413,63 +672,41 @@ async def create_club_room(name: str, mapUids=list[str], region: str = "eu-west"
         "scalable":scalable,
         "password":password
     }
-    async with get_live_session() as session:
-        async with session.post(CREATE_ROOM_URL, json=data) as resp:
-            if not resp.ok:
-                logging.warn(f"Error creating club room; {resp.status}, {await resp.content.read()}")
-                return
-            data = await resp.json()
-            logging.info(f"Create room response: {data}")
-            if password == 0:
-                return data
-        logging.info(f"Getting password for club room: {data['activityId']}")
-        async with session.get(GET_PASSWORD_URL(data['activityId'])) as resp:
-            if not resp.ok:
-                logging.warn(f"Error getting pw for club room; {resp.status}, {await resp.content.read()}; {data}")
-                return data
-            pwData = await resp.json()
-            data['password'] = pwData['password']
-            return data
+    result = await nadeo_client.request('NadeoLiveServices', 'POST', CREATE_ROOM_URL, 'create_club_room', idempotent=False, json=data)
+    if not result.ok:
+        return
+    data = result.data
+    logging.info(f"Create room response: {data}")
+    if password == 0:
+        return data
+    logging.info(f"Getting password for club room: {data['activityId']}")
+    return await add_club_room_password(data)
+
+async def add_club_room_password(data: dict):
+    pwData = await nadeo_client.get_json('NadeoLiveServices', GET_PASSWORD_URL(data['activityId']), 'get_club_room_password')
+    if pwData is None:
+        return data
+    data['password'] = pwData['password']
+    return data
 
 async def get_club_room(activityId: int):
-    await await_nadeo_services_initialized()
-    async with get_live_session() as session:
-        async with session.get(GET_ROOM_URL(activityId)) as resp:
-            if not resp.ok:
-                logging.warn(f"Error getting club room {activityId}; {resp.status}, {await resp.content.read()}")
-            else:
-                data = await resp.json()
-                async with session.get(GET_PASSWORD_URL(data['activityId'])) as resp:
-                    if not resp.ok:
-                        logging.warn(f"Error getting pw for club room; {resp.status}, {await resp.content.read()}; {data}")
-                        return data
-                    pwData = await resp.json()
-                    data['password'] = pwData['password']
-                    return data
+    data = await nadeo_client.get_json('NadeoLiveServices', GET_ROOM_URL(activityId), 'get_club_room')
+    if data is not None:
+        return await add_club_room_password(data)
 
 async def delete_club_room(activityId: int):
-    await await_nadeo_services_initialized()
-    async with get_live_session() as session:
-        async with session.post(DELETE_ROOM_URL(activityId)) as resp:
-            if not resp.ok:
-                logging.warn(f"Error deleting club room {activityId}; {resp.status}, {await resp.content.read()}")
-            else:
-                logging.info(f"Deleted activity: {activityId}")
+    result = await nadeo_client.request('NadeoLiveServices', 'POST', DELETE_ROOM_URL(activityId), 'delete_club_room', idempotent=False)
+    if result.ok:
+        logging.info(f"Deleted activity: {activityId}")
 
 
 async def join_club_room(activityId: int):
-    await await_nadeo_services_initialized()
-    async with get_live_session() as session:
-        async with session.post(POST_JOIN_URL(activityId)) as resp:
-            if not resp.ok:
-                logging.warn(f"Error getting join info for {activityId}; {resp.status}, {await resp.content.read()}")
-                if resp.status == 504: # timeout
-                    await asyncio.sleep(1.0)
-                    return await join_club_room(activityId)
-            else:
-                data: dict = await resp.json()
-                # logging.debug(f"Join link data: {data}")
-                return data
+    # asking for a join link again is harmless, so timeouts (504) and other transient errors are retried by the client
+    result = await nadeo_client.request('NadeoLiveServices', 'POST', POST_JOIN_URL(activityId), 'join_club_room', idempotent=True)
+    if result.ok:
+        data: dict = result.data
+        # logging.debug(f"Join link data: {data}")
+        return data
 
 async def await_join_club_room(activityId: int):
         count = 0
@@ -477,8 +714,9 @@ async def await_join_club_room(activityId: int):
             if count > 0:
                 await asyncio.sleep(.75)
             count += 1
-            join_resp: dict = await join_club_room(activityId)
-            if not join_resp.get('starting', True):
+            join_resp: dict | None = await join_club_room(activityId)
+            # None: the request failed even after retries; treat it as not started yet
+            if join_resp is not None and not join_resp.get('starting', True):
                 return join_resp['joinLink']
         logging.warn(f"Server was not started! checked 60 times sleeping .75s between.")
 
@@ -517,7 +755,7 @@ async def run_club_room_creation_test():
 async def upload_map(map_file: str, map_id: str, map_uid: str, map_name: str, author_id: str, at: int, gold: int, silver: int, bronze: int, token: str = ""):
     map_path = Path(map_file)
     map_bytes = map_path.read_bytes()
-    url = f"https://prod.trackmania.core.nadeo.online/maps/{map_id}"
+    url = f"{NADEO_CORE_BASE_URL}/maps/{map_id}"
     boundary = "BoundaryAvd6SChorflHbz03MQHQyJWA92quH6vii3RgZ9bc"
 
     content = f"""--{boundary}
@@ -568,20 +806,11 @@ Content-Transfer-Encoding: binary\r
     print(f"DEV headers: {headers}")
     if len(token) > 0:
         headers["Authorization"] = f"nadeo_v1 t={token}"
-    await await_nadeo_services_initialized()
-    async with get_core_session() as session:
-        session.headers.update(headers)
-        # return None
-        async with session.post(url, data=content) as resp:
-            if not resp.ok:
-                logging.warn(f"Error uploading map {map_uid}; {resp.status}, {await resp.content.read()}")
-                # if resp.status == 504: # timeout
-                #     await asyncio.sleep(1.0)
-                #     return await join_club_room(activityId)
-            else:
-                data: dict = await resp.json()
-                logging.warn(f"map upload response: {data}")
-                return data
+    result = await nadeo_client.request('NadeoServices', 'POST', url, 'upload_map', headers=headers, idempotent=False, data=content)
+    if result.ok:
+        data: dict = result.data
+        logging.warn(f"map upload response: {data}")
+        return data
 
 
 # 0a2d1bc0-4aaa-4374-b2db-3d561bdab1c9
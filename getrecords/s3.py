@@ -3,6 +3,7 @@ import boto3
 import botocore
 
 from getrecords.utils import read_config_file
+from mapmonitor.metrics import observe_upstream
 
 s3_config = read_config_file('.s3', ['access-key', 'secret-key', 'service-url', 'bucket-name'])
 s3_bucket_name = s3_config['bucket-name']
@@ -27,7 +28,8 @@ s3_client = boto3.client('s3',
 
 def upload_ghost_to_s3(ghost_hash: str, ghost_body: bytes) -> str:
     key = f'ghost/{ghost_hash}.Ghost.gbx'
-    s3.Object(s3_bucket_name, key).put(
-        ACL='public-read', Body=ghost_body
-    )
+    with observe_upstream('s3'):
+        s3.Object(s3_bucket_name, key).put(
+            ACL='public-read', Body=ghost_body
+        )
     return f"https://{s3_bucket_name}.{s3_config['service-url']}/" + key
@@ -0,0 +1,184 @@
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+import random
+import time
+import traceback
+from typing import Callable, Coroutine
+
+from getrecords.bg_workers import WorkerGroup
+from getrecords.job_telemetry import JobTelemetry
+from getrecords.models import CachedValue
+from getrecords.view_logic import is_close_to_cotd
+
+
+# Runs a background job's periodic tasks concurrently on one event loop, each on its own schedule, so a slow or failing
+# task doesn't hold up the others. Per task: an interval (between starts), a timeout, how many runs may overlap, whether
+# to pause around COTD quali, and exponential backoff after failures. Each run is a top-level stage of the task's job
+# telemetry. Each task's schedule is saved in its own CachedValue, so a restarted process picks up where it left off instead of running
+# everything at once.
+# With a WorkerGroup (see bg_workers.py), several processes can run the same schedule: singleton tasks only run on the
+# group's leader, and the others are expected to split their work using the group's shards. Only the leader saves and
+# loads the schedules of the tasks that run in every process, so processes don't overwrite each other's backoff; the
+# others start those tasks afresh.
+#
+#     scheduler = Scheduler('tmx_scraper')
+#     scheduler.add(ScheduledTask('cache_map_uids', cache_map_uids, SCRAPER_JOB, interval=300, timeout=600))
+#     loop.create_task(scheduler.run_forever())
+
+SCHEDULE_CV_NAME_FMT = "Schedule:{name}:{task}"
+TICK_SECONDS = 1.0
+# while close to COTD, paused tasks are checked again this often
+COTD_PAUSE_RECHECK_SECONDS = 60
+COTD_CHECK_CACHE_SECONDS = 15
+
+
+@dataclass
+class ScheduledTask:
+    name: str
+    # makes the coroutine for one run
+    run: Callable[[], Coroutine]
+    job: JobTelemetry
+    interval: float
+    timeout: float | None = None
+    max_concurrent: int = 1
+    pause_near_cotd: bool = True
+    # after n failures in a row the next run is retry_base * 2**(n-1) (default: interval) after the failure, up to backoff_max
+    retry_base: float | None = None
+    backoff_max: float = 3600.0
+    # only run on the leader of the scheduler's WorkerGroup
+    singleton: bool = False
+
+    def retry_delay(self, failures: int) -> float:
+        base = self.retry_base if self.retry_base is not None else self.interval
+        return min(max(self.backoff_max, self.interval), base * 2**(failures - 1)) * (0.5 + random.random())
+
+
+def new_task_state() -> dict:
+    return dict(next_run_at=None, last_started_at=None, last_finished_at=None, last_seconds=None, last_ok=None, last_error=None,
+                failures=0, runs=0, running=0)
+
+
+class Scheduler:
+    def __init__(self, name: str, max_running: int = 4, workers: WorkerGroup | None = None):
+        ''' max_running: tasks (of any kind) running at once; due tasks wait for a slot '''
+        self.name = name
+        self.max_running = max_running
+        self.workers = workers
+        self._was_leader = False
+        self.tasks: dict[str, ScheduledTask] = dict()
+        self.state: dict[str, dict] = dict()
+        self._running: set[asyncio.Task] = set()
+        self._cotd = dict(close=False, checked_at=0.0)
+
+    def add(self, task: ScheduledTask):
+        if task.name in self.tasks:
+            raise ValueError(f"duplicate scheduled task {task.name}")
+        self.tasks[task.name] = task
+        self.state[task.name] = new_task_state()
+        # shows up in the job's status doc (/debug/jobs)
+        task.job.doc.setdefault('schedule', dict())[task.name] = self.state[task.name]
+
+    async def run_forever(self):
+        if self.workers is not None:
+            await self.workers.ready.wait()
+        await self.load_state()
+        while True:
+            try:
+                await self.check_leadership()
+                await self.start_due_tasks()
+            except Exception as e:
+                logging.error(f"scheduler {self.name}: {e}")
+                traceback.print_exc()
+            await asyncio.sleep(TICK_SECONDS)
+
+    async def start_due_tasks(self):
+        now = time.time()
+        due = [t for t in self.tasks.values() if (self.state[t.name]['next_run_at'] or 0) <= now and self.state[t.name]['running'] < t.max_concurrent
+               and self.may_run(t)]
+        for task in sorted(due, key=lambda t: self.state[t.name]['next_run_at'] or 0):
+            if len(self._running) >= self.max_running:
+                break
+            s = self.state[task.name]
+            if task.pause_near_cotd and await self.close_to_cotd():
+                logging.info(f"scheduler {self.name}: not starting {task.name} as we are close to COTD")
+                s['next_run_at'] = now + COTD_PAUSE_RECHECK_SECONDS
+                continue
+            s.update(running=s['running'] + 1, last_started_at=now, next_run_at=now + task.interval)
+            t = asyncio.create_task(self.run_task(task))
+            self._running.add(t)
+            t.add_done_callback(self._running.discard)
+
+    def may_run(self, task: ScheduledTask) -> bool:
+        return not task.singleton or self.workers is None or self.workers.is_leader
+
+    def persists(self, task: ScheduledTask) -> bool:
+        ''' whether this process saves (and resumes) the task's schedule '''
+        return task.singleton or self.workers is None or self.workers.is_leader
+
+    async def check_leadership(self):
+        ''' on becoming the leader, pick up the singleton tasks' schedules from the previous leader '''
+        if self.workers is None: return
+        if self.workers.is_leader and not self._was_leader:
+            await self.load_state([t.name for t in self.tasks.values() if t.singleton])
+        self._was_leader = self.workers.is_leader
+
+    async def run_task(self, task: ScheduledTask):
+        s = self.state[task.name]
+        start = time.time()
+        try:
+            with task.job.stage(task.name):
+                await asyncio.wait_for(task.run(), task.timeout)
+            s.update(last_ok=True, last_error=None, failures=0)
+        except asyncio.TimeoutError:
+            self.task_failed(task, f"timed out after {task.timeout}s")
+        except Exception as e:
+            self.task_failed(task, str(e))
+            traceback.print_exception(e, limit=3)
+        finally:
+            s.update(running=s['running'] - 1, runs=s['runs'] + 1, last_finished_at=time.time(), last_seconds=time.time() - start)
+            await self.save_state(task.name)
+
+    def task_failed(self, task: ScheduledTask, error: str):
+        s = self.state[task.name]
+        s.update(last_ok=False, last_error=error[:500], failures=s['failures'] + 1)
+        delay = task.retry_delay(s['failures'])
+        s['next_run_at'] = time.time() + delay
+        logging.warning(f"scheduler {self.name}: {task.name} failed ({s['failures']} in a row), retrying in {delay:.0f}s: {error}")
+
+    async def close_to_cotd(self) -> bool:
+        now = time.time()
+        if now - self._cotd['checked_at'] > COTD_CHECK_CACHE_SECONDS:
+            self._cotd.update(close=await is_close_to_cotd(), checked_at=now)
+        return self._cotd['close']
+
+    def cv_name(self, task_name: str) -> str:
+        return SCHEDULE_CV_NAME_FMT.format(name=self.name, task=task_name)
+
+    async def load_saved(self, names: list[str]) -> dict:
+        ''' {task name: saved state} for the tasks in `names` that have one '''
+        by_cv_name = {self.cv_name(n): n for n in names}
+        try:
+            return {by_cv_name[cv.name]: json.loads(cv.value) async for cv in CachedValue.objects.filter(name__in=list(by_cv_name.keys()))}
+        except Exception as e:
+            logging.warning(f"scheduler {self.name}: failed to load saved schedule: {e}")
+            return dict()
+
+    async def load_state(self, names: list[str] | None = None):
+        ''' resume saved schedules (of `names`, default all tasks whose schedule this process keeps); tasks without one are due now '''
+        names = [n for n in self.state.keys() if self.persists(self.tasks[n])] if names is None else names
+        saved = await self.load_saved(names)
+        for name in names:
+            s = self.state[name]
+            prev = saved.get(name, dict())
+            s.update({k: v for k, v in prev.items() if k in s and k != 'running'})
+        logging.info(f"scheduler {self.name}: next runs in {({n: max(0, int((self.state[n]['next_run_at'] or 0) - time.time())) for n in names})}s")
+
+    async def save_state(self, name: str):
+        ''' saves the schedule of the task that just ran, one row per task (see persists for the tasks every process runs) '''
+        if not self.persists(self.tasks[name]): return
+        try:
+            await CachedValue.objects.aupdate_or_create({'value': json.dumps(self.state[name])}, name=self.cv_name(name))
+        except Exception as e:
+            logging.warning(f"scheduler {self.name}: failed to save schedule for {name}: {e}")
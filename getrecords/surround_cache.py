@@ -0,0 +1,115 @@
+from bisect import bisect_left
+import logging
+import time
+
+from django.core.cache import cache
+
+from getrecords.nadeoapi import get_map_records, nadeo_get_surround_for_map
+from getrecords.utils import run_async
+from mapmonitor.metrics import record_cache
+
+
+# Leaderboard windows per map: every surround response (and any prefetched top-N) is a run of consecutive records.
+# A later request whose score lands inside a stored window is answered from it instead of asking nadeo again.
+
+SURROUND_CACHE_TTL = 300
+SURROUND_CACHE_KEY_FMT = "surround:{map_uid}"
+SURROUND_STATS_KEY_FMT = "surround-stats:{name}"
+MAX_WINDOWS_PER_MAP = 32
+
+
+def get_surround(map_uid: str, score: int) -> dict | None:
+    ''' same shape as nadeo's surround/1/1 response '''
+    entry = load_entry(map_uid)
+    if entry is not None:
+        for window in entry['windows']:
+            top = surround_from_window(window, score)
+            if top is not None:
+                incr_stat('hits')
+                return build_response(entry['meta'], top)
+    incr_stat('misses')
+    resp = run_async(nadeo_get_surround_for_map(map_uid, score))
+    if resp is not None:
+        store_window(map_uid, resp)
+    return resp
+
+
+def surround_from_window(window: dict, score: int) -> list[dict] | None:
+    ''' the record before where `score` would rank, the one at it, and the one after -- if the window covers all three '''
+    records = window['records']
+    k = bisect_left([r['score'] for r in records], score)
+    starts_at_top = len(records) > 0 and records[0]['position'] == 1
+    if k - 1 < 0 and not starts_at_top: return None
+    if k + 1 >= len(records): return None
+    return records[max(0, k - 1):k + 2]
+
+
+def build_response(meta: dict, top: list[dict]) -> dict:
+    return dict(groupUid=meta['groupUid'], mapUid=meta['mapUid'], tops=[dict(zoneId=meta['zoneId'], zoneName=meta['zoneName'], top=top)])
+
+
+def store_window(map_uid: str, resp: dict, records: list[dict] | None = None):
+    ''' records defaults to the (world) records in resp; they must be consecutive leaderboard entries '''
+    try:
+        tops = resp['tops'][0]
+        if records is None: records = tops['top']
+        meta = dict(groupUid=resp.get('groupUid'), mapUid=resp.get('mapUid', map_uid), zoneId=tops.get('zoneId'), zoneName=tops.get('zoneName'))
+    except (KeyError, IndexError, TypeError) as e:
+        logging.warning(f"surround cache: unexpected response for {map_uid}: {e}")
+        return
+    if len(records) == 0: return
+    entry = load_entry(map_uid) or dict(meta=meta, windows=[])
+    entry['meta'] = meta
+    entry['windows'] = [dict(ts=time.time(), records=records)] + entry['windows'][:MAX_WINDOWS_PER_MAP - 1]
+    try:
+        cache.set(SURROUND_CACHE_KEY_FMT.format(map_uid=map_uid), entry, SURROUND_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"surround cache set failed: {e}")
+
+
+def load_entry(map_uid: str) -> dict | None:
+    try:
+        entry = cache.get(SURROUND_CACHE_KEY_FMT.format(map_uid=map_uid))
+    except Exception as e:
+        logging.warning(f"surround cache get failed: {e}")
+        return None
+    if entry is None: return None
+    # the whole entry's TTL is bumped on every store, so drop individual windows that are too old
+    entry['windows'] = [w for w in entry['windows'] if time.time() - w['ts'] < SURROUND_CACHE_TTL]
+    return entry
+
+
+async def prefetch_top(map_uid: str, nb_records: int) -> int:
+    ''' fetches the top nb_records (in pages of 100) and stores them as one window; returns how many were stored '''
+    resp = None
+    records = []
+    for offset in range(0, nb_records, 100):
+        page = await get_map_records(map_uid, length=min(100, nb_records - offset), offset=offset)
+        if page is None or len(page.get('tops', [])) == 0: break
+        resp = page
+        page_records = page['tops'][0]['top']
+        records.extend(page_records)
+        if len(page_records) < 100: break
+    if resp is not None:
+        store_window(map_uid, resp, records)
+    return len(records)
+
+
+def incr_stat(name: str):
+    record_cache('surround', hits=int(name == 'hits'), misses=int(name == 'misses'))
+    key = SURROUND_STATS_KEY_FMT.format(name=name)
+    try:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+    except Exception as e:
+        logging.warning(f"surround stats incr failed: {e}")
+
+
+def get_stats() -> dict:
+    try:
+        hits = cache.get(SURROUND_STATS_KEY_FMT.format(name='hits'), 0)
+        misses = cache.get(SURROUND_STATS_KEY_FMT.format(name='misses'), 0)
+    except Exception as e:
+        logging.warning(f"surround stats get failed: {e}")
+        hits = misses = 0
+    return dict(hits=hits, misses=misses, hit_ratio=hits / max(1, hits + misses))
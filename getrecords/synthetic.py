@@ -0,0 +1,175 @@
+from itertools import accumulate
+import random
+import time
+from typing import Iterable
+
+from django.db import models
+
+from getrecords.models import CotdChallenge, CotdChallengeRanking, MapTotalPlayers, TmxMap, TmxMapAT, TmxMapScrapeState
+from getrecords.utils import chunk
+from mapalitics.models import MapaliticsToken, TrackEvent, User as MapaliticsUser, Zone
+
+
+# Synthetic data for benchmarks (see the gen_synthetic_data and run_benchmarks commands). Rows come from a seeded
+# Random, so the same arguments on an empty db give the same data. Ids continue from the highest existing ones.
+
+BATCH_SIZE = 5000
+# keeps `field__in=[...]` lookups under sqlite's limit on sql variables
+IN_CHUNK_SIZE = 20_000
+
+SYNTHETIC_COTD_CHALLENGE_ID_START = 9_000_000
+SYNTHETIC_MAPALITICS_TOKEN = "synthetic-benchmark-token"
+# type -> relative frequency
+TRACK_EVENT_TYPES = {'MapLoad': 2, 'Restart': 10, 'Respawn': 20, 'Checkpoint': 60, 'Finish': 5}
+VEHICLES = ['CarSport', 'CarSnow', 'CarRally', 'CarDesert']
+LENGTHS = ['15 secs', '30 secs', '45 secs', '1 min', '1 m 30 s', '2 min', '3 min', '5 min', 'Long']
+ZONES = ['World', 'World|Europe|France', 'World|Europe|Germany', 'World|North America|United States', 'World|Oceania|Australia']
+
+
+def bulk_create_batched(model: type[models.Model], objs: Iterable[models.Model], batch_size: int = BATCH_SIZE) -> int:
+    ''' bulk_create without holding all of objs in memory '''
+    n = 0
+    batch = []
+    for o in objs:
+        batch.append(o)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            n += len(batch)
+            batch = []
+    if len(batch) > 0:
+        model.objects.bulk_create(batch)
+        n += len(batch)
+    return n
+
+
+def next_id(model: type[models.Model], field: str) -> int:
+    return (model.objects.order_by(f"-{field}").values_list(field, flat=True).first() or 0) + 1
+
+
+def create_synthetic_maps(n: int, comments: str = "synthetic map for benchmarks", rng: random.Random | None = None) -> list[int]:
+    ''' TrackIDs of the new maps; with an rng, maps get varied types, tags, vehicles and lengths '''
+    start_id = next_id(TmxMap, 'TrackID')
+    track_ids = list(range(start_id, start_id + n))
+    bulk_create_batched(TmxMap, (synthetic_map(tid, comments, rng) for tid in track_ids))
+    return track_ids
+
+
+def set_scraped_up_to_latest_map():
+    ''' random map search picks TrackIDs up to the main scrape state's LastScraped '''
+    latest = next_id(TmxMap, 'TrackID') - 1
+    TmxMapScrapeState.objects.update_or_create(dict(LastScraped=latest), Name="main")
+
+
+def synthetic_map(tid: int, comments: str, rng: random.Random | None) -> TmxMap:
+    m = TmxMap(
+        TrackID=tid, UserID=tid % 1000, Username=f"user{tid % 1000}", AuthorLogin=f"login{tid % 1000}",
+        Name=f"Map {tid}", GbxMapName=f"$s$oMap {tid}", TrackUID=f"uid{tid:020d}", TitlePack="TMStadium",
+        ExeVersion="3.3.0", ExeBuild="2023-03-24_13_17", Mood="Day", ModName=None, AuthorTime=40000 + tid,
+        ParserVersion=1, UploadedAt="2023-06-01T12:00:00.123", UpdatedAt="2023-06-02T12:00:00",
+        Tags="1,5,23", TypeName="Race", StyleName="Tech", RouteName="Single", LengthName="1 min", DifficultyName="Advanced",
+        Laps=1, Comments=comments, Downloadable=True, Unlisted=False, Unreleased=False,
+        VehicleName="CarSport", EnvironmentName="Stadium", HasScreenshot=False, HasThumbnail=True,
+        MapType="TrackMania\\TM_Race", RatingVoteAverage=4.5,
+    )
+    if rng is not None:
+        # ~10% aren't race maps, like on TMX
+        if rng.random() < 0.1:
+            m.MapType = rng.choice(["TrackMania\\TM_Royal", "TrackMania\\TM_Platform", "TrackMania\\TM_Stunt"])
+        m.Tags = ','.join(map(str, sorted(rng.sample(range(1, 45), rng.randint(1, 4)))))
+        m.VehicleName = VEHICLES[0] if rng.random() < 0.85 else rng.choice(VEHICLES[1:])
+        m.LengthName = rng.choice(LENGTHS)
+        m.AuthorTime = rng.randint(8_000, 300_000)
+        m.UploadedAt = m.UpdatedAt = f"20{20 + tid % 5}-{1 + tid % 12:02d}-{1 + tid % 28:02d}T12:00:00.123"
+        m.RatingVoteAverage = round(rng.uniform(0, 5), 2)
+    return m
+
+
+def create_synthetic_map_ats(track_ids: list[int], rng: random.Random, beaten_frac: float = 0.6) -> int:
+    ''' a TmxMapAT per map: some beaten (by a pool of players), a few broken or removed from TMX, the rest unbeaten '''
+    players = [f"player{i}" for i in range(2000)]
+    now = time.time()
+    def gen():
+        for tids in chunk(track_ids, IN_CHUNK_SIZE):
+            for pk in TmxMap.objects.filter(TrackID__in=tids).order_by('TrackID').values_list('pk', flat=True):
+                at = TmxMapAT(Track_id=pk, LastChecked=now - rng.uniform(0, 86400 * 14), WR=rng.randint(8_000, 300_000))
+                r = rng.random()
+                if r < beaten_frac:
+                    at.AuthorTimeBeaten = True
+                    at.ATBeatenTimestamp = int(now - rng.uniform(0, 86400 * 365))
+                    at.ATBeatenUsers = rng.choice(players)
+                    at.ATBeatenFirstNb = 1
+                elif r < beaten_frac + 0.01:
+                    at.Broken = True
+                elif r < beaten_frac + 0.02:
+                    at.RemovedFromTmx = True
+                yield at
+    return bulk_create_batched(TmxMapAT, gen())
+
+
+def create_synthetic_nb_players(track_ids: list[int], rng: random.Random) -> int:
+    ''' fresh MapTotalPlayers rows, so the cache builders don't ask nadeo for player counts '''
+    now = int(time.time())
+    existing = set()
+    for tids in chunk(track_ids, IN_CHUNK_SIZE):
+        uids = [f"uid{tid:020d}" for tid in tids]
+        existing.update(MapTotalPlayers.objects.filter(uid__in=uids).values_list('uid', flat=True))
+    return bulk_create_batched(MapTotalPlayers, (
+        MapTotalPlayers(uid=f"uid{tid:020d}", nb_players=rng.randint(1, 50_000), created_ts=now, updated_ts=now)
+        for tid in track_ids if f"uid{tid:020d}" not in existing
+    ))
+
+
+def create_synthetic_cotd(nb_challenges: int, nb_players: int, nb_snapshots: int, rng: random.Random) -> list[CotdChallenge]:
+    ''' COTD qualis with nb_snapshots full ranking snapshots each (like cotd_quali_cache saves every 20s) '''
+    start_id = max(SYNTHETIC_COTD_CHALLENGE_ID_START, next_id(CotdChallenge, 'challenge_id'))
+    end = int(time.time()) - 86400
+    challenges = []
+    for i in range(nb_challenges):
+        start_date = end - 86400 * (nb_challenges - i)
+        c = CotdChallenge(challenge_id=start_id + i, uid=f"cotd{start_id + i:023d}", name=f"COTD synthetic #{i}",
+                          leaderboard_id=start_id + i, start_date=start_date, end_date=start_date + 900)
+        c.save()
+        challenges.append(c)
+        players = [f"{rng.getrandbits(128):032x}" for _ in range(nb_players)]
+        def gen():
+            for s in range(nb_snapshots):
+                # players join over the quali, so later snapshots are bigger
+                n = max(1, nb_players * (s + 1) // nb_snapshots)
+                scores = sorted(rng.randint(40_000, 90_000) for _ in range(n))
+                for rank, (score, player) in enumerate(zip(scores, players[:n]), start=1):
+                    yield CotdChallengeRanking(challenge=c, req_timestamp=c.start_date + 20 * (s + 1), score=score, rank=rank, player=player)
+        bulk_create_batched(CotdChallengeRanking, gen())
+    return challenges
+
+
+def create_synthetic_track_events(nb_events: int, track_ids: list[int], rng: random.Random, nb_users: int = 2000, nb_maps: int = 500) -> int:
+    ''' mapalitics TrackEvents spread (unevenly) over nb_maps of track_ids '''
+    zones = [Zone.objects.get_or_create(zone_path=z)[0] for z in ZONES]
+    start_user = next_id(MapaliticsUser, 'id')
+    MapaliticsUser.objects.bulk_create([MapaliticsUser(wsid=f"synthetic-{start_user + i}", display_name=f"Player {start_user + i}") for i in range(nb_users)])
+    user_ids = list(MapaliticsUser.objects.filter(wsid__startswith="synthetic-").values_list('id', flat=True))
+    maps = [(f"uid{tid:020d}", rng.randint(3, 30)) for tid in rng.sample(track_ids, min(nb_maps, len(track_ids)))]
+    # a few maps get most of the events
+    map_cum_weights = list(accumulate(1 / (i + 1) for i in range(len(maps))))
+    types, type_cum_weights = list(TRACK_EVENT_TYPES), list(accumulate(TRACK_EVENT_TYPES.values()))
+    now = int(time.time())
+    def gen():
+        for i in range(nb_events):
+            map_uid, nb_cps = rng.choices(maps, cum_weights=map_cum_weights)[0]
+            ty = rng.choices(types, cum_weights=type_cum_weights)[0]
+            cp = nb_cps if ty == 'Finish' else rng.randint(0, nb_cps)
+            yield TrackEvent(
+                user_id=rng.choice(user_ids), created_ts=now - (nb_events - i), type=ty, map_uid=map_uid,
+                race_time=rng.randint(1000, 120_000) if ty in ('Checkpoint', 'Finish') else -1, cp_count=cp,
+                vx=rng.uniform(-100, 100), vy=rng.uniform(-100, 100), vz=rng.uniform(-100, 100),
+                px=rng.uniform(0, 1500), py=rng.uniform(0, 300), pz=rng.uniform(0, 1500), zone=rng.choice(zones),
+            )
+    return bulk_create_batched(TrackEvent, gen())
+
+
+def get_or_create_synthetic_mapalitics_token() -> MapaliticsToken:
+    token = MapaliticsToken.objects.filter(token=SYNTHETIC_MAPALITICS_TOKEN).first()
+    if token is None:
+        user, _ = MapaliticsUser.objects.get_or_create(wsid="synthetic-bench", defaults=dict(display_name="Synthetic Bench"))
+        token = MapaliticsToken.objects.create(token=SYNTHETIC_MAPALITICS_TOKEN, user=user)
+    return token
@@ -1,3 +1,129 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from getrecords.job_telemetry import merge_job_docs, new_stage_doc
+from getrecords.surround_cache import surround_from_window
+from getrecords.utils import dumps_json, json_parts
+
+
+def make_window(scores: list[int], first_position: int = 1) -> dict:
+    return dict(ts=0, records=[dict(position=first_position + i, score=score, accountId=f"acct{first_position + i}") for i, score in enumerate(scores)])
+
+
+def positions(records: list[dict] | None) -> list[int] | None:
+    return None if records is None else [r['position'] for r in records]
+
+
+class SurroundFromWindowTests(SimpleTestCase):
+    def test_score_inside_window(self):
+        window = make_window([100, 200, 300, 400, 500], first_position=11)
+        self.assertEqual(positions(surround_from_window(window, 300)), [12, 13, 14])
+        # between two records: the one before it, and the two after (where it would rank)
+        self.assertEqual(positions(surround_from_window(window, 250)), [12, 13, 14])
+
+    def test_first_record_of_window(self):
+        # nothing known before the window's first record unless it's the WR
+        self.assertIsNone(surround_from_window(make_window([100, 200, 300], first_position=11), 100))
+        self.assertIsNone(surround_from_window(make_window([100, 200, 300], first_position=11), 50))
+        self.assertEqual(positions(surround_from_window(make_window([100, 200, 300]), 100)), [1, 2])
+        self.assertEqual(positions(surround_from_window(make_window([100, 200, 300]), 50)), [1, 2])
+
+    def test_last_records_of_window(self):
+        window = make_window([100, 200, 300, 400], first_position=11)
+        # the record after it isn't in the window
+        self.assertIsNone(surround_from_window(window, 400))
+        self.assertIsNone(surround_from_window(window, 350))
+        self.assertEqual(positions(surround_from_window(window, 300)), [12, 13, 14])
+
+    def test_score_outside_window(self):
+        window = make_window([100, 200, 300], first_position=11)
+        self.assertIsNone(surround_from_window(window, 301))
+        self.assertIsNone(surround_from_window(window, 99))
+
+    def test_ties(self):
+        # a score equal to a run of tied records ranks at the first of them
+        window = make_window([100, 200, 200, 200, 300], first_position=11)
+        self.assertEqual(positions(surround_from_window(window, 200)), [11, 12, 13])
+        window = make_window([200, 200, 200, 300])
+        self.assertEqual(positions(surround_from_window(window, 200)), [1, 2])
+        self.assertIsNone(surround_from_window(make_window([100, 200, 200], first_position=11), 200 + 1))
+
+    def test_tiny_and_empty_windows(self):
+        self.assertIsNone(surround_from_window(make_window([]), 100))
+        self.assertIsNone(surround_from_window(make_window([100]), 100))
+        self.assertIsNone(surround_from_window(make_window([100], first_position=11), 50))
+
+
+def joined_json(obj, chunk_size: int = 3):
+    return json.loads(''.join(json_parts(obj, chunk_size)))
+
+
+class JsonPartsTests(SimpleTestCase):
+    def test_big_list(self):
+        for n in [0, 1, 3, 4, 6, 7, 100]:
+            obj = [[i, f"uid{i}", i * 1.5, None, True] for i in range(n)]
+            self.assertEqual(joined_json(obj), obj)
+        self.assertEqual(joined_json(list(range(100)), chunk_size=1), list(range(100)))
+
+    def test_big_dict(self):
+        obj = {f"key{i}": dict(n=i, name=f"map \"{i}\"") for i in range(50)}
+        self.assertEqual(joined_json(obj), obj)
+        self.assertEqual(list(joined_json(obj).keys()), list(obj.keys()))
+
+    def test_nested_small_dicts(self):
+        obj = dict(ts=1.5, tracks=[[i, f"uid{i}"] for i in range(10)], nested=dict(a=dict(b=list(range(7)), c=dict()), d=[]), empty=dict())
+        self.assertEqual(joined_json(obj), obj)
+        self.assertEqual(joined_json(dict()), dict())
+
+    def test_int_keys(self):
+        # like json.dumps, int keys become strings
+        small = {1: "a", 2: [1, 2]}
+        big = {i: f"uid{i}" for i in range(20)}
+        for obj in [small, big, dict(by_id=big)]:
+            self.assertEqual(joined_json(obj), json.loads(json.dumps(obj)))
+
+    def test_scalars(self):
+        for obj in [None, 1, 1.5, "a \u00e9 \"q\"", True]:
+            self.assertEqual(joined_json(obj), obj)
+
+
+class DumpsJsonTests(SimpleTestCase):
+    def test_like_json_dumps_without_spaces(self):
+        obj = {1: [1.5, "a \u00e9"], "b": None}
+        self.assertEqual(dumps_json(obj), json.dumps(obj, separators=(',', ':'), ensure_ascii=False))
+
+    def test_nan_is_null(self):
+        self.assertEqual(dumps_json([float('nan'), float('inf')]), '[null,null]')
+
+    def test_big_int_falls_back_to_json(self):
+        self.assertEqual(dumps_json(dict(n=2**70)), '{"n":%d}' % 2**70)
+
+
+def job_doc(process: str, updated_at: float, **stages) -> dict:
+    return dict(name='tmx_scraper', process=process, pid=1, started_at=0.0, updated_at=updated_at, run=dict(started_at=updated_at),
+                last_success_at=updated_at, runs_total=2, failures_total=1, stages=stages, queues=dict(q=int(updated_at)),
+                loop_lag=dict(max_seconds=updated_at / 10, blocked_total=3))
+
+
+def stage(last_started_at: float, items: int) -> dict:
+    return dict(new_stage_doc(), last_started_at=last_started_at, items=items, items_total=items, errors_total=1)
+
+
+class MergeJobDocsTests(SimpleTestCase):
+    def test_totals_are_summed_and_latest_wins(self):
+        merged = merge_job_docs([job_doc('b', 20.0, scrape=stage(5.0, 7)), job_doc('a', 10.0, scrape=stage(8.0, 3), only_a=stage(1.0, 1))])
+        self.assertEqual((merged['runs_total'], merged['failures_total'], merged['updated_at']), (4, 2, 20.0))
+        self.assertEqual((merged['last_success_at'], merged['run'], merged['queues']), (20.0, dict(started_at=20.0), dict(q=20)))
+        self.assertEqual(merged['loop_lag'], dict(max_seconds=2.0, blocked_total=6))
+        scrape = merged['stages']['scrape']
+        # a started the stage last, so its latest run's items; totals over both
+        self.assertEqual((scrape['items'], scrape['items_total'], scrape['errors_total']), (3, 10, 2))
+        self.assertEqual(merged['stages']['only_a']['items'], 1)
+        self.assertEqual(sorted(merged['processes']), ['a', 'b'])
+        self.assertNotIn('stages', merged['processes']['a'])
+
+    def test_single_doc(self):
+        doc = job_doc('a', 10.0, scrape=stage(5.0, 7))
+        merged = merge_job_docs([doc])
+        self.assertEqual((merged['runs_total'], merged['stages']['scrape']['items']), (2, 7))
@@ -0,0 +1,173 @@
+import asyncio
+from collections import OrderedDict
+import logging
+import random
+import threading
+import time
+
+from django.core.cache import cache
+
+from getrecords.models import TmxMap
+from mapmonitor.metrics import record_cache
+from mapmonitor.settings import TMX_MAP_LRU_SIZE
+
+
+# Read-through cache of TmxMap records (the dicts model_to_dict / TmxMap.objects.api_dicts() give), keyed by TrackID.
+# Two tiers: an in-process LRU in front of redis, in front of the db.
+# Each map has its own version stamp in redis; writes (update_tmx_map, bulk upserts) call invalidate_tmx_maps, which gives
+# just those maps a new stamp. Redis records are stored with the stamp that was current before the db read, and read
+# together with the current stamp, so a record read before a write but cached after it (the invalidation landed in
+# between) is ignored instead of being served for the whole TTL.
+# LRU entries also carry their stamp, which is re-checked against redis at most every VERSION_CHECK_SECONDS, so other
+# processes see a change within that long, and a write only drops the maps it touched.
+
+TMX_MAP_CACHE_TTL = 86400
+TMX_MAP_KEY_FMT = "tmx-map:{tid}"
+# no TTL: if a stamp expired, a record cached (with no stamp) by a slow reader before the write could become current again
+TMX_MAP_VERSION_KEY_FMT = "tmx-map-version:{tid}"
+VERSION_CHECK_SECONDS = 2.0
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.evictions = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_lru = LRUCache(TMX_MAP_LRU_SIZE)
+_stats = dict(lru_hits=0, redis_hits=0, misses=0, invalidations=0)
+
+
+def get_tmx_map_record(track_id: int) -> dict | None:
+    return get_tmx_map_records([track_id]).get(track_id)
+
+
+def get_tmx_map_records(track_ids: list[int]) -> dict[int, dict]:
+    ''' {TrackID: record} for the maps that exist; insertion order follows track_ids '''
+    track_ids = list(dict.fromkeys(track_ids))
+    now = time.time()
+    found: dict[int, dict] = dict()
+    # LRU entries are (version, record, checked_at)
+    to_check: dict[int, tuple] = dict()
+    for tid in track_ids:
+        entry = _lru.get(tid)
+        if entry is None:
+            continue
+        if now - entry[2] <= VERSION_CHECK_SECONDS:
+            found[tid] = entry[1]
+        else:
+            to_check[tid] = entry
+    missing = [tid for tid in track_ids if tid not in found]
+    versions, from_redis = None, dict()
+    if len(missing) > 0:
+        got = redis_get_records(missing, [tid for tid in missing if tid not in to_check])
+        if got is None:
+            # can't check the stamps, so keep serving what we have
+            for tid, entry in to_check.items():
+                found[tid] = entry[1]
+        else:
+            versions, from_redis = got
+            for tid, entry in to_check.items():
+                if versions[tid] == entry[0]:
+                    _lru.put(tid, (entry[0], entry[1], now))
+                    found[tid] = entry[1]
+                else:
+                    _lru.pop(tid)
+    nb_lru_hits = len(found)
+    _stats['lru_hits'] += nb_lru_hits
+    _stats['redis_hits'] += len(from_redis)
+    record_cache('tmx_map_lru', hits=nb_lru_hits, misses=len(track_ids) - nb_lru_hits)
+    record_cache('tmx_map_redis', hits=len(from_redis), misses=len(track_ids) - nb_lru_hits - len(from_redis))
+    for tid, record in from_redis.items():
+        _lru.put(tid, (versions[tid], record, now))
+        found[tid] = record
+    missing = [tid for tid in track_ids if tid not in found]
+    if len(missing) > 0:
+        _stats['misses'] += len(missing)
+        from_db = {r['TrackID']: r for r in TmxMap.objects.filter(TrackID__in=missing).api_dicts()}
+        # tagged with the stamps from before the db read: if a write lands in between, these are ignored
+        if versions is not None:
+            redis_set_records({tid: (versions[tid], record) for tid, record in from_db.items()})
+            for tid, record in from_db.items():
+                _lru.put(tid, (versions[tid], record, now))
+        found.update(from_db)
+    return {tid: dict(found[tid]) for tid in track_ids if tid in found}
+
+
+def redis_get_records(track_ids: list[int], with_records: list[int]) -> tuple[dict, dict] | None:
+    ''' ({TrackID: version stamp} for track_ids, {TrackID: record} for the with_records whose record is current); None if redis failed '''
+    version_keys = {tid: TMX_MAP_VERSION_KEY_FMT.format(tid=tid) for tid in track_ids}
+    record_keys = {tid: TMX_MAP_KEY_FMT.format(tid=tid) for tid in with_records}
+    try:
+        cached = cache.get_many(list(version_keys.values()) + list(record_keys.values()))
+    except Exception as e:
+        logging.warning(f"tmx map cache get failed: {e}")
+        return None
+    versions = {tid: cached.get(key) for tid, key in version_keys.items()}
+    records = dict()
+    for tid, key in record_keys.items():
+        entry = cached.get(key)
+        if entry is not None and entry[0] == versions[tid]:
+            records[tid] = entry[1]
+    return versions, records
+
+
+def redis_set_records(entries: dict[int, tuple]):
+    ''' entries: {TrackID: (version stamp, record)} '''
+    if len(entries) == 0: return
+    try:
+        cache.set_many({TMX_MAP_KEY_FMT.format(tid=tid): entry for tid, entry in entries.items()}, TMX_MAP_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"tmx map cache set failed: {e}")
+
+
+def invalidate_tmx_maps(track_ids: list[int]):
+    ''' call after writing TmxMap rows (including queryset .update()s and bulk upserts, which don't go through save) '''
+    if len(track_ids) == 0: return
+    _stats['invalidations'] += len(track_ids)
+    for tid in track_ids:
+        _lru.pop(tid)
+    try:
+        cache.set_many({TMX_MAP_VERSION_KEY_FMT.format(tid=tid): random.getrandbits(63) for tid in track_ids}, None)
+        cache.delete_many([TMX_MAP_KEY_FMT.format(tid=tid) for tid in track_ids])
+    except Exception as e:
+        logging.warning(f"tmx map cache invalidate failed: {e}")
+
+
+async def ainvalidate_tmx_maps(track_ids: list[int]):
+    await asyncio.to_thread(invalidate_tmx_maps, track_ids)
+
+
+async def aget_tmx_map_record(track_id: int) -> dict | None:
+    return await asyncio.to_thread(get_tmx_map_record, track_id)
+
+
+def get_stats() -> dict:
+    ''' for this process '''
+    lookups = _stats['lru_hits'] + _stats['redis_hits'] + _stats['misses']
+    return dict(**_stats, lru_evictions=_lru.evictions, lru_size=len(_lru), lru_max_size=_lru.max_size,
+                hit_ratio=(_stats['lru_hits'] + _stats['redis_hits']) / max(1, lookups))
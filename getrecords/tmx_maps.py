@@ -4,6 +4,7 @@ import logging
 
 from getrecords.http import get_session
 from getrecords.utils import run_async
+from mapmonitor.settings import TMX_BASE_URL
 
 
 """Length Enums:
@@ -79,8 +80,8 @@ async def update_tmx_tags_cached():
     global tmx_tags_cached
     try:
         async with get_session() as session:
-            logging.info(f"Updating tags cache [https://trackmania.exchange/api/tags/gettags]")
-            async with await session.get("https://trackmania.exchange/api/tags/gettags") as resp:
+            logging.info(f"Updating tags cache [{TMX_BASE_URL}/api/tags/gettags]")
+            async with await session.get(f"{TMX_BASE_URL}/api/tags/gettags") as resp:
                 if resp.ok:
                     data = await resp.json()
                     if data[0]["ID"] == 1:
@@ -23,6 +23,11 @@ urlpatterns = [
     path('kr5/results', views.get_kr5_cached_doc),
     path('kr5/maps', views.get_kr5_maps_cached_doc),
     path('kr5/map/<int:map_number>', views.get_kr5_map_lb_cached_doc),
+    # event leaderboards (see events.py)
+    path('events', views.list_events),
+    path('events/<str:slug>/results', views.get_event_cached_doc, dict(doc='results')),
+    path('events/<str:slug>/maps', views.get_event_cached_doc, dict(doc='maps')),
+    path('events/<str:slug>/map/<int:map_number>', views.get_event_cached_doc, dict(doc='map')),
 
     # old archivist stuff
     path('upload/ghost/<str:map_uid>/<int:score>', views.ghost_upload, name='upload-ghost'),
@@ -52,9 +57,14 @@ urlpatterns = [
     path(f'tmx/uid_to_tid_map', views.tmx_uid_to_tid_map),
     # path(f'debug/nb_dup_tids', views.debug_nb_dup_tids),
     path(f'debug/nb_track_types', views.debug_nb_track_types),
+    path(f'debug/surround_cache_stats', views.surround_cache_stats),
+    path(f'debug/tmx_map_cache_stats', views.tmx_map_cache_stats),
+    path(f'debug/map_info_batch_stats', views.map_info_batch_stats),
+    path(f'debug/jobs', views.debug_jobs),
 
     path(f'e++/icons/convert/webp', views.convert_webp_to_png),
     path(f'e++/icons/convert/rgba', views.convert_rgba_to_png),
+    path(f'e++/icons/convert/rgba/batch', views.convert_rgba_to_png_batch),
     path(f'e++/lm-analysis/convert/webp', views.lm_conversion_req),
 
     path(f'tmx/convert_webp', views.convert_tmx_webp_thumbnail),
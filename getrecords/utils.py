@@ -1,15 +1,18 @@
 
 import asyncio
 import hashlib
+import json
 from pathlib import Path
 import time
-from typing import Coroutine, Iterable
+from typing import Any, Callable, Coroutine, Iterable
 from contextlib import contextmanager
 import logging as log
 import os
 
+import orjson
 from django.core import serializers
-from django.db.models import Model
+from django.db.models import Field, Model
+from django.utils.encoding import is_protected_type
 
 
 @contextmanager
@@ -103,8 +106,103 @@ def sha_256_b_ts(bs: bytes, ts: int) -> str:
     return sha_256_b(hashlib.sha256(bs).digest() + str(ts).encode('UTF8'))
 
 
-def model_to_dict(m: Model):
-    return serializers.serialize('python', [m])[0]['fields']
+def model_to_dict(m: Model) -> dict:
+    ''' same output as serializers.serialize('python', [m])[0]['fields'], via per-model accessors built once '''
+    accessors = _model_field_accessors.get(type(m))
+    if accessors is None:
+        accessors = _model_field_accessors[type(m)] = compile_field_accessors(type(m))
+    if accessors is SERIALIZER_FALLBACK:
+        return serializers.serialize('python', [m])[0]['fields']
+    return {name: get(m) for name, get in accessors}
+
+
+SERIALIZER_FALLBACK = []
+_model_field_accessors: dict[type, list[tuple[str, Callable[[Model], Any]]]] = dict()
+# values of these types are output as-is by the serializer (django.utils.encoding.is_protected_type); str is handled per field
+_PROTECTED_EXACT_TYPES = {type(None), int, float, bool}
+
+
+def serialized_field_names(model: type[Model]) -> list[str]:
+    ''' the keys model_to_dict returns; for models without m2m fields, qs.values(*these) gives the same dicts '''
+    return [f.name for f in model._meta.concrete_model._meta.local_fields if f.serialize]
+
+
+def compile_field_accessors(model: type[Model]) -> list[tuple[str, Callable[[Model], Any]]]:
+    ''' the fields the python serializer would output, in its order: serializable local fields (FKs as their raw id) '''
+    opts = model._meta.concrete_model._meta
+    if any(f.serialize for f in opts.local_many_to_many):
+        # m2m values need a query per field; not worth duplicating, and none of our models have one
+        return SERIALIZER_FALLBACK
+    return [(f.name, field_accessor(f)) for f in opts.local_fields if f.serialize]
+
+
+def field_accessor(field: Field) -> Callable[[Model], Any]:
+    ''' equivalent to Serializer._value_from_field '''
+    if type(field).value_from_object is not Field.value_from_object:
+        return lambda m: value_from_field(m, field)
+    attname = field.attname
+    # Field.value_to_string is str(value), so a str value is already what it'd return
+    str_as_is = type(field).value_to_string is Field.value_to_string
+    def get(m: Model):
+        value = getattr(m, attname)
+        if type(value) in _PROTECTED_EXACT_TYPES or (str_as_is and type(value) is str):
+            return value
+        return value_from_field(m, field)
+    return get
+
+
+def value_from_field(m: Model, field: Field):
+    value = field.value_from_object(m)
+    if is_protected_type(value):
+        return value
+    return field.value_to_string(m)
+
+
+# Encoding the big cached docs (unbeaten ATs, track id -> uid, ...) with json.dumps blocked the bg jobs' event loop for
+# ~0.26 s each (the 150k-track unbeaten ATs doc). orjson is several times faster, but like json it holds the GIL for
+# the whole call, so a thread alone wouldn't let the loop run meanwhile. adumps_json encodes on a thread,
+# JSON_CHUNK_SIZE items of a big list/dict at a time, and the loop gets the GIL back between chunks.
+JSON_CHUNK_SIZE = 2000
+
+
+def dumps_json(obj) -> str:
+    ''' like json.dumps(obj) (non-str keys become strings) but without spaces, and NaN / Infinity become null (which
+        is valid JSON, unlike json's NaN). What orjson can't encode (ints beyond 64 bits) falls back to json.dumps. '''
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, separators=(',', ':'))
+
+
+def json_parts(obj, chunk_size: int = JSON_CHUNK_SIZE) -> Iterable[str]:
+    ''' dumps_json(obj) in pieces; big lists and dicts are encoded chunk_size items at a time, small dicts key by key '''
+    if isinstance(obj, list) and len(obj) > chunk_size:
+        yield '['
+        for i in range(0, len(obj), chunk_size):
+            if i > 0: yield ','
+            yield dumps_json(obj[i:(i+chunk_size)])[1:-1]
+        yield ']'
+    elif isinstance(obj, dict) and len(obj) > chunk_size:
+        items = list(obj.items())
+        yield '{'
+        for i in range(0, len(items), chunk_size):
+            if i > 0: yield ','
+            yield dumps_json(dict(items[i:(i+chunk_size)]))[1:-1]
+        yield '}'
+    elif isinstance(obj, dict):
+        yield '{'
+        for i, (k, v) in enumerate(obj.items()):
+            # '{"k":null}' -> '"k"'
+            yield (',' if i > 0 else '') + dumps_json({k: None})[1:-6] + ':'
+            yield from json_parts(v, chunk_size)
+        yield '}'
+    else:
+        yield dumps_json(obj)
+
+
+async def adumps_json(obj) -> str:
+    ''' dumps_json off the event loop; don't modify obj until it returns '''
+    return await asyncio.to_thread(lambda: ''.join(json_parts(obj)))
 
 
 
@@ -3,10 +3,14 @@ import asyncio
 import json
 import logging
 import time
-from getrecords.http import get_session
+from django.core.cache import cache
+from getrecords.http import get_session, http_head_okay_async
+from getrecords.map_info import get_map_info
 from getrecords.models import CachedValue, MapTotalPlayers, TmxMap, TmxMapAT
 from getrecords.nadeoapi import LOCAL_DEV_MODE, nadeo_get_nb_players_for_map
-from getrecords.utils import run_async
+from getrecords.tmx_map_cache import ainvalidate_tmx_maps, get_tmx_map_record, get_tmx_map_records
+from getrecords.utils import chunk, run_async
+from mapmonitor.settings import TMX_BASE_URL
 
 
 # 5 min
@@ -72,15 +76,12 @@ UNBEATEN_ATS_CV_NAME = "UnbeatenATs"
 RECENTLY_BEATEN_ATS_CV_NAME = "RecentlyBeatenATs"
 TRACK_UIDS_CV_NAME = "TrackIDToUID"
 CURRENT_COTD_KEY = "COTD_current"
-KR5_RESULTS_CV_NAME = "KR5Results"
-KR5_MAPS_CV_NAME = "KR5Maps"
-KR5_MAP_CV_NAME_FMT = "KR5Map_{0}"
 UNBEATEN_ATS_LEADERBOARD_CV_NAME = "UnbeatenATsLeaderboard"
 
 async def get_tmx_map(tid: int, timeout=1.5):
     async with get_session() as session:
         try:
-            async with session.get(f"https://trackmania.exchange/api/maps/get_map_info/multi/{tid}", timeout=timeout) as resp:
+            async with session.get(f"{TMX_BASE_URL}/api/maps/get_map_info/multi/{tid}", timeout=timeout) as resp:
                 if resp.status == 200:
                     maps = (await resp.json())
                     if len(maps) == 0: return None
@@ -96,7 +97,7 @@ async def get_tmx_map_pack_maps(mpid: int, secret: str | None = None):
     async with get_session() as session:
         try:
             sec_str = f"?secret={secret}" if secret else ""
-            async with session.get(f"https://trackmania.exchange/api/mappack/get_mappack_tracks/{mpid}{sec_str}") as resp:
+            async with session.get(f"{TMX_BASE_URL}/api/mappack/get_mappack_tracks/{mpid}{sec_str}") as resp:
                 if resp.status == 200:
                     return await resp.json()
                 else:
@@ -104,7 +105,7 @@ async def get_tmx_map_pack_maps(mpid: int, secret: str | None = None):
         except asyncio.TimeoutError as e:
             raise Exception(f"TMX timeout for get mappack maps {mpid}")
 
-CHANGE_MAP_STATUS_IN_MAPPACK = "https://trackmania.exchange/api/mappack/manage/{id}/map_status/{status}/{midstring}?secret={secret}"
+CHANGE_MAP_STATUS_IN_MAPPACK = TMX_BASE_URL + "/api/mappack/manage/{id}/map_status/{status}/{midstring}?secret={secret}"
 async def set_map_status_in_map_pack(mappack_id: int, status: int, track_id_or_uid: str, secret: str):
     ''' status: 0 accepted, 1 pending, rest see: <https://api2.mania.exchange/Enum/Index/11> '''
     async with get_session() as session:
@@ -121,7 +122,7 @@ async def set_map_status_in_map_pack(mappack_id: int, status: int, track_id_or_u
 async def add_map_to_tmx_map_pack(mpid: int, tid: int, api_key: str):
     async with get_session() as session:
         try:
-            async with session.post(f"https://trackmania.exchange/api/mappack/manage/{mpid}/add_map/{tid}?secret={api_key}") as resp:
+            async with session.post(f"{TMX_BASE_URL}/api/mappack/manage/{mpid}/add_map/{tid}?secret={api_key}") as resp:
                 if resp.status == 200:
                     return await resp.json()
                 else:
@@ -133,7 +134,7 @@ async def add_map_to_tmx_map_pack(mpid: int, tid: int, api_key: str):
 async def remove_map_from_tmx_map_pack(mpid: int, tid: int, api_key: str):
     async with get_session() as session:
         try:
-            async with session.delete(f"https://trackmania.exchange/api/mappack/manage/{mpid}/remove_map/{tid}?secret={api_key}") as resp:
+            async with session.delete(f"{TMX_BASE_URL}/api/mappack/manage/{mpid}/remove_map/{tid}?secret={api_key}") as resp:
                 if resp.status == 200:
                     return await resp.json()
                 else:
@@ -151,16 +152,115 @@ async def update_tmx_map(j: dict):
     if author_time < 0: author_time = -1
     if author_time > 4294967295: author_time = 4294967295
     j['AuthorTime'] = author_time
-    _map = await TmxMap.objects.filter(TrackID=tid).afirst()
-
     tmp_map = TmxMap(**j)
-    if _map is None:
-        await tmp_map.asave()
-    if _map is not None:
-        if not j.get('VehicleName', None):
-            j['VehicleName'] = "!Unknown!"
-        TmxMap.RemoveKeysFromTMX(j)
-        await TmxMap.objects.filter(TrackID=tid).aupdate(**j)
+    if not tmp_map.VehicleName:
+        tmp_map.VehicleName = "!Unknown!"
+    # an existing row only gets the columns tmx sent; an upsert, as the scraper tasks and the get_map_info fallback can
+    # save the same map at once
+    sent = dict(j, VehicleName=tmp_map.VehicleName)
+    TmxMap.RemoveKeysFromTMX(sent)
+    update_fields = [k for k in sent.keys() if k != 'TrackID']
+    await TmxMap.objects.abulk_create([tmp_map], update_conflicts=True, unique_fields=['TrackID'], update_fields=update_fields)
+    await ainvalidate_tmx_maps([tid])
+
+
+# get_map_info/multi: ids we don't have are looked up on tmx (at most this many per request, this many per tmx request)
+MULTI_TMX_FALLBACK_MAX_IDS = 100
+MULTI_TMX_FALLBACK_CHUNK = 20
+# short: this is on the request path, and on failure the view redirects the client to tmx anyway
+MULTI_TMX_FALLBACK_TIMEOUT = 2.0
+# ids tmx answered without (it doesn't have them) aren't asked for again for this long
+TMX_MAP_MISSING_TTL = 600
+TMX_MAP_MISSING_KEY_FMT = "tmx-map-missing:{tid}"
+# maps fetched by the fallback wait here for the scraper (save_tmx_fallback_maps) to save them, so requests don't write
+# to the db. The id list is racy (no CAS), but a map that drops off it is just fetched and queued again by the next request.
+TMX_FALLBACK_PENDING_IDS_KEY = "tmx-map-fallback-pending"
+TMX_FALLBACK_PENDING_KEY_FMT = "tmx-map-fallback-pending:{tid}"
+TMX_FALLBACK_PENDING_TTL = 3600
+TMX_FALLBACK_PENDING_MAX = 2000
+
+
+def get_map_infos_with_tmx_fallback(track_ids: list[int]) -> list[dict]:
+    ''' map records in request order; ids we don't have are fetched from tmx (concurrently), merged in, and queued to be saved '''
+    track_ids = list(dict.fromkeys(track_ids))
+    found = get_tmx_map_records(track_ids)
+    missing = [tid for tid in track_ids if tid not in found]
+    if len(missing) > 0:
+        try:
+            known_missing = cache.get_many([TMX_MAP_MISSING_KEY_FMT.format(tid=tid) for tid in missing])
+        except Exception as e:
+            logging.warning(f"tmx missing cache get failed: {e}")
+            known_missing = dict()
+        missing = [tid for tid in missing if TMX_MAP_MISSING_KEY_FMT.format(tid=tid) not in known_missing][:MULTI_TMX_FALLBACK_MAX_IDS]
+    if len(missing) > 0:
+        fetched, not_on_tmx = run_async(fetch_tmx_maps(missing))
+        try:
+            cache.set_many({TMX_MAP_MISSING_KEY_FMT.format(tid=tid): True for tid in not_on_tmx}, TMX_MAP_MISSING_TTL)
+        except Exception as e:
+            logging.warning(f"tmx missing cache set failed: {e}")
+        queue_tmx_fallback_maps(list(fetched.values()))
+        found.update(fetched)
+    return [found[tid] for tid in track_ids if tid in found]
+
+
+async def fetch_tmx_maps(track_ids: list[int]) -> tuple[dict[int, dict], list[int]]:
+    ''' ({TrackID: map} for the ids tmx had, ids tmx answered without); ids in failed chunks are in neither '''
+    async with get_session() as session:
+        async def fetch(tids: list[int]) -> tuple[list[int], list[dict]] | None:
+            url = f"{TMX_BASE_URL}/api/maps/get_map_info/multi/{','.join(map(str, tids))}"
+            try:
+                async with session.get(url, timeout=MULTI_TMX_FALLBACK_TIMEOUT) as resp:
+                    if resp.status == 200:
+                        return tids, await resp.json()
+                    logging.warning(f"tmx fallback for {len(tids)} maps: {resp.status} code")
+            except Exception as e:
+                logging.warning(f"tmx fallback for {len(tids)} maps failed: {e}")
+            return None
+        results = await asyncio.gather(*[fetch(list(c)) for c in chunk(track_ids, MULTI_TMX_FALLBACK_CHUNK)])
+    fetched = dict()
+    not_on_tmx = []
+    for result in results:
+        if result is None:
+            continue
+        tids, maps = result
+        for m in maps:
+            if m.get('TrackUID', None) is not None and m.get('TrackID', None) in tids:
+                fetched[m['TrackID']] = m
+        not_on_tmx.extend(tid for tid in tids if tid not in fetched)
+    return fetched, not_on_tmx
+
+
+def queue_tmx_fallback_maps(maps: list[dict]):
+    if len(maps) == 0: return
+    try:
+        cache.set_many({TMX_FALLBACK_PENDING_KEY_FMT.format(tid=m['TrackID']): m for m in maps}, TMX_FALLBACK_PENDING_TTL)
+        pending = cache.get(TMX_FALLBACK_PENDING_IDS_KEY) or []
+        new_ids = [m['TrackID'] for m in maps if m['TrackID'] not in pending]
+        if len(new_ids) > 0 and len(pending) < TMX_FALLBACK_PENDING_MAX:
+            cache.set(TMX_FALLBACK_PENDING_IDS_KEY, pending + new_ids, TMX_FALLBACK_PENDING_TTL)
+    except Exception as e:
+        logging.warning(f"tmx fallback queue failed: {e}")
+
+
+async def save_tmx_fallback_maps():
+    ''' saves the maps get_map_infos_with_tmx_fallback fetched (run by the scraper) '''
+    pending = await cache.aget(TMX_FALLBACK_PENDING_IDS_KEY) or []
+    if len(pending) == 0: return
+    maps = await cache.aget_many([TMX_FALLBACK_PENDING_KEY_FMT.format(tid=tid) for tid in pending])
+    saved = []
+    for m in maps.values():
+        try:
+            await update_tmx_map(m)
+            saved.append(m['TrackID'])
+        except Exception as e:
+            logging.warning(f"Failed to save tmx map {m.get('TrackID')} from fallback: {e}")
+    # saved maps, and ids whose queued map expired, come off the list; failed saves stay queued for the next run
+    failed = set(m['TrackID'] for m in maps.values()) - set(saved)
+    done = set(pending) - failed
+    await cache.adelete_many([TMX_FALLBACK_PENDING_KEY_FMT.format(tid=tid) for tid in saved])
+    pending_now = await cache.aget(TMX_FALLBACK_PENDING_IDS_KEY) or []
+    await cache.aset(TMX_FALLBACK_PENDING_IDS_KEY, [tid for tid in pending_now if tid not in done], TMX_FALLBACK_PENDING_TTL)
+    logging.info(f"Saved {len(saved)} of {len(pending)} tmx maps from the get_map_info fallback")
 
 
 def tmx_map_still_public(m: TmxMap) -> bool:
@@ -194,3 +294,61 @@ async def is_close_to_cotd(buffer_seconds=360):
     except Exception as e:
         logging.warn(f"Failed to read next COTD times: {e}")
     return False
+
+
+
+MAP_DL_CACHE_KEY_FMT = "map-dl:{mapid}"
+# where map_dl sends clients for tmx downloads; TMX_BASE_URL (which might be a load testing stand-in) is only probed
+TMX_PUBLIC_URL = "https://trackmania.exchange"
+MAP_DL_FOUND_TTL = 6 * 60 * 60
+MAP_DL_NOT_FOUND_TTL = 2 * 60
+
+
+def resolve_map_dl_url(mapid: int) -> tuple[str | None, str]:
+    ''' returns (url or None, source); the result (including not found) is cached per TrackID '''
+    key = MAP_DL_CACHE_KEY_FMT.format(mapid=mapid)
+    try:
+        cached = cache.get(key)
+    except Exception as e:
+        logging.warning(f"map_dl cache get failed: {e}")
+        cached = None
+    if cached is not None:
+        return cached['url'], cached['source']
+    track = get_tmx_map_record(mapid)
+    uid = track['TrackUID'] if track is not None else None
+    url, source = run_async(resolve_map_dl_url_async(mapid, uid))
+    try:
+        cache.set(key, dict(url=url, source=source), MAP_DL_FOUND_TTL if url is not None else MAP_DL_NOT_FOUND_TTL)
+    except Exception as e:
+        logging.warning(f"map_dl cache set failed: {e}")
+    return url, source
+
+
+async def resolve_map_dl_url_async(mapid: int, uid: str | None) -> tuple[str | None, str]:
+    ''' checks all sources at once; the first one that works, in preference order (tmx, nadeo, cgf), wins '''
+    async def tmx():
+        found = await http_head_okay_async(f"{TMX_BASE_URL}/maps/download/{mapid}")
+        return f"{TMX_PUBLIC_URL}/maps/download/{mapid}" if found else None
+    async def nadeo():
+        if uid is None: return None
+        info = await asyncio.to_thread(get_map_info, uid)
+        return None if info is None else info['fileUrl']
+    async def cgf():
+        # last because some are just a saved error page
+        url = f"https://cgf.s3.nl-1.wasabisys.com/{mapid}.Map.Gbx"
+        return url if await http_head_okay_async(url) else None
+    sources = [('tmx', tmx()), ('nadeo', nadeo()), ('cgf', cgf())]
+    tasks = [(name, asyncio.create_task(coro)) for name, coro in sources]
+    try:
+        for name, task in tasks:
+            try:
+                url = await task
+            except Exception as e:
+                logging.warning(f"map_dl: {name} lookup for {mapid} failed: {e}")
+                continue
+            if url is not None:
+                return url, name
+        return None, 'none'
+    finally:
+        for _, task in tasks:
+            task.cancel()
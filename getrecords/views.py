@@ -8,7 +8,6 @@ import operator
 from random import shuffle
 import time
 from typing import Coroutine, Optional
-from PIL import Image
 from io import BytesIO
 import numpy as np
 import zipfile
@@ -19,24 +18,32 @@ from django.db import IntegrityError
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponseRedirect, JsonResponse, HttpResponseNotAllowed, HttpRequest, HttpResponseForbidden, HttpResponse, HttpResponseNotFound, HttpResponseBadRequest, HttpResponsePermanentRedirect, FileResponse
 from django.core import serializers
-from django.db.models import Model, Q, Count
+from django.db.models import Model, Q, Count, Case, Exists, F, Value, When
 from django.utils import timezone
 from django.db import transaction
 from django.views.decorators.cache import cache_page
 
-from getrecords.http import get_session, http_head_okay, get_req_sync
+from getrecords.http import get_session, get_req_sync
+from getrecords.blob_cache import content_key
+from getrecords.images import ICON_BGRA_LEN, bgra_to_image, frame_bytes, icon_to_png, image_cache, webp_to_image, webp_to_png
+from getrecords.job_telemetry import get_jobs_status
+from getrecords.lightmaps import convert_lightmaps, get_lm_pool, parse_compress_level, read_lm_files
+from getrecords.map_info import get_map_info, get_stats as get_map_info_stats
 from getrecords.management.commands.tmx_scraper import get_scrape_state
 from getrecords.openplanet import ARCHIVIST_PLUGIN_ID, MAP_MONITOR_PLUGIN_ID, TokenResp, check_token, sha_256
 from getrecords.rmc_exclusions import EXCLUDE_FROM_RMC
 from getrecords.s3 import upload_ghost_to_s3
+from getrecords.surround_cache import get_stats as get_surround_stats, get_surround
+from getrecords.tmx_map_cache import get_stats as get_tmx_map_cache_stats, get_tmx_map_record
 from getrecords.tmx_maps import get_tmx_tags_cached, update_tmx_tag_lookup, update_tmx_tags_cached, tmx_tags_lookup
 from getrecords.utils import model_to_dict, parse_i32_list, parse_optional_int, run_async, sha_256_b_ts
-from mapmonitor.settings import CACHE_5_MIN, CACHE_8HRS_TTL, CACHE_COTD_TTL, CACHE_ICONS_TTL
+from mapmonitor.settings import CACHE_8HRS_TTL, CACHE_COTD_TTL
 
 from .models import CachedValue, Challenge, CotdChallenge, CotdChallengeRanking, CotdQualiTimes, Ghost, MapTotalPlayers, TmxMap, TmxMapAT, Track, TrackStats, User, UserStats, UserTrackPlay, model_to_dict_v2
-from .nadeoapi import LOCAL_DEV_MODE, core_get_maps_by_uid, get_and_save_all_challenge_records, nadeo_get_nb_players_for_map, nadeo_get_surround_for_map
+from .nadeoapi import LOCAL_DEV_MODE, get_and_save_all_challenge_records, nadeo_get_nb_players_for_map
 import getrecords.nadeoapi as nadeoapi
-from .view_logic import CURRENT_COTD_KEY, KR5_MAP_CV_NAME_FMT, KR5_MAPS_CV_NAME, KR5_RESULTS_CV_NAME, NB_PLAYERS_CACHE_SECONDS, NB_PLAYERS_MAX_CACHE_SECONDS, RECENTLY_BEATEN_ATS_CV_NAME, TRACK_UIDS_CV_NAME, UNBEATEN_ATS_CV_NAME, UNBEATEN_ATS_LEADERBOARD_CV_NAME, get_tmx_map, get_unbeaten_ats_query, refresh_nb_players_inner, QUALI_TIMES_CACHE_SECONDS, tmx_map_still_public
+from .events import EVENTS
+from .view_logic import CURRENT_COTD_KEY, NB_PLAYERS_CACHE_SECONDS, NB_PLAYERS_MAX_CACHE_SECONDS, RECENTLY_BEATEN_ATS_CV_NAME, TRACK_UIDS_CV_NAME, UNBEATEN_ATS_CV_NAME, UNBEATEN_ATS_LEADERBOARD_CV_NAME, get_map_infos_with_tmx_fallback, get_tmx_map, get_unbeaten_ats_query, refresh_nb_players_inner, resolve_map_dl_url, QUALI_TIMES_CACHE_SECONDS, tmx_map_still_public
 
 # if LOCAL_DEV_MODE:
 #     logging.basicConfig(level=logging.DEBUG)
@@ -387,10 +394,27 @@ def refresh_nb_players(request, map_uid, user=None):
 
 
 
-@cache_page(CACHE_5_MIN)
 def get_surround_score(request, map_uid, score):
     if request.method != "GET": return HttpResponseNotAllowed(['GET'])
-    return JsonResponse(run_async(nadeo_get_surround_for_map(map_uid, score)))
+    resp = get_surround(map_uid, score)
+    if resp is None: return JsonResponse({'error': 'failed to get surround from nadeo'}, status=502)
+    return JsonResponse(resp)
+
+
+def surround_cache_stats(request):
+    return JsonResponse(get_surround_stats())
+
+
+def tmx_map_cache_stats(request):
+    return JsonResponse(get_tmx_map_cache_stats())
+
+
+def map_info_batch_stats(request):
+    return JsonResponse(get_map_info_stats())
+
+
+def debug_jobs(request):
+    return JsonResponse(get_jobs_status())
 
 
 
@@ -398,10 +422,9 @@ def get_track_mb_create(uid: str) -> Track:
     track = Track.objects.filter(uid=uid).first()
     if track is None:
         track = Track(uid=uid)
-        track_info = run_async(nadeoapi.core_get_maps_by_uid([uid]))
-        # logging.warn(f"track_info: {track_info}")
-        if track_info is list and len(track_info) > 0:
-            track_info2: dict = track_info[0]
+        track_info2 = get_map_info(uid)
+        # logging.warn(f"track_info: {track_info2}")
+        if track_info2 is not None:
             track.map_id = track_info2.get('mapId', None)
             track.name = track_info2.get('name', None)
             track.url = track_info2.get('fileUrl', None)
@@ -411,31 +434,29 @@ def get_track_mb_create(uid: str) -> Track:
 
 
 def increment_stats(user: User, track: Track, ghost: Ghost):
-    utp = UserTrackPlay.objects.filter(user=user, track=track).first()
+    ''' Counters are bumped with single UPDATE ... SET x = x + n statements so concurrent uploads can't lose updates.
+        The UserTrackPlay existence check is a subquery of the same UPDATE, so this must run before the UTP for `ghost` is saved.
+    '''
+    first_play = Case(When(Exists(UserTrackPlay.objects.filter(user=user, track=track)), then=Value(0)), default=Value(1))
+    run_increments = dict(
+        total_runs=F('total_runs') + (0 if ghost.segmented else 1),
+        segmented_runs=F('segmented_runs') + (1 if ghost.segmented else 0),
+        partial_runs=F('partial_runs') + (1 if ghost.partial else 0),
+        total_time=F('total_time') + (0 if ghost.segmented else ghost.duration),
+    )
+    upsert_stats(TrackStats, 'track', track, unique_users=F('unique_users') + first_play, **run_increments)
+    upsert_stats(UserStats, 'user', user, unique_maps=F('unique_maps') + first_play, **run_increments)
 
-    with transaction.atomic():
-        track_stats = TrackStats.objects.filter(track=track).first()
-        if track_stats is None: track_stats = TrackStats(track=track)
-        track_stats.total_runs += 1 if not ghost.segmented else 0
-        track_stats.segmented_runs += 1 if ghost.segmented else 0
-        track_stats.partial_runs += 1 if ghost.partial else 0
-        if not ghost.segmented:
-            track_stats.total_time += ghost.duration
-        if utp is None:
-            track_stats.unique_users += 1
-        track_stats.save()
 
+def upsert_stats(stats_model: type[Model], parent_field: str, parent: Model, **increments):
+    key = {parent_field: parent}
     with transaction.atomic():
-        user_stats = UserStats.objects.filter(user=user).first()
-        if user_stats is None: user_stats = UserStats(user=user)
-        user_stats.total_runs += 1 if not ghost.segmented else 0
-        user_stats.segmented_runs += 1 if ghost.segmented else 0
-        user_stats.partial_runs += 1 if ghost.partial else 0
-        if not ghost.segmented:
-            user_stats.total_time += ghost.duration
-        if utp is None:
-            user_stats.unique_maps += 1
-        user_stats.save()
+        if stats_model.objects.filter(**key).update(**increments) > 0:
+            return
+        # first stats for this parent: lock the parent row so concurrent first uploads don't create duplicate stats rows
+        type(parent).objects.select_for_update().filter(pk=parent.pk).first()
+        stats_model.objects.get_or_create(**key)
+        stats_model.objects.filter(**key).update(**increments)
 
 
 @requires_openplanet_auth(ARCHIVIST_PLUGIN_ID)
@@ -644,7 +665,7 @@ def rand_mapsearch(author: Optional[str], len_match: TrackLenMatch, vehicles: li
         q_dict = dict(TrackID__in=rand_tids)
         if author is not None:
             q_dict = dict(Username__iexact=author)
-        query = TmxMap.objects.filter(**q_dict)
+        query = TmxMap.objects.filter(**q_dict).for_search()
         if len(include_tags) > 0:
             query = query.filter(reduce(operator.and_ if require_all_tags else operator.or_, (Q(Tags__contains=f"{t}") for t in include_tags)))
         tracks: list[TmxMap] = query.all()
@@ -682,12 +703,12 @@ def rand_mapsearch(author: Optional[str], len_match: TrackLenMatch, vehicles: li
             dur = time.time() - start_t
             logging.info(f"mapsearch2 took {dur:.4f} seconds")
             logging.info(f"Found track: {track.TrackID} / not found: {len(no_track)} / no match: {len(no_match)} / count: {count}")
-            return track
+            return TmxMap.objects.get(pk=track.pk)
         # track.Tags
     dur = time.time() - start_t
     logging.info(f"mapsearch2 took {dur:.4f} seconds / count: {count}")
     if last_track is not None:
-        return last_track
+        return TmxMap.objects.get(pk=last_track.pk)
     return HttpResponseNotFound("Searched 20k maps but did not find a map")
 
 
@@ -698,18 +719,9 @@ def clone_and_shuffle(xs: list) -> list:
 
 
 def map_dl(request, mapid: int):
-    tmx_url = f"https://trackmania.exchange/maps/download/{mapid}"
-    cgf_url = f"https://cgf.s3.nl-1.wasabisys.com/{mapid}.Map.Gbx"
-    if http_head_okay(tmx_url):
-        return HttpResponseRedirect(tmx_url)
-    track = TmxMap.objects.filter(TrackID=mapid).first()
-    if track is not None and track.TrackUID is not None:
-        maps_resp = run_async(core_get_maps_by_uid([track.TrackUID]))
-        if maps_resp is not None and len(maps_resp) >= 1:
-            return HttpResponseRedirect(maps_resp[0]['fileUrl'])
-    # do this last because some are just a saved error page
-    if http_head_okay(cgf_url):
-        return HttpResponseRedirect(cgf_url)
+    url, _source = resolve_map_dl_url(mapid)
+    if url is not None:
+        return HttpResponseRedirect(url)
     return HttpResponseNotFound(f"Could not find track with ID: {mapid}! (Unknown ID or missing UID or not uploaded to Nadeo)")
 
 
@@ -727,26 +739,18 @@ def tmx_api_tags_gettags_refresh(request):
 
 
 def api_tmx_get_map(req, trackid: int):
-    track = TmxMap.objects.filter(TrackID=trackid).first()
+    track = get_tmx_map_record(trackid)
     if track is None:
         return HttpResponseNotFound(f"Could not find track with ID: {trackid}!")
-    return JsonResponse(model_to_dict(track))
+    return JsonResponse(track)
 
 
 def tmx_maps_get_map_info_multi(request, mapids: str):
     try:
         tmxIds = list(map(int, mapids.split(',')))
-        tracks = TmxMap.objects.filter(TrackID__in=tmxIds)
+        tracks = get_map_infos_with_tmx_fallback(tmxIds)
         print(f"Got ids: {len(tmxIds)} and tracks: {len(tracks)}")
-        resp = []
-        done = set()
-        for track in tracks:
-            if track.TrackID in done:
-                # print(f"Skipping duplicate: {track.TrackID}")
-                continue
-            done.add(track.TrackID)
-            resp.append(model_to_dict(track))
-        return JsonResponse(resp, safe=False)
+        return JsonResponse(tracks, safe=False)
     except Exception as e:
         print(f"Exception getting map ids: {e}")
         return HttpResponseRedirect(f"https://trackmania.exchange/api/maps/get_map_info/multi/{mapids}")
@@ -811,7 +815,7 @@ def tmx_next_map(request, map_id: int):
     start = time.time()
     tags = get_requests_query_tags(request)
     extra_maps = min(100, get_requests_query_int(request, 'extra', 5))
-    next_maps = TmxMap.objects.filter(TrackID__gt=map_id, MapType="TM_Race")
+    next_maps = TmxMap.objects.filter(TrackID__gt=map_id, MapType="TM_Race").for_next_map()
     if len(tags) > 0:
         next_maps = next_maps.filter(reduce(operator.or_, (Q(Tags__contains=f"{t}") for t in tags)))
     next_maps = next_maps.order_by('TrackID')
@@ -866,7 +870,7 @@ def tmx_next_map(request, map_id: int):
     return JsonResponse(resp)
 
 def tmx_prev_map(request, map_id: int):
-    prev_map = TmxMap.objects.filter(TrackID__lt=map_id, MapType__contains="TM_Race").order_by('-TrackID').first()
+    prev_map = TmxMap.objects.filter(TrackID__lt=map_id, MapType__contains="TM_Race").order_by('-TrackID').only('TrackID', 'TrackUID').first()
     if prev_map is None:
         return JsonResponse(dict(prev=1))
     return JsonResponse(dict(prev=prev_map.TrackID, prev_uid=prev_map.TrackUID))
@@ -876,14 +880,14 @@ def tmx_count_at_map(request, map_id: int):
 
 
 def get_unbeaten_at_details(request, trackid:int):
-    track = TmxMap.objects.filter(TrackID=trackid).first()
+    track = get_tmx_map_record(trackid)
     if track is None:
         return HttpResponseNotFound(f"Could not find track with ID: {trackid}!")
-    map_at = TmxMapAT.objects.filter(Track_id=track.pk).first()
+    map_at = TmxMapAT.objects.filter(Track__TrackID=trackid).first()
     if map_at is None:
         return HttpResponseNotFound(f"Could not find AT for track with ID: {trackid}!")
     ret = model_to_dict(map_at)
-    ret['Track'] = model_to_dict(track)
+    ret['Track'] = track
     return JsonResponse(ret)
 
 
@@ -917,25 +921,33 @@ def track_ids_to_uid(request):
 
 
 def get_kr5_cached_doc(request):
-    cached_value = CachedValue.objects.filter(name=KR5_RESULTS_CV_NAME).first()
-    if cached_value is not None:
-        return JsonEncodedResponse(cached_value.value)
-    return JsonResponse(dict(error='not yet initialized'))
+    return get_event_cached_doc(request, 'kr5', 'results')
 
 def get_kr5_maps_cached_doc(request):
-    cached_value = CachedValue.objects.filter(name=KR5_MAPS_CV_NAME).first()
-    if cached_value is not None:
-        return JsonEncodedResponse(cached_value.value)
-    return JsonResponse(dict(error='not yet initialized'))
+    return get_event_cached_doc(request, 'kr5', 'maps')
 
 def get_kr5_map_lb_cached_doc(request, map_number: int):
-    if map_number < 0 or map_number > 74:
+    return get_event_cached_doc(request, 'kr5', 'map', map_number)
+
+def get_event_cached_doc(request, slug: str, doc: str, map_number: int | None = None):
+    event = EVENTS.get(slug)
+    if event is None:
+        return JsonResponse(dict(error='Unknown event'), status=404)
+    cv_name = event.cv_name(doc, map_number)
+    if cv_name is None:
         return JsonResponse(dict(error='Invalid map number'))
-    cached_value = CachedValue.objects.filter(name=KR5_MAP_CV_NAME_FMT.format(map_number)).first()
+    cached_value = CachedValue.objects.filter(name=cv_name).first()
     if cached_value is not None:
         return JsonEncodedResponse(cached_value.value)
     return JsonResponse(dict(error='not yet initialized'))
 
+def list_events(request):
+    return JsonResponse(dict(events=[
+        dict(slug=e.slug, active=e.is_active(), nb_maps=e.nb_maps, refresh_period=e.refresh_period,
+             active_from=e.active_from, active_until=e.active_until if e.active_until != float('inf') else None)
+        for e in EVENTS.values()
+    ]))
+
 class JsonEncodedResponse(HttpResponse):
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("content_type", "application/json")
@@ -972,70 +984,56 @@ class JsonErrorResponse(JsonResponse):
         self.status_code = status_code
 
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-@cache_page(CACHE_ICONS_TTL)
+# note: cache_page never applied to these (POST responses aren't cached), so conversions are cached by input hash instead
 def convert_webp_to_png(request: HttpRequest):
     if (request.method != "POST"): return HttpResponseNotAllowed(['POST'])
     if len(request.body) > 12000: return HttpResponseBadRequest("Image too big, max 12kb after b64 encoding")
-    im = Image.open(BytesIO(base64.decodebytes(request.body)), formats=['webp'])
-    return finish_icon_img_request(im)
+    bs = base64.decodebytes(request.body)
+    png = image_cache.get_or_create(content_key('webp-icon', bs), lambda: icon_to_png(webp_to_image(bs)))
+    return FileResponse(BytesIO(png))
 
-@cache_page(CACHE_ICONS_TTL)
 def convert_rgba_to_png(request: HttpRequest):
     if (request.method != "POST"): return HttpResponseNotAllowed(['POST'])
     if len(request.body) > 24000: return HttpResponseBadRequest("Image too big, max 24kb after b64 encoding")
     bs = base64.decodebytes(request.body)
     if len(bs) % 4 != 0: return HttpResponseBadRequest("Image bytes must be len%4==0 (and in bgra format)")
-    img_bytes = b''.join(bytes((r,g,b,a)) for (b,g,r,a) in chunks([b for b in bs], 4))
-    im = Image.frombytes('RGBA', (64, 64), img_bytes)
-    return finish_icon_img_request(im)
-
-def finish_icon_img_request(im: Image):
-    im = im.resize((64, 64))
-    im = im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-    bs = BytesIO()
-    im.save(bs, "png", optimize=True)
-    print(f'generated size: {bs.tell()}')
-    bs.seek(0)
-    return FileResponse(bs)
+    png = image_cache.get_or_create(content_key('bgra-icon', bs), lambda: icon_to_png(bgra_to_image(bs)))
+    return FileResponse(BytesIO(png))
 
+MAX_ICONS_PER_BATCH = 64
+# b64 of MAX_ICONS_PER_BATCH icons, allowing for a newline every 76 chars (base64.encodebytes); the icons are counted after decoding
+MAX_ICON_BATCH_BODY_LEN = (ICON_BGRA_LEN * MAX_ICONS_PER_BATCH + 2) // 3 * 4 * 77 // 76 + 1
 
-def lm_conversion_req(request: HttpRequest):
+def convert_rgba_to_png_batch(request: HttpRequest):
+    ''' body: b64 of N concatenated 64x64 BGRA icons; returns N length-prefixed PNGs in the same order '''
     if (request.method != "POST"): return HttpResponseNotAllowed(['POST'])
-    max_mb = 10
-    if len(request.body) > (1024**2) * max_mb: return HttpResponseBadRequest(f"LM zip too big, max {max_mb} MB after b64 encoding (was {len(request.body) / (1024**2):.2f} MB)")
-    zip_bytes = BytesIO(base64.decodebytes(request.body))
-    zip_bytes.seek(0)
+    if len(request.body) > MAX_ICON_BATCH_BODY_LEN: return HttpResponseBadRequest(f"Too many icons, max {MAX_ICONS_PER_BATCH} per request")
+    bs = memoryview(base64.decodebytes(request.body))
+    if len(bs) == 0 or len(bs) % ICON_BGRA_LEN != 0:
+        return HttpResponseBadRequest(f"Image bytes must be a multiple of {ICON_BGRA_LEN} (64x64 icons in bgra format)")
+    if len(bs) // ICON_BGRA_LEN > MAX_ICONS_PER_BATCH: return HttpResponseBadRequest(f"Too many icons, max {MAX_ICONS_PER_BATCH} per request")
     output = BytesIO()
-    with zipfile.ZipFile(zip_bytes) as zf:
-        for name in zf.namelist():
-            processed = process_lm_file(name, zf)
-            if processed:
-                new_name = name[:-5] + ".png"
-                output.write(len(new_name).to_bytes(4, 'little'))
-                output.write(new_name.encode())
-                # output.write(b'\x00')
-                data_size = processed.tell()
-                processed.seek(0)
-                output.write(data_size.to_bytes(4, 'little'))
-                output.write(processed.read(data_size))
-                print(f"{new_name}: {data_size}")
+    for i in range(0, len(bs), ICON_BGRA_LEN):
+        icon = bs[i:i + ICON_BGRA_LEN]
+        output.write(frame_bytes(image_cache.get_or_create(content_key('bgra-icon', icon), lambda: icon_to_png(bgra_to_image(icon)))))
     output.seek(0)
     return FileResponse(output)
 
-def process_lm_file(name: str, zf: zipfile.ZipFile) -> BytesIO | None:
-    can_process = name == "ProbeGrid.webp" or (name.startswith("LightMap") and name.endswith(".webp"))
-    if not can_process: return None
-    data = zf.read(name)
-    im = Image.open(BytesIO(data), formats=['webp'])
-    im = im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-    bs = BytesIO()
-    im.save(bs, "png")
-    return bs
+
+def lm_conversion_req(request: HttpRequest):
+    ''' query: compress_level=0..9 (optional) '''
+    if (request.method != "POST"): return HttpResponseNotAllowed(['POST'])
+    max_mb = 10
+    if len(request.body) > (1024**2) * max_mb: return HttpResponseBadRequest(f"LM zip too big, max {max_mb} MB after b64 encoding (was {len(request.body) / (1024**2):.2f} MB)")
+    try:
+        compress_level = parse_compress_level(request.GET.get('compress_level'))
+    except ValueError:
+        return HttpResponseBadRequest("compress_level must be an int from 0 to 9")
+    try:
+        files = read_lm_files(base64.decodebytes(request.body))
+    except zipfile.BadZipFile:
+        return HttpResponseBadRequest("Not a valid zip file")
+    return FileResponse(BytesIO(convert_lightmaps(files, compress_level, get_lm_pool())))
 
 
 def convert_tmx_webp_thumbnail(request: HttpRequest):
@@ -1044,12 +1042,9 @@ def convert_tmx_webp_thumbnail(request: HttpRequest):
     url = request.body.decode('utf-8')
     bad_ret = url_looks_like_tmx_image(url)
     if bad_ret is not None: return bad_ret
-    img_bytes = get_req_sync(url)
-    im = Image.open(BytesIO(img_bytes), formats=['webp'])
-    bs = BytesIO()
-    im.save(bs, "png", optimize=True)
-    bs.seek(0)
-    return FileResponse(bs)
+    # keyed on the URL so a hit skips the download too (TMX thumbnails don't change for a given URL)
+    png = image_cache.get_or_create(content_key('tmx-thumb', url), lambda: webp_to_png(get_req_sync(url)))
+    return FileResponse(BytesIO(png))
 
 
 def url_looks_like_tmx_image(url: str) -> bool:
@@ -0,0 +1,8 @@
+import os
+
+
+def child_exit(server, worker):
+    # prometheus multiprocess mode (see mapmonitor/metrics.py): drop the exited worker's live gauges
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
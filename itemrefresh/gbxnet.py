@@ -1,5 +1,6 @@
 
 import binascii
+import hashlib
 import json
 import logging
 import math
@@ -8,6 +9,8 @@ from pathlib import Path
 import random
 import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import zipfile
 from dataclasses import dataclass
@@ -16,7 +19,8 @@ import requests
 
 import sys
 
-from mapmonitor.settings import DEBUG
+from getrecords.blob_cache import BlobCache, content_key
+from mapmonitor.settings import DEBUG, GBX_NET_MAX_CONCURRENT_RUNS, GBX_NET_TIMEOUT, MAP_CACHE_DIR, MAP_CACHE_MAX_BYTES
 
 IS_WINDOWS = sys.platform.startswith('win32')
 
@@ -42,13 +46,26 @@ if LOCAL_DEV_MODE:
 @dataclass
 class EmbedRequest:
     item_filenames: list[str]
-    items: list[bytes]
-    map_bytes: bytes
+    # usually memoryview slices of the request body; anything bytes-like works
+    items: list[bytes | memoryview]
+    map_bytes: bytes | memoryview
 
     def zipped_items(self):
         return zip(self.item_filenames, self.items)
 
+    def cache_key(self) -> str:
+        ''' same base map + same (filename, item contents) list, in order => same output; includes the exe version since that determines the output too '''
+        items = [(fname.replace('\\', '/'), hashlib.sha256(item).digest()) for fname, item in self.zipped_items()]
+        return content_key('embed-map', GBX_NET_EXE_NAME, self.map_bytes, *(part for item in items for part in item))
+
+
+map_cache = BlobCache(MAP_CACHE_DIR, MAP_CACHE_MAX_BYTES)
+
 def generate_map_bytes(item_paths: EmbedRequest):
+    ''' a cache hit returns without touching GBX.NET '''
+    return map_cache.get_or_create(item_paths.cache_key(), lambda: _generate_map_bytes(item_paths))
+
+def _generate_map_bytes(item_paths: EmbedRequest):
     # ensure_map_base_downloaded()
     # if not LOCAL_DEV_MODE:
     ensure_gbx_net_exe_downloaded()
@@ -94,43 +111,30 @@ def save_url_to_file(url, f: Path):
 
 
 def run_map_generation(item_paths: EmbedRequest) -> bytes:
-    tmpdir = Path(f'/tmp/mapgen/{random.randint(0, 10**10)}')
-    if not tmpdir.exists():
-        tmpdir.mkdir(parents=True, exist_ok=True)
-    _curdir = os.curdir
-    os.chdir(tmpdir)
+    ''' each request gets its own working dir and the exe is run with cwd= it, so concurrent requests can't collide (no os.chdir) '''
+    workdir = Path(tempfile.mkdtemp(prefix='mapgen-'))
+    try:
+        items = write_items(workdir, item_paths)
+        return run_place_objects_on_map(workdir, item_paths.map_bytes, [], items, clean_items=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
 
+
+def write_items(workdir: Path, item_paths: EmbedRequest) -> list['DotnetItem']:
+    items_dir = (workdir / 'Items').resolve()
     items = []
     for ip, item_bytes in item_paths.zipped_items():
         raw_ip = ip.replace('\\', '/')
-        itemNameOnly = Path(raw_ip).name
-        pos = DotnetVector3(
-            # random.random() * 48. * 32.,
-            # 100,
-            # random.random() * 48. * 32.
-            31,100,31
-        )
-        item = DotnetItem(f'{raw_ip}', f'Items/{raw_ip}', pos, DotnetVector3(), DotnetVector3())
-        item_path = Path(f'Items/{raw_ip}')
         if not ip.lower().endswith('.gbx'):
             raise Exception('bad file name')
-        if ('../' in ip or '../' in ip):
+        item_path = (items_dir / raw_ip).resolve()
+        if '../' in raw_ip or not item_path.is_relative_to(items_dir):
             raise Exception('bad path')
-        item_folder = item_path.parent
-        if not item_folder.exists():
-            item_folder.mkdir(parents=True, exist_ok=True)
-        # (Path('Items') / item_path).write_bytes(item_bytes)
-        (item_path).write_bytes(item_bytes)
-        items.append(item)
-
-    resp = run_place_objects_on_map(item_paths.map_bytes, [], items, clean_items=True)
-
-    print(f"list dir: {list(tmpdir.glob('**/*'))}")
-
-    os.chdir(_curdir)
-    shutil.rmtree(tmpdir, ignore_errors=True)
-
-    return resp
+        pos = DotnetVector3(31,100,31)
+        items.append(DotnetItem(f'{raw_ip}', f'Items/{raw_ip}', pos, DotnetVector3(), DotnetVector3()))
+        item_path.parent.mkdir(parents=True, exist_ok=True)
+        item_path.write_bytes(item_bytes)
+    return items
 
 
 
@@ -275,7 +279,8 @@ class ComplexEncoder(json.JSONEncoder):
 
 # Dotnet commands
 def run_place_objects_on_map(
-    base_map_bytes: bytes,
+    workdir: Path,
+    base_map_bytes: bytes | memoryview,
     blocks: list[DotnetBlock] = [],
     items: list[DotnetItem] = [],
     # should_overwrite: bool = False,
@@ -288,9 +293,8 @@ def run_place_objects_on_map(
     config_path = f'{base_name}.json'
     _out_map_path = f'Maps/{base_name}.Map.Gbx'
     _populated_out_map_path = f"Maps/{base_name}_p.Map.Gbx"
-    Path('Maps').mkdir()
-    out_map_path = Path(_out_map_path)
-    out_map_path.write_bytes(base_map_bytes)
+    (workdir / 'Maps').mkdir(exist_ok=True)
+    (workdir / _out_map_path).write_bytes(base_map_bytes)
     overwrite = True
 
     cfg = DotnetPlaceObjectsOnMap(
@@ -306,50 +310,58 @@ def run_place_objects_on_map(
     cfg_str = json.dumps(cfg, cls=ComplexEncoder, ensure_ascii=False)
     logging.info(f"run_place_objects_on_map {cfg_str}")
 
-    with open(config_path, 'w+', encoding='utf-8') as outfile:
-        outfile.write(cfg_str)
-        outfile.close()
+    (workdir / config_path).write_text(cfg_str, encoding='utf-8')
 
-    res = _run_dotnet(config_path)
+    res = run_dotnet(config_path, workdir)
     logging.info(f"Got back from run dotnet: success: {res.success} \n MSG: \n {res.message}")
 
     if not res.success or "Error:" in res.message:
         raise Exception(f"dotnet exe failed: {res.message}")
     print([config_path, _out_map_path, _populated_out_map_path])
-    ret_bytes = Path(_out_map_path if overwrite else _populated_out_map_path).read_bytes()
+    # the caller removes workdir
+    return (workdir / (_out_map_path if overwrite else _populated_out_map_path)).read_bytes()
+
+
 
-    os.remove(config_path)
-    os.remove(_out_map_path)
-    if not overwrite:
-        os.remove(_populated_out_map_path)
-    return ret_bytes
 
+# Each run is a separate process (so each pays the .NET startup), at most GBX_NET_MAX_CONCURRENT_RUNS at once per server
+# process. Keeping warm worker processes around instead needs a server mode (read jobs from stdin, answer on stdout) that
+# tm-embed-items doesn't have, so that waits on a new release of it.
+_run_slots = threading.BoundedSemaphore(max(1, GBX_NET_MAX_CONCURRENT_RUNS))
 
 
+def run_dotnet(payload: str, cwd: Path) -> DotnetExecResult:
+    with _run_slots:
+        return _run_dotnet(payload, cwd)
 
-def _run_dotnet(payload: str) -> DotnetExecResult:
+
+def _run_dotnet(payload: str, cwd: Path) -> DotnetExecResult:
     #print(payload)
     dotnet_exe = GBX_NET_EXE
 
-    logging.info(f'running dotnet: {dict(cwd=os.getcwd(), exe=dotnet_exe, path=payload)}')
+    logging.info(f'running dotnet: {dict(cwd=str(cwd), exe=dotnet_exe, path=payload)}')
     process = subprocess.Popen(args=[
         dotnet_exe,
         # command,
         payload.strip('"'),
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    out, err = process.communicate()
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+
+    try:
+        out, err = process.communicate(timeout=GBX_NET_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        return DotnetExecResult(message=f"Error: timed out after {GBX_NET_TIMEOUT}s", success=False)
     if len(err) != 0:
         return DotnetExecResult(message=err.decode("utf-8") , success=False)
 
     res = out.decode("utf-8").strip()
     if process.returncode != 0:
-        return DotnetExecResult(message="Unknown Error", success=False) if len(res) == 0 else res
+        return DotnetExecResult(message="Unknown Error" if len(res) == 0 else res, success=False)
 
     return DotnetExecResult(message=res, success=True)
 
 
 
-
 minimal_item_hex = "424706584200435500520020852e00000400000003000010512e000006000010082e000000000020042e000001000020042e000003000000ff00ffff1aff000000000000164000004300306977627145517153333279317a475771397978085100000500000049006574736dffffffff000800000001000b0000694d696e616d496c6574036d000000000000000000010000000000000006000000000000062000000355000009340010052e000049006574736d0000000000030000ffffffff100b2e00ffffffff001a00803f00164000004300306977627145517153333279317a4757713979780c5100100b2e00004d006e696d696c6174496d65100d2e00000e00006f4e442073657263706969746e6f10102e0000040000ffffffffdc00020010112e008401a40c06000001000012030010f02ee401020020082e00cc0736130004090200200a2e06c2200c17be201209ac04300500bf80999a3e19201510a0190200200f2e7c2dec01800603140260002e0260108c010e00000200000000000030030900300209ac290e0200030000d000090fd000090f000b0000f0010015001b00001000230000005300617469646d754d5c646561694d5c7461726561695c6c6c5074616f666d72655468630fe4042a0600ffffffffd001090fcc052801006e3f8001ec02010fd0ec090a01de01faca300409004950534b290c02840104000005000030049c1b8419f400a40600064000004c00796172650830000047006f65656d7274017908c425020000040044dd860480068f420021430009b64340ec2a9c060c1f000b0000654461666c7543746275e065bc400105000008000096c00000b8009c01edcd40000000dda840ee0180042d40002c05dc029c2e2ac000c10c060718c004ac049d2800001c02ff0000961802183203000c16000001020300010100060504070000040103070000010004050100000006010105000201000607030209bc1cf828e9c8068746000c550c00a405ac79018555a4aa0000790d795579550055ff000cffff550cfff25500aaf20000aa85000caa85550caa038c7901f255b6aaff03b6ff7903b4550303aa85000055790ccc060002010403060508070a090c0b0e0d100f121114131615071740d014ba3f8000af4000c10602421c310100de01faca77ec16a451b03ae8043c28000aa000a43c3cfc002e26000603e80eac01050260502e4b49d45384470100de01faca11b7ffffca1a1c80ac20b89c01552e02000006bd84323406019c642ee702800001bf07d4d52a04014d31050002cc340a000005000000000018700a09e82d300e0384dc280201de01facad01ef49efc2c0200201f2e00d00cec70940206b6ffffffff20202e00bc030202000020252f00048d3126004d3027004c0002de01faca00110000"
 minimal_item = binascii.unhexlify(minimal_item_hex)
@@ -0,0 +1,78 @@
+import io
+import json
+import os
+from pathlib import Path
+import shutil
+import struct
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from itemrefresh.gbxnet import EmbedRequest, write_items
+from itemrefresh.views import read_request_parts
+
+
+class Command(BaseCommand):
+    help = "Memory-profile the create_map body parser (legacy BytesIO copies vs memoryview slices) on large synthetic item sets"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nb-items", type=str, default="10,100,500", help="comma separated item counts")
+        parser.add_argument("--item-kb", type=int, default=200)
+        parser.add_argument("--map-kb", type=int, default=500)
+
+    def handle(self, *args, **options):
+        for nb_items in [int(n) for n in options['nb_items'].split(',')]:
+            body = synthetic_body(nb_items, options['item_kb'] * 1024, options['map_kb'] * 1024)
+            legacy, new = legacy_read_request_parts(body), read_request_parts(body)
+            if legacy.item_filenames != new.item_filenames or legacy.items != [bytes(i) for i in new.items] or legacy.map_bytes != bytes(new.map_bytes):
+                raise Exception("legacy and memoryview parsers differ!")
+            del legacy, new
+            self.stdout.write(f"{nb_items} items, body {len(body) / 1024**2:.1f} MB:")
+            for name, f in [('legacy', legacy_read_request_parts), ('memoryview', read_request_parts)]:
+                parse = profile(lambda: f(body))
+                with_write = profile(lambda: write_to_tmp(f(body)))
+                self.stdout.write(f"  {name:>10}: parse peak {parse['peak_mb']:7.2f} MB in {parse['ms']:7.1f} ms"
+                                  f" | parse+write items peak {with_write['peak_mb']:7.2f} MB in {with_write['ms']:7.1f} ms")
+
+
+def synthetic_body(nb_items: int, item_size: int, map_size: int) -> bytes:
+    names = json.dumps([f"Folder\\Item{i}.Item.Gbx" for i in range(nb_items)]).encode()
+    parts = [struct.pack('<I', len(names)), names, struct.pack('<I', nb_items)]
+    for _ in range(nb_items):
+        parts += [struct.pack('<I', item_size), os.urandom(item_size)]
+    parts += [struct.pack('<I', map_size), os.urandom(map_size)]
+    rest = b''.join(parts)
+    return struct.pack('<I', len(rest) + 4) + rest
+
+
+def legacy_read_request_parts(_body: bytes) -> EmbedRequest:
+    ''' the BytesIO parser create_map used before, kept for comparison '''
+    def read_uint(b): return struct.unpack_from('<I', b.read(4))[0]
+    def read_bytes(b): return b.read(read_uint(b))
+    body = io.BytesIO(_body)
+    if read_uint(body) != len(_body): raise Exception('bad length')
+    item_filenames = json.loads(read_bytes(body))
+    items = [read_bytes(body) for _ in range(read_uint(body))]
+    return EmbedRequest(item_filenames, items, read_bytes(body))
+
+
+def write_to_tmp(req: EmbedRequest):
+    workdir = Path(tempfile.mkdtemp(prefix='mapgen-profile-'))
+    try:
+        write_items(workdir, req)
+        (workdir / 'map.Map.Gbx').write_bytes(req.map_bytes)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def profile(f) -> dict:
+    ''' peak python allocations during f() (the body itself is allocated beforehand so isn't counted) '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    f()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(peak_mb=peak / 1024**2, ms=duration * 1000)
@@ -1,3 +1,73 @@
-from django.test import TestCase
+import struct
+import tracemalloc
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from itemrefresh.management.commands.profile_create_map_parser import legacy_read_request_parts, synthetic_body
+from itemrefresh.views import read_request_parts
+
+
+def peak_alloc(f) -> int:
+    ''' peak bytes allocated while f() runs '''
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def with_u32(body: bytes, pos: int, value: int) -> bytes:
+    return body[:pos] + struct.pack('<I', value) + body[pos + 4:]
+
+
+class ReadRequestPartsTests(SimpleTestCase):
+    def test_items_and_map_are_slices_of_the_body(self):
+        body = synthetic_body(3, 100, 200)
+        req = read_request_parts(body)
+        for part in req.items + [req.map_bytes]:
+            self.assertIsInstance(part, memoryview)
+            self.assertIs(part.obj, body)
+        self.assertEqual([len(i) for i in req.items], [100, 100, 100])
+        self.assertEqual(len(req.map_bytes), 200)
+
+    def test_same_as_legacy_parser(self):
+        body = synthetic_body(5, 37, 91)
+        legacy, new = legacy_read_request_parts(body), read_request_parts(body)
+        self.assertEqual(new.item_filenames, legacy.item_filenames)
+        self.assertEqual([bytes(i) for i in new.items], legacy.items)
+        self.assertEqual(bytes(new.map_bytes), legacy.map_bytes)
+
+    def test_no_items(self):
+        req = read_request_parts(synthetic_body(0, 10, 50))
+        self.assertEqual((req.item_filenames, req.items, len(req.map_bytes)), ([], [], 50))
+
+    def test_truncated_bodies(self):
+        body = synthetic_body(2, 10, 20)
+        for cut in [0, 3, 4, 10, len(body) - 1]:
+            truncated = body[:cut]
+            if cut >= 4:
+                # keep total_len consistent so it's the field lengths that are wrong
+                truncated = with_u32(truncated, 0, cut)
+            with self.assertRaises(ValueError):
+                read_request_parts(truncated)
+        with self.assertRaises(ValueError):
+            read_request_parts(body + b'\0')
+
+    def test_oversized_lengths_rejected_before_allocating(self):
+        body = synthetic_body(2, 10, 20)
+        names_len = struct.unpack_from('<I', body, 4)[0]
+        nb_items_pos = 8 + names_len
+        first_item_pos = nb_items_pos + 4
+        for pos in [4, nb_items_pos, first_item_pos]:
+            bad = with_u32(body, pos, 0xFFFFFFFF)
+            peak = peak_alloc(lambda: self.assertRaises(ValueError, read_request_parts, bad))
+            self.assertLess(peak, 64 * 1024)
+
+    def test_memory_for_large_item_sets(self):
+        body = synthetic_body(200, 20 * 1024, 100 * 1024)
+        legacy_peak = peak_alloc(lambda: legacy_read_request_parts(body))
+        peak = peak_alloc(lambda: read_request_parts(body))
+        # the legacy parser copies every item; the memoryview one only allocates the filenames and the slice objects
+        self.assertGreater(legacy_peak, len(body))
+        self.assertLess(peak, len(body) // 20)
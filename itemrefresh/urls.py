@@ -4,4 +4,5 @@ from . import views
 
 urlpatterns = [
     path('itemrefresh/create_map', views.create_map, name='create_map'),
+    path('itemrefresh/cache_stats', views.map_cache_stats, name='map_cache_stats'),
 ]
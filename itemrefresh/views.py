@@ -1,7 +1,6 @@
 import asyncio
 import base64
 from dataclasses import dataclass
-import io
 import json
 import logging
 from pathlib import Path
@@ -13,14 +12,17 @@ from django.shortcuts import render
 import requests
 import zipfile
 
-from itemrefresh.gbxnet import EmbedRequest, generate_map_bytes
+from itemrefresh.gbxnet import EmbedRequest, generate_map_bytes, map_cache
 
 # Create your views here.
 
 def create_map(request: HttpRequest):
     if request.method != "POST": return HttpResponseNotAllowed(['POST'], "POST only")
     print(f'body len: {len(request.body)}')
-    req_parts = read_request_parts(base64.b64decode(request.body))
+    try:
+        req_parts = read_request_parts(base64.b64decode(request.body))
+    except ValueError as e:
+        return HttpResponseBadRequest(f"Bad request body: {e}")
     print('got req parts!')
     map_bytes = generate_map_bytes(req_parts)
     # filename=f'map-with-items-{time.time()}.Map.Gbx',
@@ -29,53 +31,67 @@ def create_map(request: HttpRequest):
     return HttpResponse(map_bytes, content_type='application/octet-stream')
 
 
+def map_cache_stats(request: HttpRequest):
+    return JsonResponse(map_cache.stats())
 
 
-def read_request_parts(_body: bytes):
-    print(f'body len: {len(_body)}')
-    body = io.BytesIO(_body)
-    # print(f"_body len: {len(_body)}")
-    # print(f"body len: {len(body)}")
-    full_len = r_read_length(body, len(_body))
-    # print(f"body 2 len: {len(body)}")
-    item_filenames = r_read_json_array(body)
-    items = r_read_item_list(body)
-    map_bytes = r_read_map(body)
-    return EmbedRequest(item_filenames, items, map_bytes)
 
 
-def r_read_length(b: io.BytesIO, expected_len: int):
-    l = r_read_uint(b)
-    if expected_len != l:
-        raise Exception('bad length')
-    return l
+# body layout (all u32 LE):
+#   total_len (== len(body)) | len, json array of item filenames | nb_items, nb_items * (len, item bytes) | len, map bytes
 
-def r_read_uint(b: io.BytesIO):
-    _b = b.read(4)
-    # print(f'bytes ({len(_b)}): {_b}')
-    return struct.unpack_from('<I', _b)[0]
+def read_request_parts(_body: bytes) -> EmbedRequest:
+    ''' items and the map are memoryview slices of _body (no copies); every declared length is checked before anything is sliced '''
+    body = memoryview(_body)
+    r_read_length(body, len(body))
+    pos = 4
+    filenames_span, pos = r_read_span(body, pos)
+    nb_items, pos = r_read_uint(body, pos)
+    # each item needs at least its length prefix, so this bounds nb_items before we allocate anything for it
+    if nb_items * 4 > len(body) - pos:
+        raise ValueError(f'item count {nb_items} too large for body')
+    item_spans = []
+    for _ in range(nb_items):
+        span, pos = r_read_span(body, pos)
+        item_spans.append(span)
+    map_span, pos = r_read_span(body, pos)
+    if pos != len(body):
+        raise ValueError(f'{len(body) - pos} trailing bytes')
 
-def r_read_json_array(b: io.BytesIO) -> list[any]:
-    list_part = r_read_bytes(b)
-    return json.loads(list_part)
+    item_filenames = r_read_json_array(body, filenames_span)
+    if len(item_filenames) != nb_items:
+        raise ValueError(f'{len(item_filenames)} filenames but {nb_items} items')
+    items = [body[a:b] for a, b in item_spans]
+    return EmbedRequest(item_filenames, items, body[map_span[0]:map_span[1]])
 
-def r_read_item_list(b: io.BytesIO) -> list[bytes]:
-    return r_read_list(b)
 
-def r_read_map(b: io.BytesIO) -> bytes:
-    return r_read_bytes(b)
+def r_read_length(b: memoryview, expected_len: int):
+    l, _ = r_read_uint(b, 0)
+    if expected_len != l:
+        raise ValueError('bad length')
+    return l
 
-def r_read_list(b: io.BytesIO) -> list[bytes]:
-    size = r_read_uint(b)
-    ret = list()
-    for i in range(size):
-        ret.append(r_read_bytes(b))
+def r_read_uint(b: memoryview, pos: int) -> tuple[int, int]:
+    if pos + 4 > len(b):
+        raise ValueError(f'truncated at {pos}')
+    return struct.unpack_from('<I', b, pos)[0], pos + 4
+
+def r_read_span(b: memoryview, pos: int) -> tuple[tuple[int, int], int]:
+    ''' validates a length-prefixed field; returns ((start, end), next pos) '''
+    size, pos = r_read_uint(b, pos)
+    if pos + size > len(b):
+        raise ValueError(f'field at {pos - 4} declares {size} bytes but only {len(b) - pos} remain')
+    return (pos, pos + size), pos + size
+
+def r_read_json_array(b: memoryview, span: tuple[int, int]) -> list[str]:
+    try:
+        ret = json.loads(bytes(b[span[0]:span[1]]))
+    except json.JSONDecodeError as e:
+        raise ValueError(f'bad item filenames: {e}')
+    if not isinstance(ret, list) or not all(isinstance(f, str) for f in ret):
+        raise ValueError('item filenames must be a list of strings')
     return ret
 
-def r_read_bytes(b: io.BytesIO) -> bytes:
-    size = r_read_uint(b)
-    return b.read(size)
-
 
 
 def run_async(coro: Coroutine):
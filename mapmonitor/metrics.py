@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+
+from getrecords.job_telemetry import JobTelemetryCollector, note_upstream
+from mapmonitor.settings import DEBUG, METRICS_TOKEN, NADEO_CORE_BASE_URL, NADEO_LIVE_BASE_URL, NADEO_MEET_BASE_URL, TMX_BASE_URL, UBI_BASE_URL
+
+
+# Prometheus metrics for the web app and background jobs, served at /metrics.
+# With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR (an empty dir) so /metrics reports all workers, not just
+# whichever one served the scrape (see gunicorn.conf.py).
+# Background job progress (getrecords/job_telemetry.py) is read from redis when /metrics is scraped.
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_LATENCY = Histogram('mm_http_request_duration_seconds', 'Request latency by route', ['route', 'method', 'status'])
+REQUEST_DB_QUERIES = Histogram('mm_http_request_db_queries', 'DB queries per request', ['route'], buckets=COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('mm_http_request_db_seconds', 'DB time per request', ['route'])
+REQUEST_UPSTREAM_CALLS = Histogram('mm_http_request_upstream_calls', 'Upstream (nadeo/tmx/s3/...) calls per request', ['route'], buckets=COUNT_BUCKETS)
+UPSTREAM_LATENCY = Histogram('mm_upstream_request_duration_seconds', 'Upstream call latency', ['service'])
+UPSTREAM_REQUESTS = Counter('mm_upstream_requests_total', 'Upstream calls', ['service', 'status'])
+CACHE_LOOKUPS = Counter('mm_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+JOBS_COLLECTOR = JobTelemetryCollector()
+REGISTRY.register(JOBS_COLLECTOR)
+
+# per-request counters; a mutable dict so run_async / to_thread / sync_to_async work (which run in copies of the context,
+# and for db queries, on other threads' connections) still add to it
+_request_stats: ContextVar[dict | None] = ContextVar('mm_request_stats', default=None)
+
+UPSTREAM_SERVICES = [
+    ('trackmania.com', 'nadeo'), ('nadeo', 'nadeo'), ('ubi.com', 'nadeo'), ('ubisoft', 'nadeo'),
+    ('trackmania.exchange', 'tmx'), ('openplanet', 'openplanet'), ('kackyreloaded', 'kacky'),
+    ('wasabisys', 's3'), ('amazonaws', 's3'),
+]
+# checked first, so a stand-in on localhost (run_fake_upstream) is labelled like the real thing
+UPSTREAM_BASE_URLS = [
+    (TMX_BASE_URL, 'tmx'), (NADEO_CORE_BASE_URL, 'nadeo'), (NADEO_LIVE_BASE_URL, 'nadeo'), (NADEO_MEET_BASE_URL, 'nadeo'), (UBI_BASE_URL, 'nadeo'),
+]
+
+
+def upstream_service(url: str) -> str:
+    url = str(url)
+    for base, service in UPSTREAM_BASE_URLS:
+        if url.startswith(base + '/'): return service
+    host = urlsplit(url).hostname or ''
+    for part, service in UPSTREAM_SERVICES:
+        if part in host: return service
+    return 'other'
+
+
+def record_cache(cache_name: str, hits: int = 0, misses: int = 0):
+    if hits > 0: CACHE_LOOKUPS.labels(cache_name, 'hit').inc(hits)
+    if misses > 0: CACHE_LOOKUPS.labels(cache_name, 'miss').inc(misses)
+
+
+def record_upstream(service: str, status: str, seconds: float):
+    UPSTREAM_LATENCY.labels(service).observe(seconds)
+    UPSTREAM_REQUESTS.labels(service, status).inc()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats['upstream_calls'] += 1
+    note_upstream(status == 'ok' or (status.isdigit() and int(status) < 400))
+
+
+@contextmanager
+def observe_upstream(service: str):
+    ''' for upstream calls that don't go through aiohttp (e.g. boto3) '''
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        record_upstream(service, status, time.perf_counter() - start)
+
+
+def aiohttp_trace_config() -> aiohttp.TraceConfig:
+    ''' times every request made with a session that has this (see getrecords.http.get_session) '''
+    async def on_start(session, ctx, params):
+        ctx.mm_start = time.perf_counter()
+    async def on_end(session, ctx, params):
+        record_upstream(upstream_service(params.url), str(params.response.status), time.perf_counter() - ctx.mm_start)
+    async def on_exception(session, ctx, params):
+        record_upstream(upstream_service(params.url), type(params.exception).__name__, time.perf_counter() - ctx.mm_start)
+    tc = aiohttp.TraceConfig()
+    tc.on_request_start.append(on_start)
+    tc.on_request_end.append(on_end)
+    tc.on_request_exception.append(on_exception)
+    return tc
+
+
+class MetricsMiddleware:
+    ''' per-route latency, plus DB queries/time and upstream calls for each request '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest):
+        stats = dict(db_queries=0, db_seconds=0.0, upstream_calls=0)
+        # in case this thread connected before the signal handler was registered
+        install_query_counter(None, connection)
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        status = '500'
+        try:
+            response = self.get_response(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            _request_stats.reset(token)
+            match = getattr(request, 'resolver_match', None)
+            route = match.route if match is not None else 'unmatched'
+            REQUEST_LATENCY.labels(route, request.method, status).observe(time.perf_counter() - start)
+            REQUEST_DB_QUERIES.labels(route).observe(stats['db_queries'])
+            REQUEST_DB_SECONDS.labels(route).observe(stats['db_seconds'])
+            REQUEST_UPSTREAM_CALLS.labels(route).observe(stats['upstream_calls'])
+
+
+def install_query_counter(sender, connection, **kwargs):
+    ''' on every connection, whichever thread opens it, so queries made off the request thread are counted too '''
+    if timed_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(timed_execute)
+
+
+connection_created.connect(install_query_counter)
+
+
+def timed_execute(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats['db_queries'] += 1
+        stats['db_seconds'] += time.perf_counter() - start
+
+
+def metrics_view(request: HttpRequest):
+    if not METRICS_TOKEN:
+        # only served without a token for local dev
+        if not DEBUG: return HttpResponseForbidden("METRICS_TOKEN is not set")
+    elif request.headers.get('Authorization', '') != f"Bearer {METRICS_TOKEN}":
+        return HttpResponseForbidden()
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(JOBS_COLLECTOR)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 import os
 from pathlib import Path
 import sys
+import tempfile
 
 import environ
 import dj_database_url
@@ -47,6 +48,39 @@ CACHE_ICONS_TTL = 86400 * 365 * 10
 # cache 8 hours
 CACHE_8HRS_TTL = 3600 * 8
 
+# converted icons / thumbnails, keyed by a hash of the input (LRU by total size on local disk)
+IMAGE_CACHE_DIR = env('IMAGE_CACHE_DIR', default=str(Path(tempfile.gettempdir()) / 'mapmonitor' / 'image-cache'))
+IMAGE_CACHE_MAX_BYTES = env.int('IMAGE_CACHE_MAX_BYTES', default=256 * 1024**2)
+
+# lightmap webp -> png conversion: worker processes (0 = convert in the request thread) and default zlib level (0-9; lower is faster, larger)
+# Each gunicorn worker starts its own pool, so a dyno runs (gunicorn workers) x LM_CONVERSION_WORKERS conversion processes;
+# keep that product at or below the dyno's cpus.
+LM_CONVERSION_WORKERS = env.int('LM_CONVERSION_WORKERS', default=0)
+LM_PNG_COMPRESS_LEVEL = env.int('LM_PNG_COMPRESS_LEVEL', default=6)
+
+# itemrefresh map generation: max concurrent GBX.NET runs (per server process)
+GBX_NET_MAX_CONCURRENT_RUNS = env.int('GBX_NET_MAX_CONCURRENT_RUNS', default=2)
+GBX_NET_TIMEOUT = env.int('GBX_NET_TIMEOUT', default=120)
+# generated maps, keyed by a hash of the base map + items (LRU by total size on local disk)
+MAP_CACHE_DIR = env('MAP_CACHE_DIR', default=str(Path(tempfile.gettempdir()) / 'mapmonitor' / 'map-cache'))
+MAP_CACHE_MAX_BYTES = env.int('MAP_CACHE_MAX_BYTES', default=1024**3)
+
+# /metrics requires `Authorization: Bearer <METRICS_TOKEN>`; if it's unset, /metrics is only served in local dev (DEBUG)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# TmxMap records kept in each process's LRU (in front of redis; see getrecords/tmx_map_cache.py)
+TMX_MAP_LRU_SIZE = env.int('TMX_MAP_LRU_SIZE', default=20000)
+
+# upstream APIs (no trailing slash); for load testing, point them at the stand-in from `manage.py run_fake_upstream`
+TMX_BASE_URL = env('TMX_BASE_URL', default='https://trackmania.exchange')
+NADEO_CORE_BASE_URL = env('NADEO_CORE_BASE_URL', default='https://prod.trackmania.core.nadeo.online')
+NADEO_LIVE_BASE_URL = env('NADEO_LIVE_BASE_URL', default='https://live-services.trackmania.nadeo.live')
+NADEO_MEET_BASE_URL = env('NADEO_MEET_BASE_URL', default='https://meet.trackmania.nadeo.club')
+UBI_BASE_URL = env('UBI_BASE_URL', default='https://public-ubiservices.ubi.com')
+
+# background jobs: partitioned work (AT checks) is split into this many shards between the processes running a job
+BG_SHARDS = env.int('BG_SHARDS', default=16)
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.1/howto/deployment/checklist/
 
@@ -68,6 +102,7 @@ SECURE_HSTS_SECONDS = 0
 INSTALLED_APPS = [
     'getrecords.apps.GetrecordsConfig',
     'mapalitics.apps.MapaliticsConfig',
+    'itemrefresh.apps.ItemrefreshConfig',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -96,6 +131,8 @@ FILE_UPLOAD_MAX_MEMORY_SIZE = 1024*1024*16
 #     ]
 
 MIDDLEWARE = [
+    # first, so its timings cover the other middleware too
+    'mapmonitor.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
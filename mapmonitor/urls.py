@@ -17,6 +17,8 @@ import sys
 from django.contrib import admin
 from django.urls import path, include
 
+from mapmonitor.metrics import metrics_view
+
 # populated below
 urlpatterns = []
 
@@ -28,6 +30,7 @@ if IS_WINDOWS:
 else:
     urlpatterns = [
         path('admin/', admin.site.urls),
+        path('metrics', metrics_view),
         path('', include('getrecords.urls')),
         path('', include('mapalitics.urls')),
         path('', include('itemrefresh.urls')),